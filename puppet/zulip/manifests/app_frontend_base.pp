@@ -119,6 +119,7 @@ class zulip::app_frontend_base {
     'missedmessage_emails',
     'missedmessage_mobile_notifications',
     'outgoing_webhooks',
+    'rerender_messages',
     'user_activity',
     'user_activity_interval',
     'user_presence',
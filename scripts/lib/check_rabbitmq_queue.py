@@ -20,6 +20,7 @@ normal_queues = [
     "missedmessage_emails",
     "missedmessage_mobile_notifications",
     "outgoing_webhooks",
+    "rerender_messages",
     "user_activity",
     "user_activity_interval",
     "user_presence",
@@ -13,7 +13,7 @@ from scripts.lib.setup_path import setup_path
 
 setup_path()
 
-from scripts.lib.zulip_tools import get_config_file, get_tornado_ports
+from scripts.lib.zulip_tools import get_config, get_config_file, get_tornado_ports
 
 
 def nginx_quote(s: str) -> str:
@@ -74,7 +74,28 @@ def write_updated_configs() -> None:
             nginx_sharding_conf_f.write("\n")
         nginx_sharding_conf_f.write("}\n")
 
-        data = {"shard_map": shard_map, "shard_regexes": shard_regexes}
+        data: Dict[str, object] = {"shard_map": shard_map, "shard_regexes": shard_regexes}
+
+        # How users in a realm sharded across several ports are split
+        # between them; "modulo" (the default) or "consistent_hash".
+        user_sharding = get_config(
+            config_file, "application_server", "tornado_user_sharding", "modulo"
+        )
+        assert user_sharding in (
+            "modulo",
+            "consistent_hash",
+        ), f"unknown tornado_user_sharding {user_sharding!r}"
+        if user_sharding == "consistent_hash":
+            virtual_nodes = get_config(
+                config_file, "application_server", "tornado_user_sharding_virtual_nodes", "64"
+            )
+            assert (
+                virtual_nodes.isdigit() and int(virtual_nodes) > 0
+            ), f"tornado_user_sharding_virtual_nodes ({virtual_nodes}) must be a positive integer"
+            data["user_sharding"] = {
+                "algorithm": "consistent_hash",
+                "virtual_nodes": int(virtual_nodes),
+            }
         sharding_json_f.write(json.dumps(data) + "\n")
 
 
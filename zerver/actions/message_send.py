@@ -22,7 +22,7 @@ import orjson
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError, transaction
-from django.db.models import F
+from django.db.models import F, QuerySet
 from django.utils.html import escape
 from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
@@ -32,7 +32,16 @@ from django_stubs_ext import ValuesQuerySet
 from zerver.actions.uploads import do_claim_attachments
 from zerver.lib.addressee import Addressee
 from zerver.lib.alert_words import get_alert_word_automaton
-from zerver.lib.cache import cache_with_key, user_profile_delivery_email_cache_key
+from zerver.lib.cache import (
+    cache_get_many,
+    cache_set_many,
+    cache_with_key,
+    get_cache_generations,
+    stream_recipient_info_cache_key,
+    stream_recipient_info_generation_cache_key,
+    stream_topic_visibility_policies_cache_key,
+    user_profile_delivery_email_cache_key,
+)
 from zerver.lib.create_user import create_user
 from zerver.lib.exceptions import (
     JsonableError,
@@ -61,6 +70,7 @@ from zerver.lib.notification_data import (
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.recipient_users import recipient_for_user_profiles
 from zerver.lib.stream_subscription import (
+    get_active_subscriptions_for_stream_id,
     get_subscriptions_for_send_message,
     num_subscribers_for_stream_id,
 )
@@ -79,6 +89,7 @@ from zerver.models import (
     Realm,
     Recipient,
     Stream,
+    Subscription,
     UserMessage,
     UserPresence,
     UserProfile,
@@ -92,7 +103,7 @@ from zerver.models import (
     is_cross_realm_bot_email,
     query_for_ids,
 )
-from zerver.tornado.django_api import send_event
+from zerver.tornado.django_api import batch_send_events, send_event
 
 
 def compute_irc_user_fullname(email: str) -> str:
@@ -184,6 +195,136 @@ class ActiveUserDict(TypedDict):
     bot_type: Optional[int]
 
 
+def fetch_subscription_rows(query: QuerySet[Subscription]) -> List[Dict[str, Any]]:
+    """Returns one row per subscription, ordered by user ID, with the
+    subscription's notification settings, the user's defaults for
+    them, and the user's ActiveUserDict."""
+    query = query.annotate(
+        user_profile_email_notifications=F("user_profile__enable_stream_email_notifications"),
+        user_profile_push_notifications=F("user_profile__enable_stream_push_notifications"),
+        user_profile_wildcard_mentions_notify=F("user_profile__wildcard_mentions_notify"),
+        enable_online_push_notifications=F("user_profile__enable_online_push_notifications"),
+        enable_offline_email_notifications=F("user_profile__enable_offline_email_notifications"),
+        enable_offline_push_notifications=F("user_profile__enable_offline_push_notifications"),
+        is_bot=F("user_profile__is_bot"),
+        bot_type=F("user_profile__bot_type"),
+        long_term_idle=F("user_profile__long_term_idle"),
+    )
+
+    subscription_rows: List[Dict[str, Any]] = []
+    for row in query.values(
+        "user_profile_id",
+        "push_notifications",
+        "email_notifications",
+        "wildcard_mentions_notify",
+        "user_profile_email_notifications",
+        "user_profile_push_notifications",
+        "user_profile_wildcard_mentions_notify",
+        "is_muted",
+        "enable_online_push_notifications",
+        "enable_offline_email_notifications",
+        "enable_offline_push_notifications",
+        "is_bot",
+        "bot_type",
+        "long_term_idle",
+    ).order_by("user_profile_id"):
+        user: ActiveUserDict = {
+            "id": row["user_profile_id"],
+            "enable_online_push_notifications": row["enable_online_push_notifications"],
+            "enable_offline_email_notifications": row["enable_offline_email_notifications"],
+            "enable_offline_push_notifications": row["enable_offline_push_notifications"],
+            "is_bot": row["is_bot"],
+            "bot_type": row["bot_type"],
+            "long_term_idle": row["long_term_idle"],
+        }
+        subscription_rows.append(
+            {
+                "user_profile_id": row["user_profile_id"],
+                "push_notifications": row["push_notifications"],
+                "email_notifications": row["email_notifications"],
+                "wildcard_mentions_notify": row["wildcard_mentions_notify"],
+                "user_profile_email_notifications": row["user_profile_email_notifications"],
+                "user_profile_push_notifications": row["user_profile_push_notifications"],
+                "user_profile_wildcard_mentions_notify": row[
+                    "user_profile_wildcard_mentions_notify"
+                ],
+                "is_muted": row["is_muted"],
+                "user": user,
+            }
+        )
+    return subscription_rows
+
+
+def get_stream_subscription_rows(
+    realm_id: int,
+    stream_topic: StreamTopicTarget,
+    possible_wildcard_mention: bool,
+    possibly_mentioned_user_ids: AbstractSet[int],
+) -> Tuple[List[Dict[str, Any]], Dict[int, int]]:
+    """Returns the subscription rows get_recipient_info needs for a
+    message to the stream, and the topic's visibility policies.
+
+    The rows of get_subscriptions_for_send_message, without any
+    possibly mentioned users, are the same for every message, so we
+    cache them per stream, and separately the rows of all subscribers,
+    for messages with a possible wildcard mention.  These are cached
+    under keys containing the stream's generation number, which is
+    changed to invalidate them; see stream_recipient_info_cache_key."""
+    stream_id = stream_topic.stream_id
+    generation_key = stream_recipient_info_generation_cache_key(stream_id)
+    generation = get_cache_generations([generation_key])[generation_key]
+
+    rows_key = stream_recipient_info_cache_key(stream_id, generation, possible_wildcard_mention)
+    topic_key = stream_topic_visibility_policies_cache_key(
+        stream_id, generation, stream_topic.topic_name
+    )
+    cached = cache_get_many([rows_key, topic_key])
+    to_cache: Dict[str, Any] = {}
+
+    if rows_key in cached:
+        subscription_rows = cached[rows_key]
+    else:
+        subscription_rows = to_cache[rows_key] = fetch_subscription_rows(
+            get_subscriptions_for_send_message(
+                realm_id=realm_id,
+                stream_id=stream_id,
+                possible_wildcard_mention=possible_wildcard_mention,
+                possibly_mentioned_user_ids=set(),
+            )
+        )
+    if topic_key in cached:
+        user_id_to_visibility_policy = cached[topic_key]
+    else:
+        user_id_to_visibility_policy = to_cache[
+            topic_key
+        ] = stream_topic.user_id_to_visibility_policy_dict()
+
+    if to_cache:
+        cache_set_many(to_cache, timeout=3600 * 24)
+
+    if possible_wildcard_mention:
+        return subscription_rows, user_id_to_visibility_policy
+
+    # Long-term idle subscribers who may be mentioned are not in the
+    # cached rows, since they depend on the message.
+    missing_user_ids = possibly_mentioned_user_ids - {
+        row["user_profile_id"] for row in subscription_rows
+    }
+    if missing_user_ids:
+        subscription_rows = sorted(
+            [
+                *subscription_rows,
+                *fetch_subscription_rows(
+                    get_active_subscriptions_for_stream_id(
+                        stream_id, include_deactivated_users=False
+                    ).filter(user_profile_id__in=missing_user_ids)
+                ),
+            ],
+            key=lambda row: row["user_profile_id"],
+        )
+    return subscription_rows, user_id_to_visibility_policy
+
+
 def get_recipient_info(
     *,
     realm_id: int,
@@ -197,6 +338,8 @@ def get_recipient_info(
     stream_email_user_ids: Set[int] = set()
     wildcard_mention_user_ids: Set[int] = set()
     muted_sender_user_ids: Set[int] = get_muting_users(sender_id)
+    # ActiveUserDicts for recipients, where we already have them.
+    rows: List[ActiveUserDict] = []
 
     if recipient.type == Recipient.PERSONAL:
         # The sender and recipient may be the same id, so
@@ -210,35 +353,11 @@ def get_recipient_info(
         # of this function for different message types.
         assert stream_topic is not None
 
-        subscription_rows = (
-            get_subscriptions_for_send_message(
-                realm_id=realm_id,
-                stream_id=stream_topic.stream_id,
-                possible_wildcard_mention=possible_wildcard_mention,
-                possibly_mentioned_user_ids=possibly_mentioned_user_ids,
-            )
-            .annotate(
-                user_profile_email_notifications=F(
-                    "user_profile__enable_stream_email_notifications"
-                ),
-                user_profile_push_notifications=F("user_profile__enable_stream_push_notifications"),
-                user_profile_wildcard_mentions_notify=F("user_profile__wildcard_mentions_notify"),
-            )
-            .values(
-                "user_profile_id",
-                "push_notifications",
-                "email_notifications",
-                "wildcard_mentions_notify",
-                "user_profile_email_notifications",
-                "user_profile_push_notifications",
-                "user_profile_wildcard_mentions_notify",
-                "is_muted",
-            )
-            .order_by("user_profile_id")
+        subscription_rows, user_id_to_visibility_policy = get_stream_subscription_rows(
+            realm_id, stream_topic, possible_wildcard_mention, possibly_mentioned_user_ids
         )
-
         message_to_user_ids = [row["user_profile_id"] for row in subscription_rows]
-        user_id_to_visibility_policy = stream_topic.user_id_to_visibility_policy_dict()
+        rows = [row["user"] for row in subscription_rows]
 
         def notification_recipients(setting: str) -> Set[int]:
             return {
@@ -281,6 +400,8 @@ def get_recipient_info(
     # escaped).  `get_ids_for` will filter these extra user rows
     # for our data structures not related to bots
     user_ids |= possibly_mentioned_user_ids
+    # We only need to query users we don't already have rows for.
+    user_ids -= {row["id"] for row in rows}
 
     if user_ids:
         query: ValuesQuerySet[UserProfile, ActiveUserDict] = UserProfile.objects.filter(
@@ -302,23 +423,21 @@ def get_recipient_info(
             user_ids=sorted(user_ids),
             field="id",
         )
-        rows = list(query)
-    else:
-        # TODO: We should always have at least one user_id as a recipient
-        #       of any message we send.  Right now the exception to this
-        #       rule is `notify_new_user`, which, at least in a possibly
-        #       contrived test scenario, can attempt to send messages
-        #       to an inactive bot.  When we plug that hole, we can avoid
-        #       this `else` clause and just `assert(user_ids)`.
-        #
-        # UPDATE: It's February 2020 (and a couple years after the above
-        #         comment was written).  We have simplified notify_new_user
-        #         so that it should be a little easier to reason about.
-        #         There is currently some cleanup to how we handle cross
-        #         realm bots that is still under development.  Once that
-        #         effort is complete, we should be able to address this
-        #         to-do.
-        rows = []
+        rows += list(query)
+    # TODO: We should always have at least one user_id as a recipient
+    #       of any message we send.  Right now the exception to this
+    #       rule is `notify_new_user`, which, at least in a possibly
+    #       contrived test scenario, can attempt to send messages
+    #       to an inactive bot.  When we plug that hole, we can
+    #       just `assert(rows)`.
+    #
+    # UPDATE: It's February 2020 (and a couple years after the above
+    #         comment was written).  We have simplified notify_new_user
+    #         so that it should be a little easier to reason about.
+    #         There is currently some cleanup to how we handle cross
+    #         realm bots that is still under development.  Once that
+    #         effort is complete, we should be able to address this
+    #         to-do.
 
     def get_ids_for(f: Callable[[ActiveUserDict], bool]) -> Set[int]:
         """Only includes users on the explicit message to line"""
@@ -622,29 +741,43 @@ def create_user_messages(
     #
     # See https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
     # for details on this system.
-    user_messages = []
-    for user_profile_id in um_eligible_user_ids:
+    #
+    # Messages to large streams are common, and nearly all recipients
+    # get just base_flags, so we compute the (few) users who get
+    # additional flags with set operations, and only examine those
+    # users individually.
+    read_user_ids = mark_as_read_user_ids & um_eligible_user_ids
+    if message.sent_by_human() and sender_id in um_eligible_user_ids:
+        read_user_ids.add(sender_id)
+    if limit_unread_user_ids is not None:
+        read_user_ids |= um_eligible_user_ids - limit_unread_user_ids
+    mentioned_eligible_user_ids = um_eligible_user_ids & mentioned_user_ids
+    alert_word_eligible_user_ids = um_eligible_user_ids & ids_with_alert_words
+
+    flagged_user_ids = read_user_ids | mentioned_eligible_user_ids | alert_word_eligible_user_ids
+    base_flags_user_ids = um_eligible_user_ids - flagged_user_ids
+    if is_stream_message and int(base_flags) == 0:
+        base_flags_user_ids -= (
+            long_term_idle_user_ids - stream_push_user_ids - stream_email_user_ids
+        )
+
+    user_messages = [
+        UserMessageLite(
+            user_profile_id=user_profile_id,
+            message_id=message.id,
+            flags=base_flags,
+        )
+        for user_profile_id in sorted(base_flags_user_ids)
+    ]
+    for user_profile_id in sorted(flagged_user_ids):
         flags = base_flags
-        if (
-            (user_profile_id == sender_id and message.sent_by_human())
-            or user_profile_id in mark_as_read_user_ids
-            or (limit_unread_user_ids is not None and user_profile_id not in limit_unread_user_ids)
-        ):
+        if user_profile_id in read_user_ids:
             flags |= UserMessage.flags.read
-        if user_profile_id in mentioned_user_ids:
+        if user_profile_id in mentioned_eligible_user_ids:
             flags |= UserMessage.flags.mentioned
-        if user_profile_id in ids_with_alert_words:
+        if user_profile_id in alert_word_eligible_user_ids:
             flags |= UserMessage.flags.has_alert_word
 
-        if (
-            user_profile_id in long_term_idle_user_ids
-            and user_profile_id not in stream_push_user_ids
-            and user_profile_id not in stream_email_user_ids
-            and is_stream_message
-            and int(flags) == 0
-        ):
-            continue
-
         um = UserMessageLite(
             user_profile_id=user_profile_id,
             message_id=message.id,
@@ -755,8 +888,15 @@ def do_send_messages(
                 limit_unread_user_ids=send_request.limit_unread_user_ids,
             )
 
+            # Most rows share a handful of flags values, so we only
+            # convert each distinct value to a list once.
+            flags_lists: Dict[int, List[str]] = {}
+            message_flags = user_message_flags[send_request.message.id]
             for um in user_messages:
-                user_message_flags[send_request.message.id][um.user_profile_id] = um.flags_list()
+                flags = int(um.flags)
+                if flags not in flags_lists:
+                    flags_lists[flags] = um.flags_list()
+                message_flags[um.user_profile_id] = flags_lists[flags]
 
             ums.extend(user_messages)
 
@@ -780,7 +920,7 @@ def do_send_messages(
     # * Updating the `first_message_id` field for streams without any message history.
     # * Implementing the Welcome Bot reply hack
     # * Adding links to the embed_links queue for open graph processing.
-    for send_request in send_message_requests:
+    def send_message_events(send_request: SendMessageRequest) -> None:
         realm_id: Optional[int] = None
         if send_request.message.is_stream_message():
             if send_request.stream is None:
@@ -936,6 +1076,16 @@ def do_send_messages(
                     },
                 )
 
+    # When sending several messages, their events are batched, so that
+    # each Tornado port gets a single notice batch for the whole send.
+    if len(send_message_requests) > 1:
+        with batch_send_events():
+            for send_request in send_message_requests:
+                send_message_events(send_request)
+    else:
+        for send_request in send_message_requests:
+            send_message_events(send_request)
+
     return [send_request.message.id for send_request in send_message_requests]
 
 
@@ -1118,6 +1268,40 @@ def check_send_message(
     return do_send_messages([message])[0]
 
 
+@dataclass
+class OutgoingMessage:
+    addressee: Addressee
+    content: str
+    local_id: Optional[str] = None
+    sender_queue_id: Optional[str] = None
+
+
+def check_send_messages(
+    sender: UserProfile,
+    client: Client,
+    outgoing_messages: Sequence[OutgoingMessage],
+) -> List[int]:
+    """Validates and renders every message before sending any of them,
+    so that an invalid message fails the whole batch, and then sends
+    them all with a single do_send_messages call: one transaction for
+    the Message and UserMessage rows, and one batch of notices per
+    Tornado port.  Returns the message IDs, in order."""
+    mention_backend = MentionBackend(sender.realm_id)
+    send_message_requests = [
+        check_message(
+            sender,
+            client,
+            outgoing_message.addressee,
+            outgoing_message.content,
+            local_id=outgoing_message.local_id,
+            sender_queue_id=outgoing_message.sender_queue_id,
+            mention_backend=mention_backend,
+        )
+        for outgoing_message in outgoing_messages
+    ]
+    return do_send_messages(send_message_requests)
+
+
 def send_rate_limited_pm_notification_to_bot_owner(
     sender: UserProfile, realm: Realm, content: str
 ) -> None:
@@ -1,10 +1,15 @@
 import datetime
 import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
 
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
+from psycopg2.extras import execute_values
+from psycopg2.sql import SQL
 
 from zerver.actions.user_activity import update_user_activity_interval
+from zerver.lib.cache import bulk_cached_fetch, user_profile_by_id_cache_key
 from zerver.lib.presence import (
     format_legacy_presence_dict,
     user_presence_datetime_with_date_joined_default,
@@ -12,7 +17,7 @@ from zerver.lib.presence import (
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.models import Client, UserPresence, UserProfile, active_user_ids, get_client
-from zerver.tornado.django_api import send_event
+from zerver.tornado.django_api import batch_send_events, send_event
 
 
 def send_presence_changed(
@@ -79,47 +84,46 @@ def consolidate_client(client: Client) -> Client:
         return client
 
 
-def do_update_user_presence(
-    user_profile: UserProfile,
-    client: Client,
+def apply_presence_ping(
+    presence: UserPresence,
     log_time: datetime.datetime,
-    status: int,
-    *,
-    force_send_update: bool = False,
-) -> None:
-    client = consolidate_client(client)
+    active_time: Optional[datetime.datetime],
+) -> Tuple[List[str], bool]:
+    """Updates an existing UserPresence row, in memory, for the user's
+    clients having been connected as of log_time, and active as of
+    active_time, if any.  Returns the fields which need to be saved,
+    and whether the user just came back online."""
+    if presence.last_connected_time is not None:
+        time_since_last_connected = log_time - presence.last_connected_time
+    else:
+        # The user was never connected, so let's consider this large
+        # to go over any thresholds we may have.
+        time_since_last_connected = datetime.timedelta(days=1)
 
-    # If the user doesn't have a UserPresence row yet, we create one with
-    # sensible defaults. If we're getting a presence update, clearly the user
-    # at least connected, so last_connected_time should be set. last_active_time
-    # will depend on whether the status sent is idle or active.
-    defaults = dict(
-        last_active_time=None,
-        last_connected_time=log_time,
-        realm_id=user_profile.realm_id,
-    )
-    if status == UserPresence.LEGACY_STATUS_ACTIVE_INT:
-        defaults["last_active_time"] = log_time
+    update_fields = []
+    became_online = False
 
-    (presence, created) = UserPresence.objects.get_or_create(
-        user_profile=user_profile,
-        defaults=defaults,
-    )
+    # This check is to prevent updating `last_connected_time` several
+    # times per minute with multiple connected browser windows.
+    # We also need to be careful not to wrongly "update" the timestamp if we actually already
+    # have newer presence than the reported log_time.
+    if time_since_last_connected > datetime.timedelta(
+        seconds=settings.PRESENCE_UPDATE_MIN_FREQ_SECONDS
+    ):
+        presence.last_connected_time = log_time
+        update_fields.append("last_connected_time")
+
+    if active_time is None:
+        return update_fields, became_online
 
     if presence.last_active_time is not None:
-        time_since_last_active = log_time - presence.last_active_time
-    else:
-        # The user was never active, so let's consider this large to go over any thresholds
-        # we may have.
-        time_since_last_active = datetime.timedelta(days=1)
-    if presence.last_connected_time is not None:
-        time_since_last_connected = log_time - presence.last_connected_time
+        time_since_last_active = active_time - presence.last_active_time
     else:
         # Same approach as above.
-        time_since_last_connected = datetime.timedelta(days=1)
+        time_since_last_active = datetime.timedelta(days=1)
 
     assert (3 * settings.PRESENCE_PING_INTERVAL_SECS + 20) <= settings.OFFLINE_THRESHOLD_SECS
-    now_online = time_since_last_active > datetime.timedelta(
+    became_online = time_since_last_active > datetime.timedelta(
         # Here, we decide whether the user is newly online, and we need to consider
         # sending an immediate presence update via the events system that this user is now online,
         # rather than waiting for other clients to poll the presence update.
@@ -133,47 +137,191 @@ def do_update_user_presence(
         - settings.PRESENCE_PING_INTERVAL_SECS
         - 10
     )
-    became_online = status == UserPresence.LEGACY_STATUS_ACTIVE_INT and now_online
 
-    update_fields = []
-
-    # This check is to prevent updating `last_connected_time` several
-    # times per minute with multiple connected browser windows.
-    # We also need to be careful not to wrongly "update" the timestamp if we actually already
-    # have newer presence than the reported log_time.
-    if not created and time_since_last_connected > datetime.timedelta(
+    if time_since_last_active > datetime.timedelta(
         seconds=settings.PRESENCE_UPDATE_MIN_FREQ_SECONDS
     ):
-        presence.last_connected_time = log_time
-        update_fields.append("last_connected_time")
-    if (
-        not created
-        and status == UserPresence.LEGACY_STATUS_ACTIVE_INT
-        and time_since_last_active
-        > datetime.timedelta(seconds=settings.PRESENCE_UPDATE_MIN_FREQ_SECONDS)
-    ):
-        presence.last_active_time = log_time
+        presence.last_active_time = active_time
         update_fields.append("last_active_time")
-        if presence.last_connected_time is None or log_time > presence.last_connected_time:
+        if presence.last_connected_time is None or active_time > presence.last_connected_time:
             # Update last_connected_time as well to ensure
             # last_connected_time >= last_active_time.
-            presence.last_connected_time = log_time
+            presence.last_connected_time = active_time
             update_fields.append("last_connected_time")
-    if len(update_fields) > 0:
-        presence.save(update_fields=update_fields)
+    return update_fields, became_online
+
+
+def allocate_presence_update_ids(realm_counts: Dict[int, int]) -> Dict[int, int]:
+    """Allocates the given number of consecutive presence update ids
+    in each realm, returning the first of them.  Each realm's
+    PresenceSequence row stays locked until the transaction commits;
+    see its docstring."""
+    # Lock the rows in a consistent order, to avoid deadlocks.
+    rows = sorted(realm_counts.items())
+    query = SQL(
+        """
+        INSERT INTO zerver_presencesequence (realm_id, last_update_id)
+        VALUES %s
+        ON CONFLICT (realm_id) DO UPDATE SET
+            last_update_id = zerver_presencesequence.last_update_id + EXCLUDED.last_update_id
+        RETURNING realm_id, last_update_id
+        """
+    )
+    with connection.cursor() as cursor:
+        results = execute_values(cursor.cursor, query, rows, page_size=len(rows), fetch=True)
+    return {
+        realm_id: last_update_id - realm_counts[realm_id] + 1
+        for realm_id, last_update_id in results
+    }
+
+
+def write_user_presences(
+    pings: List[Tuple[UserProfile, datetime.datetime, Optional[datetime.datetime]]],
+    *,
+    force_send_update: bool = False,
+) -> None:
+    """Records that each user's clients were connected as of the
+    first time, and active as of the second, if any, and sends
+    presence events for those who came online.  Each user may only
+    appear once.
+
+    The UserPresence rows are written in a single query, and the
+    presence events are sent to Tornado in one batch per Tornado
+    process."""
+    changed_presences: List[Tuple[UserProfile, UserPresence]] = []
+    with transaction.atomic(savepoint=False):
+        # Lock the rows in a consistent order, to avoid deadlocks.
+        presences = {
+            presence.user_profile_id: presence
+            for presence in UserPresence.objects.select_for_update()
+            .filter(user_profile_id__in=[user_profile.id for user_profile, _, _ in pings])
+            .order_by("user_profile_id")
+        }
+
+        updated_presences: List[Tuple[UserProfile, UserPresence]] = []
+        for user_profile, log_time, active_time in sorted(pings, key=lambda ping: ping[0].id):
+            presence = presences.get(user_profile.id)
+            if presence is None:
+                # If the user doesn't have a UserPresence row yet, we create one with
+                # sensible defaults. If we're getting a presence update, clearly the user
+                # at least connected, so last_connected_time should be set. last_active_time
+                # will depend on whether the status sent is idle or active.
+                created = True
+                updated = True
+                became_online = False
+                presence = UserPresence(
+                    user_profile=user_profile,
+                    realm_id=user_profile.realm_id,
+                    last_active_time=active_time,
+                    last_connected_time=log_time,
+                )
+            else:
+                created = False
+                update_fields, became_online = apply_presence_ping(presence, log_time, active_time)
+                updated = len(update_fields) > 0
+
+            # A forced update, like disabling presence_enabled, gets a
+            # new update ID even if it doesn't change the times, so that
+            # clients polling for changes see it.
+            if updated or force_send_update:
+                updated_presences.append((user_profile, presence))
+            if force_send_update or (
+                not user_profile.realm.presence_disabled and (created or became_online)
+            ):
+                changed_presences.append((user_profile, presence))
+
+        if updated_presences:
+            next_update_ids = allocate_presence_update_ids(
+                Counter(user_profile.realm_id for user_profile, _ in updated_presences)
+            )
+            rows = []
+            for user_profile, presence in updated_presences:
+                presence.last_update_id = next_update_ids[user_profile.realm_id]
+                next_update_ids[user_profile.realm_id] += 1
+                rows.append(
+                    (
+                        user_profile.id,
+                        user_profile.realm_id,
+                        presence.last_connected_time,
+                        presence.last_active_time,
+                        presence.last_update_id,
+                    )
+                )
+
+            # Rows created by a concurrent request since we read them
+            # were not locked; GREATEST keeps whichever times are newer.
+            query = SQL(
+                """
+                INSERT INTO zerver_userpresence (user_profile_id, realm_id, last_connected_time, last_active_time, last_update_id)
+                VALUES %s
+                ON CONFLICT (user_profile_id) DO UPDATE SET
+                    last_connected_time = GREATEST(zerver_userpresence.last_connected_time, EXCLUDED.last_connected_time),
+                    last_active_time = GREATEST(zerver_userpresence.last_active_time, EXCLUDED.last_active_time),
+                    last_update_id = EXCLUDED.last_update_id
+                """
+            )
+            with connection.cursor() as cursor:
+                execute_values(cursor.cursor, query, rows, page_size=len(rows))
+
+        def send_presences_changed() -> None:
+            with batch_send_events():
+                for user_profile, presence in changed_presences:
+                    send_presence_changed(
+                        user_profile, presence, force_send_update=force_send_update
+                    )
 
-    if force_send_update or (
-        not user_profile.realm.presence_disabled and (created or became_online)
-    ):
         # We do a the transaction.on_commit here, rather than inside
         # send_presence_changed, to help keep presence transactions
         # brief; the active_user_ids call there is more expensive than
         # this whole function.
-        transaction.on_commit(
-            lambda: send_presence_changed(
-                user_profile, presence, force_send_update=force_send_update
-            )
-        )
+        if changed_presences:
+            transaction.on_commit(send_presences_changed)
+
+
+def do_update_user_presence(
+    user_profile: UserProfile,
+    client: Client,
+    log_time: datetime.datetime,
+    status: int,
+    *,
+    force_send_update: bool = False,
+) -> None:
+    client = consolidate_client(client)
+
+    active_time = log_time if status == UserPresence.LEGACY_STATUS_ACTIVE_INT else None
+    write_user_presences(
+        [(user_profile, log_time, active_time)], force_send_update=force_send_update
+    )
+
+
+def do_update_user_presences(
+    pings: Dict[int, Tuple[datetime.datetime, Optional[datetime.datetime]]]
+) -> None:
+    """Bulk version of do_update_user_presence, for the presence queue
+    worker.  Each user's pings must already be coalesced into the
+    time of their latest ping, and of their latest ping reporting
+    them as active, if any; since each ping only moves the presence
+    times forward, this is equivalent to processing the pings in
+    order, except that throttled pings may still advance the times."""
+    if not pings:
+        return
+
+    user_profiles: Dict[int, UserProfile] = bulk_cached_fetch(
+        cache_key_function=user_profile_by_id_cache_key,
+        query_function=lambda user_ids: list(
+            UserProfile.objects.filter(id__in=user_ids).select_related()
+        ),
+        object_ids=list(pings),
+        id_fetcher=lambda user_profile: user_profile.id,
+    )
+    # Users deleted since they pinged are skipped.
+    write_user_presences(
+        [
+            (user_profiles[user_profile_id], log_time, active_time)
+            for user_profile_id, (log_time, active_time) in pings.items()
+            if user_profile_id in user_profiles
+        ]
+    )
 
 
 def update_user_presence(
@@ -21,6 +21,7 @@ from zerver.lib.cache import (
     cache_delete_many,
     cache_set,
     display_recipient_cache_key,
+    flush_stream_recipient_info,
     get_stream_cache_key,
     to_dict_cache_key_id,
 )
@@ -63,7 +64,7 @@ from zerver.models import (
     active_non_guest_user_ids,
     get_system_bot,
 )
-from zerver.tornado.django_api import send_event
+from zerver.tornado.django_api import batch_send_events, send_event
 
 
 @transaction.atomic(savepoint=False)
@@ -87,6 +88,7 @@ def do_deactivate_stream(
     get_active_subscriptions_for_stream_id(stream.id, include_deactivated_users=True).update(
         active=False
     )
+    flush_stream_recipient_info([stream.id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -314,6 +316,7 @@ def bulk_add_subs_to_db_with_logging(
     Subscription.objects.bulk_create(info.sub for info in subs_to_add)
     sub_ids = [info.sub.id for info in subs_to_activate]
     Subscription.objects.filter(id__in=sub_ids).update(active=True)
+    flush_stream_recipient_info({info.stream.id for info in [*subs_to_add, *subs_to_activate]})
 
     # Log subscription activities in RealmAuditLog
     event_time = timezone_now()
@@ -383,6 +386,8 @@ def send_peer_subscriber_events(
 
     assert op in ["peer_add", "peer_remove"]
 
+    peer_events: List[Tuple[Dict[str, object], Set[int]]] = []
+
     private_stream_ids = [
         stream_id for stream_id in altered_user_dict if stream_dict[stream_id].invite_only
     ]
@@ -398,11 +403,7 @@ def send_peer_subscriber_events(
                 stream_ids=[stream_id],
                 user_ids=sorted(altered_user_ids),
             )
-            transaction.on_commit(
-                lambda event=event, peer_user_ids=peer_user_ids: send_event(
-                    realm, event, peer_user_ids
-                )
-            )
+            peer_events.append((event, peer_user_ids))
 
     public_stream_ids = [
         stream_id
@@ -440,11 +441,7 @@ def send_peer_subscriber_events(
                         stream_ids=[stream_id],
                         user_ids=sorted(altered_user_ids),
                     )
-                    transaction.on_commit(
-                        lambda event=event, peer_user_ids=peer_user_ids: send_event(
-                            realm, event, peer_user_ids
-                        )
-                    )
+                    peer_events.append((event, peer_user_ids))
 
         for user_id, stream_ids in user_streams.items():
             peer_user_ids = public_peer_ids - {user_id}
@@ -454,16 +451,25 @@ def send_peer_subscriber_events(
                 stream_ids=sorted(stream_ids),
                 user_ids=[user_id],
             )
-            transaction.on_commit(
-                lambda event=event, peer_user_ids=peer_user_ids: send_event(
-                    realm, event, peer_user_ids
-                )
-            )
+            peer_events.append((event, peer_user_ids))
+
+    def send_peer_events() -> None:
+        # Callers commonly hold their own transaction open around
+        # bulk_add_subscriptions and bulk_remove_subscriptions, so
+        # these are sent after those functions' batch_send_events
+        # blocks have exited; batch them here instead.
+        with batch_send_events():
+            for event, peer_user_ids in peer_events:
+                send_event(realm, event, peer_user_ids)
+
+    if peer_events:
+        transaction.on_commit(send_peer_events)
 
 
 SubT = Tuple[List[SubInfo], List[SubInfo]]
 
 
+@batch_send_events()
 def bulk_add_subscriptions(
     realm: Realm,
     streams: Collection[Stream],
@@ -662,6 +668,7 @@ def send_subscription_remove_events(
     )
 
 
+@batch_send_events()
 def bulk_remove_subscriptions(
     realm: Realm,
     users: Iterable[UserProfile],
@@ -719,6 +726,7 @@ def bulk_remove_subscriptions(
         Subscription.objects.filter(
             id__in=sub_ids_to_deactivate,
         ).update(active=False)
+        flush_stream_recipient_info({stream.id for stream in streams_to_unsubscribe})
         occupied_streams_after = list(get_occupied_streams(realm))
 
         # Log subscription activities in RealmAuditLog
@@ -1,8 +1,13 @@
 import datetime
+from typing import Dict, Tuple
+
+from django.db import connection
+from psycopg2.extras import execute_values
+from psycopg2.sql import SQL
 
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.timestamp import datetime_to_timestamp
-from zerver.models import UserActivity, UserActivityInterval, UserProfile
+from zerver.models import UserActivityInterval, UserProfile
 
 
 def do_update_user_activity_interval(
@@ -34,17 +39,30 @@ def do_update_user_activity_interval(
 def do_update_user_activity(
     user_profile_id: int, client_id: int, query: str, count: int, log_time: datetime.datetime
 ) -> None:
-    (activity, created) = UserActivity.objects.get_or_create(
-        user_profile_id=user_profile_id,
-        client_id=client_id,
-        query=query,
-        defaults={"last_visit": log_time, "count": count},
-    )
+    do_update_user_activities({(user_profile_id, client_id, query): (count, log_time)})
+
 
-    if not created:
-        activity.count += count
-        activity.last_visit = log_time
-        activity.save(update_fields=["last_visit", "count"])
+def do_update_user_activities(
+    activities: Dict[Tuple[int, int, str], Tuple[int, datetime.datetime]]
+) -> None:
+    """Adds the count of requests by each (user_profile_id, client_id,
+    query), and updates when it was last used, in a single query."""
+    if not activities:
+        return
+
+    # Lock the rows in a consistent order, to avoid deadlocks.
+    rows = [(*key, count, log_time) for key, (count, log_time) in sorted(activities.items())]
+    query = SQL(
+        """
+        INSERT INTO zerver_useractivity (user_profile_id, client_id, query, count, last_visit)
+        VALUES %s
+        ON CONFLICT (user_profile_id, client_id, query) DO UPDATE SET
+            count = zerver_useractivity.count + EXCLUDED.count,
+            last_visit = GREATEST(zerver_useractivity.last_visit, EXCLUDED.last_visit)
+        """
+    )
+    with connection.cursor() as cursor:
+        execute_values(cursor.cursor, query, rows, page_size=len(rows))
 
 
 def update_user_activity_interval(user_profile: UserProfile, log_time: datetime.datetime) -> None:
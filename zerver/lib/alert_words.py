@@ -1,12 +1,15 @@
-from typing import Dict, Iterable, List
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import ahocorasick
 from django.db import transaction
 
 from zerver.lib.cache import (
     cache_with_key,
-    realm_alert_words_automaton_cache_key,
+    flush_user_recipient_info,
+    get_cache_generations,
     realm_alert_words_cache_key,
+    realm_alert_words_version_cache_key,
 )
 from zerver.models import AlertWord, Realm, UserProfile, flush_realm_alert_words
 
@@ -23,8 +26,33 @@ def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
     return user_ids_with_words
 
 
-@cache_with_key(realm_alert_words_automaton_cache_key, timeout=3600 * 24)
-def get_alert_word_automaton(realm: Realm) -> ahocorasick.Automaton:
+# Compiled automatons are kept in the process, along with the version of
+# the realm's alert words they were built from, since fetching and
+# unpickling a large automaton from memcached for every message is
+# expensive.  The version is changed by flush_realm_alert_words.
+MAX_CACHED_ALERT_WORD_AUTOMATONS = 1000
+alert_word_automatons: "OrderedDict[int, Tuple[str, Optional[ahocorasick.Automaton]]]" = (
+    OrderedDict()
+)
+
+
+def get_alert_word_automaton(realm: Realm) -> Optional[ahocorasick.Automaton]:
+    version_key = realm_alert_words_version_cache_key(realm.id)
+    version = get_cache_generations([version_key])[version_key]
+    cached = alert_word_automatons.get(realm.id)
+    if cached is not None and cached[0] == version:
+        alert_word_automatons.move_to_end(realm.id)
+        return cached[1]
+
+    alert_word_automaton = build_alert_word_automaton(realm)
+    alert_word_automatons[realm.id] = (version, alert_word_automaton)
+    alert_word_automatons.move_to_end(realm.id)
+    if len(alert_word_automatons) > MAX_CACHED_ALERT_WORD_AUTOMATONS:
+        alert_word_automatons.popitem(last=False)
+    return alert_word_automaton
+
+
+def build_alert_word_automaton(realm: Realm) -> Optional[ahocorasick.Automaton]:
     user_id_with_words = alert_words_in_realm(realm)
     alert_word_automaton = ahocorasick.Automaton()
     for user_id, alert_words in user_id_with_words.items():
@@ -67,6 +95,7 @@ def add_user_alert_words(user_profile: UserProfile, new_words: Iterable[str]) ->
     )
     # Django bulk_create operations don't flush caches, so we need to do this ourselves.
     flush_realm_alert_words(user_profile.realm)
+    flush_user_recipient_info(user_profile.id)
 
     return user_alert_words(user_profile)
 
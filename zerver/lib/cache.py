@@ -2,22 +2,27 @@
 import hashlib
 import logging
 import os
+import pickle
 import re
 import secrets
 import sys
 import time
 import traceback
+from collections import Counter, OrderedDict, defaultdict
+from dataclasses import dataclass
 from functools import _lru_cache_wrapper, lru_cache, wraps
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
+    DefaultDict,
     Dict,
     Generic,
     Iterable,
     List,
     Optional,
     Sequence,
+    Set,
     Tuple,
     TypeVar,
 )
@@ -25,6 +30,7 @@ from typing import (
 from django.conf import settings
 from django.core.cache import caches
 from django.core.cache.backends.base import BaseCache
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpRequest
 from django_stubs_ext import QuerySetAny
@@ -35,7 +41,16 @@ from zerver.lib.utils import make_safe_digest
 if TYPE_CHECKING:
     # These modules have to be imported for type annotations but
     # they cannot be imported at runtime due to cyclic dependency.
-    from zerver.models import Attachment, Message, MutedUser, Realm, Stream, SubMessage, UserProfile
+    from zerver.models import (
+        Attachment,
+        Message,
+        MutedUser,
+        Realm,
+        Stream,
+        SubMessage,
+        Subscription,
+        UserProfile,
+    )
 
 MEMCACHED_MAX_KEY_LENGTH = 250
 
@@ -161,7 +176,7 @@ def cache_with_key(
                     stack_info=True,
                 )
             else:
-                cache_set(key, val, cache_name=cache_name, timeout=timeout)
+                cache_set(key, val, cache_name=cache_name, timeout=timeout, fill=True)
 
             return val
 
@@ -201,8 +216,15 @@ def validate_cache_key(key: str) -> None:
 
 
 def cache_set(
-    key: str, val: Any, cache_name: Optional[str] = None, timeout: Optional[int] = None
+    key: str,
+    val: Any,
+    cache_name: Optional[str] = None,
+    timeout: Optional[int] = None,
+    *,
+    fill: bool = False,
 ) -> None:
+    """Pass fill=True when filling a missing key from the database,
+    rather than changing its value; see the process-local cache below."""
     final_key = KEY_PREFIX + key
     validate_cache_key(final_key)
 
@@ -211,26 +233,57 @@ def cache_set(
     cache_backend.set(final_key, (val,), timeout=timeout)
     remote_cache_stats_finish()
 
+    if local_cache_active(cache_name):
+        local_cache_set(key, (val,))
+        if not fill:
+            publish_local_cache_invalidations([key])
+
 
 def cache_get(key: str, cache_name: Optional[str] = None) -> Any:
     final_key = KEY_PREFIX + key
     validate_cache_key(final_key)
 
+    use_local_cache = local_cache_active(cache_name)
+    if use_local_cache:
+        ret = local_cache_get(key)
+        if ret is not None:
+            return ret
+
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(final_key)
     remote_cache_stats_finish()
+
+    if use_local_cache and ret is not None:
+        local_cache_set(key, ret)
     return ret
 
 
 def cache_get_many(keys: List[str], cache_name: Optional[str] = None) -> Dict[str, Any]:
-    keys = [KEY_PREFIX + key for key in keys]
     for key in keys:
-        validate_cache_key(key)
+        validate_cache_key(KEY_PREFIX + key)
+
+    local_ret: Dict[str, Any] = {}
+    use_local_cache = local_cache_active(cache_name)
+    if use_local_cache:
+        for key in keys:
+            value = local_cache_get(key)
+            if value is not None:
+                local_ret[key] = value
+        if len(local_ret) == len(keys):
+            return local_ret
+        keys = [key for key in keys if key not in local_ret]
+
     remote_cache_stats_start()
-    ret = get_cache_backend(cache_name).get_many(keys)
+    ret = get_cache_backend(cache_name).get_many([KEY_PREFIX + key for key in keys])
     remote_cache_stats_finish()
-    return {key[len(KEY_PREFIX) :]: value for key, value in ret.items()}
+    remote_ret = {key[len(KEY_PREFIX) :]: value for key, value in ret.items()}
+
+    if use_local_cache:
+        for key, value in remote_ret.items():
+            local_cache_set(key, value)
+        remote_ret.update(local_ret)
+    return remote_ret
 
 
 def safe_cache_get_many(keys: List[str], cache_name: Optional[str] = None) -> Dict[str, Any]:
@@ -251,21 +304,34 @@ def safe_cache_get_many(keys: List[str], cache_name: Optional[str] = None) -> Di
 
 
 def cache_set_many(
-    items: Dict[str, Any], cache_name: Optional[str] = None, timeout: Optional[int] = None
+    items: Dict[str, Any],
+    cache_name: Optional[str] = None,
+    timeout: Optional[int] = None,
+    *,
+    fill: bool = False,
 ) -> None:
     new_items = {}
     for key in items:
         new_key = KEY_PREFIX + key
         validate_cache_key(new_key)
         new_items[new_key] = items[key]
-    items = new_items
     remote_cache_stats_start()
-    get_cache_backend(cache_name).set_many(items, timeout=timeout)
+    get_cache_backend(cache_name).set_many(new_items, timeout=timeout)
     remote_cache_stats_finish()
 
+    if local_cache_active(cache_name):
+        for key, value in items.items():
+            local_cache_set(key, value)
+        if not fill:
+            publish_local_cache_invalidations(list(items))
+
 
 def safe_cache_set_many(
-    items: Dict[str, Any], cache_name: Optional[str] = None, timeout: Optional[int] = None
+    items: Dict[str, Any],
+    cache_name: Optional[str] = None,
+    timeout: Optional[int] = None,
+    *,
+    fill: bool = False,
 ) -> None:
     """Variant of cache_set_many that drops saving any keys that fail
     validation, rather than throwing an exception visible to the
@@ -274,7 +340,7 @@ def safe_cache_set_many(
         # Almost always the keys will all be correct, so we just try
         # to do normal cache_set_many to avoid the overhead of
         # validating all the keys here.
-        return cache_set_many(items, cache_name, timeout)
+        return cache_set_many(items, cache_name, timeout, fill=fill)
     except InvalidCacheKeyError:
         stack_trace = traceback.format_exc()
 
@@ -282,7 +348,7 @@ def safe_cache_set_many(
         log_invalid_cache_keys(stack_trace, bad_keys)
 
         good_items = {key: items[key] for key in good_keys}
-        return cache_set_many(good_items, cache_name, timeout)
+        return cache_set_many(good_items, cache_name, timeout, fill=fill)
 
 
 def cache_delete(key: str, cache_name: Optional[str] = None) -> None:
@@ -293,8 +359,13 @@ def cache_delete(key: str, cache_name: Optional[str] = None) -> None:
     get_cache_backend(cache_name).delete(final_key)
     remote_cache_stats_finish()
 
+    if local_cache_active(cache_name):
+        local_cache_delete(key)
+        publish_local_cache_invalidations([key])
+
 
 def cache_delete_many(items: Iterable[str], cache_name: Optional[str] = None) -> None:
+    items = list(items)
     keys = [KEY_PREFIX + item for item in items]
     for key in keys:
         validate_cache_key(key)
@@ -302,6 +373,11 @@ def cache_delete_many(items: Iterable[str], cache_name: Optional[str] = None) ->
     get_cache_backend(cache_name).delete_many(keys)
     remote_cache_stats_finish()
 
+    if local_cache_active(cache_name):
+        for item in items:
+            local_cache_delete(item)
+        publish_local_cache_invalidations(items)
+
 
 def filter_good_and_bad_keys(keys: List[str]) -> Tuple[List[str], List[str]]:
     good_keys = []
@@ -316,6 +392,214 @@ def filter_good_and_bad_keys(keys: List[str]) -> Tuple[List[str], List[str]]:
     return good_keys, bad_keys
 
 
+# The process-local cache.  When settings.PROCESS_LOCAL_CACHE is
+# enabled, each process keeps the keys of a few families of hot, rarely
+# changing objects in a bounded LRU cache in front of memcached; the
+# family of a key is the part before its first ":".  Entries expire
+# after the family's TTL, and are pickled, so that callers can't mutate
+# an object shared with later requests.
+#
+# Every write or delete of such a key through the functions above also
+# drops the local copy, and is published to the other processes
+# through an invalidation log in memcached: a sequence number, and an
+# entry for each number listing the invalidated keys.  Writes which
+# only fill a missing key (fill=True), like those in cache_with_key
+# and generic_bulk_cached_fetch, are not published: other processes'
+# copies cannot be stale, since any change since they were cached was
+# itself published.  Each process
+# replays the log at the start of each request (and at least every
+# LOCAL_CACHE_SYNC_INTERVAL seconds); if it has fallen too far behind,
+# or an entry is missing, it clears its local cache instead.
+@dataclass(frozen=True)
+class LocalCachePolicy:
+    max_entries: int
+    ttl: float
+
+
+local_cache_policies: Dict[str, LocalCachePolicy] = {
+    "user_profile_by_id": LocalCachePolicy(max_entries=10000, ttl=300),
+    "display_recipient_dict": LocalCachePolicy(max_entries=10000, ttl=300),
+    "bulk_fetch_display_recipients": LocalCachePolicy(max_entries=10000, ttl=300),
+    "stream_by_realm_and_name": LocalCachePolicy(max_entries=5000, ttl=300),
+    # Per-realm data, which flush_realm invalidates; the user ID lists
+    # are also invalidated by flush_user_profile.
+    "active_user_ids": LocalCachePolicy(max_entries=1000, ttl=300),
+    "active_non_guest_user_ids": LocalCachePolicy(max_entries=1000, ttl=300),
+    "bot_dicts_in_realm": LocalCachePolicy(max_entries=1000, ttl=300),
+    "realm_rendered_description": LocalCachePolicy(max_entries=1000, ttl=300),
+    "realm_text_description": LocalCachePolicy(max_entries=1000, ttl=300),
+}
+
+LOCAL_CACHE_SYNC_INTERVAL = 1.0
+LOCAL_CACHE_MAX_REPLAYED_INVALIDATIONS = 1000
+LOCAL_CACHE_INVALIDATION_TIMEOUT = 3600
+LOCAL_CACHE_INVALIDATION_SEQUENCE_KEY = "local_cache_invalidation_sequence"
+
+# Maps each family to its entries, each a (expiry time, pickled value) pair.
+local_cache_entries: DefaultDict[str, "OrderedDict[str, Tuple[float, bytes]]"] = defaultdict(
+    OrderedDict
+)
+local_cache_stats: DefaultDict[str, "Counter[str]"] = defaultdict(Counter)
+local_cache_key_prefix = KEY_PREFIX
+# The last invalidation sequence number we have applied; None if we
+# have not synced yet, in which case the local cache is not used.
+local_cache_invalidation_sequence: Optional[int] = None
+local_cache_last_sync = 0.0
+
+
+def local_cache_invalidation_cache_key(sequence: int) -> str:
+    return f"local_cache_invalidation:{sequence}"
+
+
+def get_local_cache_policy(key: str) -> Optional[LocalCachePolicy]:
+    return local_cache_policies.get(key.split(":", 1)[0])
+
+
+def get_local_cache_stats() -> Dict[str, Dict[str, int]]:
+    """Returns the hits, misses and evictions of the local cache in
+    this process, by key family."""
+    return {family: dict(stats) for family, stats in local_cache_stats.items()}
+
+
+def clear_local_cache() -> None:
+    local_cache_entries.clear()
+
+
+def local_cache_active(cache_name: Optional[str]) -> bool:
+    global local_cache_key_prefix, local_cache_invalidation_sequence
+    if not settings.PROCESS_LOCAL_CACHE or cache_name is not None:
+        return False
+
+    if local_cache_key_prefix != KEY_PREFIX:
+        # KEY_PREFIX changes between tests.
+        clear_local_cache()
+        local_cache_key_prefix = KEY_PREFIX
+        local_cache_invalidation_sequence = None
+    if (
+        local_cache_invalidation_sequence is None
+        or time.monotonic() - local_cache_last_sync >= LOCAL_CACHE_SYNC_INTERVAL
+    ):
+        sync_local_cache()
+    return local_cache_invalidation_sequence is not None
+
+
+def local_cache_get(key: str) -> Any:
+    policy = get_local_cache_policy(key)
+    if policy is None:
+        return None
+
+    family = key.split(":", 1)[0]
+    entries = local_cache_entries[family]
+    entry = entries.get(key)
+    if entry is None or entry[0] < time.monotonic():
+        if entry is not None:
+            del entries[key]
+        local_cache_stats[family]["misses"] += 1
+        return None
+
+    entries.move_to_end(key)
+    local_cache_stats[family]["hits"] += 1
+    return pickle.loads(entry[1])  # noqa: S301
+
+
+def local_cache_set(key: str, val: Any) -> None:
+    policy = get_local_cache_policy(key)
+    if policy is None:
+        return
+
+    family = key.split(":", 1)[0]
+    entries = local_cache_entries[family]
+    entries[key] = (time.monotonic() + policy.ttl, pickle.dumps(val, protocol=4))
+    entries.move_to_end(key)
+    while len(entries) > policy.max_entries:
+        entries.popitem(last=False)
+        local_cache_stats[family]["evictions"] += 1
+
+
+def local_cache_delete(key: str) -> None:
+    if get_local_cache_policy(key) is not None:
+        local_cache_entries[key.split(":", 1)[0]].pop(key, None)
+
+
+def publish_local_cache_invalidations(keys: List[str]) -> None:
+    global local_cache_invalidation_sequence
+    keys = [key for key in keys if get_local_cache_policy(key) is not None]
+    if len(keys) == 0:
+        return
+
+    cache_backend = get_cache_backend(None)
+    remote_cache_stats_start()
+    try:
+        sequence = cache_backend.incr(KEY_PREFIX + LOCAL_CACHE_INVALIDATION_SEQUENCE_KEY)
+    except ValueError:
+        # The sequence number is missing, so every process will
+        # clear its local cache when it next syncs anyway.
+        remote_cache_stats_finish()
+        return
+    cache_backend.set(
+        KEY_PREFIX + local_cache_invalidation_cache_key(sequence),
+        keys,
+        timeout=LOCAL_CACHE_INVALIDATION_TIMEOUT,
+    )
+    remote_cache_stats_finish()
+
+    if local_cache_invalidation_sequence == sequence - 1:
+        # We've already applied our own invalidation.
+        local_cache_invalidation_sequence = sequence
+
+
+def sync_local_cache() -> None:
+    """Applies the invalidations published by other processes since
+    the last sync."""
+    global local_cache_invalidation_sequence, local_cache_last_sync
+    if not settings.PROCESS_LOCAL_CACHE:
+        return
+
+    cache_backend = get_cache_backend(None)
+    sequence_key = KEY_PREFIX + LOCAL_CACHE_INVALIDATION_SEQUENCE_KEY
+    remote_cache_stats_start()
+    sequence = cache_backend.get(sequence_key)
+    if sequence is None:
+        # The log has never been written to, or memcached was
+        # flushed.  We start it at a random number, so that a restarted
+        # log can't be mistaken for the one we were following.
+        cache_backend.add(sequence_key, secrets.randbelow(2**31), timeout=None)
+        sequence = cache_backend.get(sequence_key)
+    remote_cache_stats_finish()
+    local_cache_last_sync = time.monotonic()
+
+    last_sequence = local_cache_invalidation_sequence
+    local_cache_invalidation_sequence = sequence
+    if sequence is None:  # nocoverage
+        # memcached is unavailable; don't use the local cache.
+        clear_local_cache()
+        return
+    if (
+        last_sequence is None
+        or sequence < last_sequence
+        or sequence - last_sequence > LOCAL_CACHE_MAX_REPLAYED_INVALIDATIONS
+    ):
+        clear_local_cache()
+        return
+    if sequence == last_sequence:
+        return
+
+    invalidation_keys = [
+        KEY_PREFIX + local_cache_invalidation_cache_key(n)
+        for n in range(last_sequence + 1, sequence + 1)
+    ]
+    remote_cache_stats_start()
+    invalidations = cache_backend.get_many(invalidation_keys)
+    remote_cache_stats_finish()
+    if len(invalidations) < len(invalidation_keys):
+        # Either an entry expired, or it is still being written.
+        clear_local_cache()
+        return
+    for keys in invalidations.values():
+        for key in keys:
+            local_cache_delete(key)
+
+
 # Generic_bulk_cached fetch and its helpers.  We start with declaring
 # a few type variables that help define its interface.
 
@@ -389,7 +673,7 @@ def generic_bulk_cached_fetch(
         items_for_remote_cache[key] = (setter(item),)
         cached_objects[key] = item
     if len(items_for_remote_cache) > 0:
-        safe_cache_set_many(items_for_remote_cache)
+        safe_cache_set_many(items_for_remote_cache, fill=True)
     return {
         object_id: cached_objects[cache_keys[object_id]]
         for object_id in object_ids
@@ -494,6 +778,10 @@ def realm_user_dicts_cache_key(realm_id: int) -> str:
     return f"realm_user_dicts:{realm_id}"
 
 
+def realm_presence_snapshot_cache_key(realm_id: int) -> str:
+    return f"realm_presence_snapshot:{realm_id}"
+
+
 def get_muting_users_cache_key(muted_user_id: int) -> str:
     return f"muting_users_list:{muted_user_id}"
 
@@ -567,6 +855,88 @@ def delete_display_recipient_cache(user_profile: "UserProfile") -> None:
     cache_delete_many(keys)
 
 
+# The recipient info for stream messages (see get_recipient_info) is
+# cached per stream, under a key containing the stream's generation
+# number, which is changed when its subscriptions or topic visibility
+# policies change, or when a subscriber changes a setting it depends
+# on.  Changing a generation orphans all the entries built with the
+# old one, which then expire.
+def stream_recipient_info_generation_cache_key(stream_id: int) -> str:
+    return f"stream_recipient_info_generation:{stream_id}"
+
+
+def stream_recipient_info_cache_key(
+    stream_id: int, stream_generation: str, all_subscribers: bool
+) -> str:
+    return f"stream_recipient_info:{stream_id}:{stream_generation}:{int(all_subscribers)}"
+
+
+def stream_topic_visibility_policies_cache_key(
+    stream_id: int, stream_generation: str, topic_name: str
+) -> str:
+    return (
+        f"stream_topic_visibility_policies:{stream_id}:{stream_generation}"
+        f":{make_safe_digest(topic_name)}"
+    )
+
+
+def new_cache_generation() -> str:
+    return secrets.token_hex(8)
+
+
+def get_cache_generations(keys: List[str]) -> Dict[str, str]:
+    """Returns the current generation stored under each of the keys,
+    starting new generations for any which are missing."""
+    generations = cache_get_many(keys)
+    new_generations = {key: new_cache_generation() for key in keys if key not in generations}
+    if new_generations:
+        cache_set_many(new_generations)
+        generations.update(new_generations)
+    return generations
+
+
+def bump_cache_generations(keys: List[str]) -> None:
+    def bump() -> None:
+        cache_set_many({key: new_cache_generation() for key in keys})
+
+    # We bump the generations right away, for the rest of this
+    # transaction, and again once it commits, in case another process
+    # cached data from before the commit in the meantime.
+    bump()
+    transaction.on_commit(bump)
+
+
+def flush_stream_recipient_info(stream_ids: Iterable[int]) -> None:
+    keys = [stream_recipient_info_generation_cache_key(stream_id) for stream_id in stream_ids]
+    if keys:
+        bump_cache_generations(keys)
+
+
+def flush_user_recipient_info(user_profile_id: int) -> None:
+    """Invalidates the recipient info of the streams the user is
+    subscribed to, after a change which affects the user's rows."""
+    from zerver.models import Recipient, Subscription
+
+    stream_ids = Subscription.objects.filter(
+        user_profile_id=user_profile_id, active=True, recipient__type=Recipient.STREAM
+    ).values_list("recipient__type_id", flat=True)
+    flush_stream_recipient_info(list(stream_ids))
+
+
+# Fields of UserProfile which get_recipient_info depends on.
+recipient_info_user_fields: List[str] = [
+    "bot_type",
+    "enable_offline_email_notifications",
+    "enable_offline_push_notifications",
+    "enable_online_push_notifications",
+    "enable_stream_email_notifications",
+    "enable_stream_push_notifications",
+    "is_active",
+    "long_term_idle",
+    "wildcard_mentions_notify",
+]
+
+
 def changed(update_fields: Optional[Sequence[str]], fields: List[str]) -> bool:
     if update_fields is None:
         # adds/deletes should invalidate the cache
@@ -602,6 +972,10 @@ def flush_user_profile(
     if changed(update_fields, ["email", "full_name", "id", "is_mirror_dummy"]):
         delete_display_recipient_cache(user_profile)
 
+    # A new user has no subscriptions yet.
+    if not kwargs.get("created") and changed(update_fields, recipient_info_user_fields):
+        flush_user_recipient_info(user_profile.id)
+
     # Invalidate our bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
     if user_profile.is_bot and changed(update_fields, bot_dict_fields):
@@ -636,7 +1010,7 @@ def flush_realm(
         cache_delete(active_user_ids_cache_key(realm.id))
         cache_delete(bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
-        cache_delete(realm_alert_words_automaton_cache_key(realm))
+        flush_realm_alert_words_version(realm.id)
         cache_delete(active_non_guest_user_ids_cache_key(realm.id))
         cache_delete(realm_rendered_description_cache_key(realm))
         cache_delete(realm_text_description_cache_key(realm))
@@ -649,8 +1023,14 @@ def realm_alert_words_cache_key(realm: "Realm") -> str:
     return f"realm_alert_words:{realm.string_id}"
 
 
-def realm_alert_words_automaton_cache_key(realm: "Realm") -> str:
-    return f"realm_alert_words_automaton:{realm.string_id}"
+# The version of a realm's alert words, which is changed whenever they
+# may have changed; see get_alert_word_automaton.
+def realm_alert_words_version_cache_key(realm_id: int) -> str:
+    return f"realm_alert_words_version:{realm_id}"
+
+
+def flush_realm_alert_words_version(realm_id: int) -> None:
+    bump_cache_generations([realm_alert_words_version_cache_key(realm_id)])
 
 
 def realm_rendered_description_cache_key(realm: "Realm") -> str:
@@ -690,6 +1070,60 @@ def flush_stream(
         cache_delete(bot_dicts_in_realm_cache_key(stream.realm))
 
 
+# Fields of Subscription which fetch_subscription_rows depends on;
+# saving only other fields, like color or pin_to_top, does not change
+# a stream's recipient info.
+recipient_info_subscription_fields: Set[str] = {
+    "active",
+    "email_notifications",
+    "is_muted",
+    "is_user_active",
+    "push_notifications",
+    "recipient",
+    "recipient_id",
+    "user_profile",
+    "user_profile_id",
+    "wildcard_mentions_notify",
+}
+
+
+@lru_cache(maxsize=10000)
+def get_recipient_stream_id(recipient_id: int) -> Optional[int]:
+    """Returns the stream ID for a stream recipient, and None for other
+    recipients.  A Recipient's type and type_id never change, so this
+    is cached for the life of the process."""
+    from zerver.models import Recipient
+
+    row = Recipient.objects.filter(id=recipient_id).values_list("type", "type_id").first()
+    if row is None or row[0] != Recipient.STREAM:
+        return None
+    return row[1]
+
+
+# Called by models.py whenever we save or delete a single Subscription;
+# bulk changes call flush_stream_recipient_info directly.
+def flush_subscription(
+    *,
+    instance: "Subscription",
+    update_fields: Optional[Sequence[str]] = None,
+    **kwargs: object,
+) -> None:
+    from zerver.models import Recipient, Subscription
+
+    subscription = instance
+    if update_fields is not None and recipient_info_subscription_fields.isdisjoint(update_fields):
+        return
+
+    if Subscription.recipient.field.is_cached(subscription):
+        if subscription.recipient.type == Recipient.STREAM:
+            flush_stream_recipient_info([subscription.recipient.type_id])
+        return
+
+    stream_id = get_recipient_stream_id(subscription.recipient_id)
+    if stream_id is not None:
+        flush_stream_recipient_info([stream_id])
+
+
 def flush_used_upload_space_cache(
     *,
     instance: "Attachment",
@@ -703,7 +1137,7 @@ def flush_used_upload_space_cache(
 
 
 def to_dict_cache_key_id(message_id: int) -> str:
-    return f"message_dict:{message_id}"
+    return f"message_dict_fragments:{message_id}"
 
 
 def to_dict_cache_key(message: "Message", realm_id: Optional[int] = None) -> str:
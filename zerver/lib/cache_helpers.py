@@ -142,9 +142,9 @@ def fill_remote_cache(cache: str) -> None:
         items_filler(items_for_remote_cache, obj)
         count += 1
         if count % batch_size == 0:
-            cache_set_many(items_for_remote_cache, timeout=3600 * 24)
+            cache_set_many(items_for_remote_cache, timeout=3600 * 24, fill=True)
             items_for_remote_cache = {}
-    cache_set_many(items_for_remote_cache, timeout=3600 * 24 * 7)
+    cache_set_many(items_for_remote_cache, timeout=3600 * 24 * 7, fill=True)
     logging.info(
         "Successfully populated %s cache!  Consumed %s remote cache queries (%s time)",
         cache,
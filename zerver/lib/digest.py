@@ -1,8 +1,9 @@
 import datetime
 import heapq
 import logging
+import time
 from collections import defaultdict
-from typing import Any, Collection, Dict, List, Set, Tuple
+from typing import Any, Collection, Dict, List, Optional, Set, Tuple
 
 from django.conf import settings
 from django.db import transaction
@@ -62,6 +63,9 @@ class DigestTopic:
     def diversity(self) -> int:
         return len(self.human_senders)
 
+    def first_message_id(self) -> int:
+        return self.sample_messages[0].id
+
     def teaser_data(self, user: UserProfile, stream_map: Dict[int, Stream]) -> Dict[str, Any]:
         teaser_count = self.num_human_messages - len(self.sample_messages)
         first_few_messages = build_message_list(
@@ -267,17 +271,122 @@ def get_user_stream_map(user_ids: List[int]) -> Dict[int, Set[int]]:
     return dct
 
 
-def get_slim_stream_map(stream_ids: Set[int]) -> Dict[int, Stream]:
+def get_slim_stream_map(realm: Realm, stream_ids: Optional[Set[int]] = None) -> Dict[int, Stream]:
     # This can be passed to build_message_list.
-    streams = Stream.objects.filter(
-        id__in=stream_ids,
-    ).only("id", "name")
+    if stream_ids is None:
+        streams = get_active_streams(realm).only("id", "name")
+    else:
+        streams = Stream.objects.filter(
+            id__in=stream_ids,
+        ).only("id", "name")
 
     return {stream.id: stream for stream in streams}
 
 
+def get_hot_topic_candidates(topics: List[DigestTopic]) -> Dict[int, List[DigestTopic]]:
+    """Groups the topics by stream, keeping only those which
+    get_hot_topics could pick for some set of streams: a topic which
+    is not one of the top few in its own stream can never be one of
+    the top few across several streams either.  The topics are kept
+    in the same order."""
+    topics_by_stream: Dict[int, List[DigestTopic]] = defaultdict(list)
+    for topic in topics:
+        topics_by_stream[topic.stream_id()].append(topic)
+
+    candidates: Dict[int, List[DigestTopic]] = {}
+    for stream_id, stream_topics in topics_by_stream.items():
+        # These limits match get_hot_topics.
+        hot_topics = set(heapq.nlargest(2, stream_topics, key=DigestTopic.diversity))
+        hot_topics.update(
+            heapq.nlargest(
+                MAX_HOT_TOPICS_TO_BE_INCLUDED_IN_DIGEST, stream_topics, key=DigestTopic.length
+            )
+        )
+        candidates[stream_id] = [topic for topic in stream_topics if topic in hot_topics]
+    return candidates
+
+
+class DigestRealmSnapshot:
+    """The parts of the digest context which are the same for every
+    user in a realm, for a given cutoff: the hot topic candidates in
+    each stream, the streams' names, and the new streams.  Finding the
+    recent topics is by far the most expensive part of building a
+    digest, so this is shared by all of the chunks of users in the
+    realm; see DigestSnapshotCache.
+
+    Callers which don't share the snapshot should pass stream_ids, to
+    only look at the streams their users are subscribed to."""
+
+    def __init__(
+        self,
+        realm: Realm,
+        cutoff_date: datetime.datetime,
+        stream_ids: Optional[Set[int]] = None,
+    ) -> None:
+        start = time.perf_counter()
+        self.realm_id = realm.id
+        self.cutoff_date = cutoff_date
+        self.stream_map = get_slim_stream_map(realm, stream_ids)
+        # This does the heavy lifting of making an expensive query to
+        # the Message table.
+        self.topics_by_stream = get_hot_topic_candidates(
+            get_recent_topics(sorted(self.stream_map), cutoff_date)
+        )
+        self.recent_streams = get_recent_streams(realm, cutoff_date)
+        self.created = time.monotonic()
+        self.build_seconds = time.perf_counter() - start
+
+    def get_hot_topics(self, stream_ids: Set[int]) -> List[DigestTopic]:
+        topics = [
+            topic for stream_id in stream_ids for topic in self.topics_by_stream.get(stream_id, [])
+        ]
+        topics.sort(key=DigestTopic.first_message_id)
+        return get_hot_topics(topics, stream_ids)
+
+
+class DigestSnapshotCache:
+    """Holds the DigestRealmSnapshot of the realm whose digests are
+    being processed.  A realm's users are queued in consecutive
+    chunks, so every chunk after the first can reuse the snapshot,
+    rather than repeating the same queries; we only keep it for a few
+    minutes, so the digests still reflect recent messages.
+
+    Counts how many times a snapshot was reused, and the time that
+    saved, which we log."""
+
+    MAX_AGE_SECONDS = 600
+
+    def __init__(self) -> None:
+        self.snapshot: Optional[DigestRealmSnapshot] = None
+        self.reuse_count = 0
+        self.seconds_saved = 0.0
+
+    def get(self, realm: Realm, cutoff_date: datetime.datetime) -> DigestRealmSnapshot:
+        snapshot = self.snapshot
+        if (
+            snapshot is not None
+            and snapshot.realm_id == realm.id
+            and snapshot.cutoff_date == cutoff_date
+            and time.monotonic() - snapshot.created < self.MAX_AGE_SECONDS
+        ):
+            self.reuse_count += 1
+            self.seconds_saved += snapshot.build_seconds
+            logger.info(
+                "Reused digest snapshot for realm %s (%d reuses, %.3fs saved in total)",
+                realm.id,
+                self.reuse_count,
+                self.seconds_saved,
+            )
+            return snapshot
+
+        self.snapshot = DigestRealmSnapshot(realm, cutoff_date)
+        return self.snapshot
+
+
 def bulk_get_digest_context(
-    users: Collection[UserProfile], cutoff: float
+    users: Collection[UserProfile],
+    cutoff: float,
+    snapshot_cache: Optional[DigestSnapshotCache] = None,
 ) -> Dict[int, Dict[str, Any]]:
     # We expect a non-empty list of users all from the same realm.
     assert users
@@ -303,19 +412,20 @@ def bulk_get_digest_context(
         stream_ids -= recently_modified_streams.get(user.id, set())
         all_stream_ids |= stream_ids
 
-    # Get all the recent topics for all the users.  This does the heavy
-    # lifting of making an expensive query to the Message table.  Then
-    # for each user, we filter to just the streams they care about.
-    recent_topics = get_recent_topics(sorted(all_stream_ids), cutoff_date)
-
-    stream_map = get_slim_stream_map(all_stream_ids)
-
-    recent_streams = get_recent_streams(realm, cutoff_date)
+    # Get the recent topics; when the snapshot is shared with the
+    # other chunks of users in the realm, that is for all of the
+    # realm's streams, and otherwise just for these users' streams.
+    # Then for each user, we filter to just the streams they care
+    # about.
+    if snapshot_cache is not None:
+        snapshot = snapshot_cache.get(realm, cutoff_date)
+    else:
+        snapshot = DigestRealmSnapshot(realm, cutoff_date, all_stream_ids)
 
     for user in users:
         stream_ids = user_stream_map[user.id]
 
-        hot_topics = get_hot_topics(recent_topics, stream_ids)
+        hot_topics = snapshot.get_hot_topics(stream_ids)
 
         context = common_context(user)
 
@@ -325,13 +435,13 @@ def bulk_get_digest_context(
 
         # Get context data for hot conversations.
         context["hot_conversations"] = [
-            hot_topic.teaser_data(user, stream_map) for hot_topic in hot_topics
+            hot_topic.teaser_data(user, snapshot.stream_map) for hot_topic in hot_topics
         ]
 
         # Gather new streams.
         new_streams_count, new_streams = gather_new_streams(
             realm=realm,
-            recent_streams=recent_streams,
+            recent_streams=snapshot.recent_streams,
             can_access_public=user.can_access_public_streams(),
         )
         context["new_streams"] = new_streams
@@ -347,7 +457,9 @@ def get_digest_context(user: UserProfile, cutoff: float) -> Dict[str, Any]:
 
 
 @transaction.atomic
-def bulk_handle_digest_email(user_ids: List[int], cutoff: float) -> None:
+def bulk_handle_digest_email(
+    user_ids: List[int], cutoff: float, snapshot_cache: Optional[DigestSnapshotCache] = None
+) -> None:
     # We go directly to the database to get user objects,
     # since inactive users are likely to not be in the cache.
     users = (
@@ -355,7 +467,7 @@ def bulk_handle_digest_email(user_ids: List[int], cutoff: float) -> None:
         .order_by("id")
         .select_related("realm")
     )
-    context_map = bulk_get_digest_context(users, cutoff)
+    context_map = bulk_get_digest_context(users, cutoff, snapshot_cache)
 
     digest_users = []
 
@@ -138,6 +138,7 @@ ALL_ZULIP_TABLES = {
     "zerver_preregistrationrealm",
     "zerver_preregistrationuser",
     "zerver_preregistrationuser_streams",
+    "zerver_presencesequence",
     "zerver_pushdevicetoken",
     "zerver_reaction",
     "zerver_realm",
@@ -197,6 +198,9 @@ NON_EXPORTED_TABLES = {
     # When switching servers, clients will need to re-log in and
     # reregister for push notifications anyway.
     "zerver_pushdevicetoken",
+    # Clients will also need to fetch presence from scratch, so
+    # presence update ids start over on import.
+    "zerver_presencesequence",
     # We don't use these generated Django tables
     "zerver_userprofile_groups",
     "zerver_userprofile_user_permissions",
@@ -23,8 +23,8 @@ from zerver.actions.user_settings import do_change_avatar_fields
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.lib.bulk_create import bulk_set_users_or_streams_recipient_fields
 from zerver.lib.export import DATE_FIELDS, Field, Path, Record, TableData, TableName
-from zerver.lib.markdown import markdown_convert
 from zerver.lib.markdown import version as markdown_version
+from zerver.lib.markdown.render_pool import MarkdownRenderPool, RenderRequest
 from zerver.lib.message import get_last_message_id
 from zerver.lib.server_initialization import create_internal_realm, server_initialized
 from zerver.lib.streams import render_stream_description
@@ -295,12 +295,17 @@ def fix_customprofilefield(data: TableData) -> None:
 
 
 def fix_message_rendered_content(
-    realm: Realm, sender_map: Dict[int, Record], messages: List[Record]
+    realm: Realm,
+    sender_map: Dict[int, Record],
+    messages: List[Record],
+    render_pool: MarkdownRenderPool,
 ) -> None:
     """
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
     """
+    messages_to_render: List[Record] = []
+    render_requests: List[RenderRequest] = []
     for message in messages:
         if message["rendered_content"] is not None:
             # For Zulip->Zulip imports, we use the original rendered
@@ -350,37 +355,36 @@ def fix_message_rendered_content(
             continue
 
         try:
-            content = message["content"]
-
-            sender_id = message["sender_id"]
-            sender = sender_map[sender_id]
-            sent_by_bot = sender["is_bot"]
-            translate_emoticons = sender["translate_emoticons"]
-
-            # We don't handle alert words on import from third-party
-            # platforms, since they generally don't have an "alert
-            # words" type feature, and notifications aren't important anyway.
-            realm_alert_words_automaton = None
-
-            rendered_content = markdown_convert(
-                content=content,
-                realm_alert_words_automaton=realm_alert_words_automaton,
-                message_realm=realm,
-                sent_by_bot=sent_by_bot,
-                translate_emoticons=translate_emoticons,
-            ).rendered_content
-
-            message["rendered_content"] = rendered_content
-            message["rendered_content_version"] = markdown_version
-        except Exception:
-            # This generally happens with two possible causes:
-            # * rendering Markdown throwing an uncaught exception
-            # * rendering Markdown failing with the exception being
-            #   caught in Markdown (which then returns None, causing the the
-            #   rendered_content assert above to fire).
+            sender = sender_map[message["sender_id"]]
+        except KeyError:
+            logging.warning(
+                "Error in Markdown rendering for message ID %s; continuing", message["id"]
+            )
+            continue
+
+        # We don't handle alert words on import from third-party
+        # platforms, since they generally don't have an "alert
+        # words" type feature, and notifications aren't important anyway.
+        messages_to_render.append(message)
+        render_requests.append(
+            RenderRequest(
+                content=message["content"],
+                realm=realm,
+                sent_by_bot=sender["is_bot"],
+                translate_emoticons=sender["translate_emoticons"],
+            )
+        )
+
+    for message, rendering_result in zip(messages_to_render, render_pool.render(render_requests)):
+        if rendering_result is None:
+            # Rendering the Markdown failed; this has already been
+            # logged in detail, without the message ID.
             logging.warning(
                 "Error in Markdown rendering for message ID %s; continuing", message["id"]
             )
+            continue
+        message["rendered_content"] = rendering_result.rendered_content
+        message["rendered_content_version"] = markdown_version
 
 
 def current_table_ids(data: TableData, table: TableName) -> List[int]:
@@ -1242,6 +1246,9 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int = 1) -> Rea
         RealmUserDefault.objects.create(realm=realm)
 
     fix_datetime_fields(data, "zerver_userpresence")
+    # The realm's presence update ids start over on this server.
+    for presence in data["zerver_userpresence"]:
+        presence["last_update_id"] = 0
     re_map_foreign_keys(data, "zerver_userpresence", "user_profile", related_table="user_profile")
     re_map_foreign_keys(data, "zerver_userpresence", "realm", related_table="realm")
     update_model_ids(UserPresence, data, "user_presence")
@@ -1313,7 +1320,10 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int = 1) -> Rea
     sender_map = {user["id"]: user for user in data["zerver_userprofile"]}
 
     # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
+    with MarkdownRenderPool(processes) as render_pool:
+        import_message_data(
+            realm=realm, sender_map=sender_map, import_dir=import_dir, render_pool=render_pool
+        )
 
     re_map_foreign_keys(data, "zerver_reaction", "message", related_table="message")
     re_map_foreign_keys(data, "zerver_reaction", "user_profile", related_table="user_profile")
@@ -1455,7 +1465,9 @@ def get_incoming_message_ids(import_dir: Path, sort_by_date: bool) -> List[int]:
     return message_ids
 
 
-def import_message_data(realm: Realm, sender_map: Dict[int, Record], import_dir: Path) -> None:
+def import_message_data(
+    realm: Realm, sender_map: Dict[int, Record], import_dir: Path, render_pool: MarkdownRenderPool
+) -> None:
     dump_file_id = 1
     while True:
         message_filename = os.path.join(import_dir, f"messages-{dump_file_id:06}.json")
@@ -1489,6 +1501,7 @@ def import_message_data(realm: Realm, sender_map: Dict[int, Record], import_dir:
             realm=realm,
             sender_map=sender_map,
             messages=data["zerver_message"],
+            render_pool=render_pool,
         )
         logging.info("Successfully rendered Markdown for message batch")
 
@@ -3,12 +3,13 @@
 import cgi
 import datetime
 import html
+import itertools
 import logging
 import re
 import time
 import urllib
 import urllib.parse
-from collections import deque
+from collections import Counter, OrderedDict, deque
 from dataclasses import dataclass
 from functools import lru_cache
 from typing import (
@@ -16,6 +17,7 @@ from typing import (
     Callable,
     Dict,
     Generic,
+    Iterator,
     List,
     Match,
     Optional,
@@ -256,6 +258,7 @@ def clear_state_for_testing() -> None:
     # try out both sides of ENABLE_FILE_LINKS, so we need
     # a way to clear it.
     get_web_link_regex.cache_clear()
+    topic_links_cache.clear()
 
 
 markdown_logger = logging.getLogger()
@@ -1781,34 +1784,120 @@ def prepare_linkifier_pattern(source: str) -> str:
     return rf"""(?P<{BEFORE_CAPTURE_GROUP}>^|\s|['"\(,:<])(?P<{OUTER_CAPTURE_GROUP}>{source})(?P<{AFTER_CAPTURE_GROUP}>$|[^\pL\pN])"""
 
 
-# Given a regular expression pattern, linkifies groups that match it
-# using the provided format string to construct the URL.
-class LinkifierPattern(CompiledInlineProcessor):
-    """Applied a given linkifier to the input"""
+class LinkifierMatcher:
+    """The compiled linkifiers for a realm, in order of priority.
+
+    We also compile all of their patterns into a single RE2 set, which
+    finds every linkifier that matches a string in one pass over it.
+    This keeps the cost of rendering a message or topic flat as the
+    number of linkifiers in a realm grows; only the (usually few)
+    linkifiers which actually match are run individually."""
+
+    def __init__(self, linkifiers: List[LinkifierDict]) -> None:
+        self.linkifiers = linkifiers
+        # Identifies this set of linkifiers in topic_links_cache.
+        self.version = next(linkifier_matcher_versions)
+        self.patterns: List[Pattern[str]] = []
+        self.url_templates: List[uri_template.URITemplate] = []
 
-    def __init__(
-        self,
-        source_pattern: str,
-        url_template: str,
-        zmd: "ZulipMarkdown",
-    ) -> None:
         # Do not write errors to stderr (this still raises exceptions)
         options = re2.Options()
         options.log_errors = False
+        # A set of hundreds of patterns needs a larger DFA than a
+        # single pattern; this is an upper bound, not an allocation.
+        set_options = re2.Options()
+        set_options.log_errors = False
+        set_options.max_mem = 64 * 1024 * 1024
+        self.pattern_set = re2.Set.SearchSet(set_options)
+
+        for linkifier in linkifiers:
+            prepared_pattern = prepare_linkifier_pattern(linkifier["pattern"])
+            try:
+                compiled_pattern = re2.compile(prepared_pattern, options=options)
+                self.pattern_set.Add(prepared_pattern)
+            except re2.error:
+                # An invalid regex shouldn't be possible here, and logging
+                # here on an invalid regex would spam the logs with every
+                # message sent; simply move on.
+                continue
+            self.patterns.append(compiled_pattern)
+            self.url_templates.append(uri_template.URITemplate(linkifier["url_template"]))
+        self.pattern_set.Compile()
+
+    def matching_linkifiers(self, text: str) -> List[int]:
+        """Returns the indexes of the linkifiers which match somewhere in
+        the text, in order of priority."""
+        if not self.patterns:
+            return []
+        return sorted(self.pattern_set.Match(text) or [])
+
 
-        compiled_re2 = re2.compile(prepare_linkifier_pattern(source_pattern), options=options)
+linkifier_matchers: Dict[int, LinkifierMatcher] = {}
+linkifier_matcher_versions = itertools.count()
 
-        self.prepared_url_template = uri_template.URITemplate(url_template)
 
-        super().__init__(compiled_re2, zmd)
+def get_linkifier_matcher(linkifiers_key: int) -> LinkifierMatcher:
+    linkifiers = linkifiers_for_realm(linkifiers_key)
+    matcher = linkifier_matchers.get(linkifiers_key)
+    if matcher is None or (
+        matcher.linkifiers is not linkifiers and matcher.linkifiers != linkifiers
+    ):
+        matcher = LinkifierMatcher(linkifiers)
+        linkifier_matchers[linkifiers_key] = matcher
+    return matcher
+
+
+class LinkifierPattern(markdown.inlinepatterns.InlineProcessor):
+    """Applies a realm's linkifiers to the input.
+
+    Linkifiers are applied one at a time, in order of priority, to the
+    output of the previous one, so a match for an earlier linkifier
+    wins over an overlapping match for a later one.  Rather than
+    scanning the input once per linkifier, we find the linkifiers
+    which match it in one pass with the LinkifierMatcher, and then
+    only apply those."""
+
+    def __init__(self, matcher: LinkifierMatcher, zmd: "ZulipMarkdown") -> None:
+        # We skip the superclass's __init__, since we have no single
+        # regex to compile; see getCompiledRegExp.
+        self.matcher = matcher
+        self.md = zmd
+        self.zmd = zmd
+        # The linkifiers still to be applied to the text being
+        # processed, or None between texts.
+        self.pending_linkifiers: Optional[List[int]] = None
+
+    def reset(self) -> None:
+        self.pending_linkifiers = None
+
+    def getCompiledRegExp(self) -> "LinkifierPattern":  # type: ignore[override] # see finditer
+        return self
+
+    def finditer(self, data: str, pos: int) -> Iterator[Match[str]]:
+        # Python-Markdown calls this repeatedly on the text, with each
+        # match it accepted replaced by a placeholder, until it yields
+        # no match that handleMatch accepts.
+        if self.pending_linkifiers is None:
+            self.pending_linkifiers = self.matcher.matching_linkifiers(data)
+        while self.pending_linkifiers:
+            # If handleMatch accepts a match, we're not resumed, and
+            # the next call starts over with the same linkifier.
+            yield from self.matcher.patterns[self.pending_linkifiers[0]].finditer(data, pos)
+            # Move on to the next linkifier, which starts over from
+            # the beginning of the text.
+            self.pending_linkifiers.pop(0)
+            pos = 0
+        self.pending_linkifiers = None
 
     def handleMatch(  # type: ignore[override] # https://github.com/python/mypy/issues/10197
         self, m: Match[str], data: str
     ) -> Union[Tuple[Element, int, int], Tuple[None, None, None]]:
+        assert self.pending_linkifiers
+        prepared_url_template = self.matcher.url_templates[self.pending_linkifiers[0]]
         db_data: Optional[DbData] = self.zmd.zulip_db_data
         url = url_to_a(
             db_data,
-            self.prepared_url_template.expand(**m.groupdict()),
+            prepared_url_template.expand(**m.groupdict()),
             markdown.util.AtomicString(m.group(OUTER_CAPTURE_GROUP)),
         )
         if isinstance(url, str):
@@ -2259,15 +2348,22 @@ class ZulipMarkdown(markdown.Markdown):
         return reg
 
     def register_linkifiers(self, registry: markdown.util.Registry) -> markdown.util.Registry:
-        for linkifier in self.linkifiers:
-            pattern = linkifier["pattern"]
-            registry.register(
-                LinkifierPattern(pattern, linkifier["url_template"], self),
-                f"linkifiers/{pattern}",
-                45,
-            )
+        if self.linkifiers:
+            # Share the compiled linkifiers with topic_links, if possible.
+            matcher = linkifier_matchers.get(self.linkifiers_key)
+            if matcher is None or matcher.linkifiers is not self.linkifiers:
+                matcher = LinkifierMatcher(self.linkifiers)
+            registry.register(LinkifierPattern(matcher, self), "linkifiers", 45)
         return registry
 
+    def reset(self) -> "ZulipMarkdown":
+        super().reset()
+        # Clear any partial state left by a conversion which was
+        # interrupted, e.g. by a timeout.
+        if "linkifiers" in self.inlinePatterns:
+            self.inlinePatterns["linkifiers"].reset()
+        return self
+
     def build_treeprocessors(self) -> markdown.util.Registry:
         # Here we build all the processors from upstream, plus a few of our own.
         treeprocessors = markdown.util.Registry()
@@ -2357,27 +2453,48 @@ class TopicLinkMatch:
     precedence: Optional[int]
 
 
+# Fetching a page of messages usually builds many message dicts with
+# the same topic, so we remember the topic links for recently seen
+# topics, by realm and version of the realm's linkifiers.
+MAX_CACHED_TOPIC_LINKS = 10000
+topic_links_cache: "OrderedDict[Tuple[int, int, str], List[Dict[str, str]]]" = OrderedDict()
+topic_links_cache_stats: "Counter[str]" = Counter()
+
+
+def get_topic_links_cache_stats() -> Dict[str, int]:
+    """Returns the hits, misses and evictions of the topic links cache
+    in this process."""
+    return dict(topic_links_cache_stats)
+
+
+def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
+    matcher = get_linkifier_matcher(linkifiers_key)
+    cache_key = (linkifiers_key, matcher.version, topic_name)
+    links = topic_links_cache.get(cache_key)
+    if links is None:
+        topic_links_cache_stats["misses"] += 1
+        links = compute_topic_links(matcher, topic_name)
+        topic_links_cache[cache_key] = links
+        if len(topic_links_cache) > MAX_CACHED_TOPIC_LINKS:
+            topic_links_cache.popitem(last=False)
+            topic_links_cache_stats["evictions"] += 1
+    else:
+        topic_links_cache_stats["hits"] += 1
+        topic_links_cache.move_to_end(cache_key)
+    # Callers get their own copies, which they are free to modify.
+    return [dict(link) for link in links]
+
+
 # Security note: We don't do any HTML escaping in this
 # function on the URLs; they are expected to be HTML-escaped when
 # rendered by clients (just as links rendered into message bodies
 # are validated and escaped inside `url_to_a`).
-def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
+def compute_topic_links(matcher: LinkifierMatcher, topic_name: str) -> List[Dict[str, str]]:
     matches: List[TopicLinkMatch] = []
-    linkifiers = linkifiers_for_realm(linkifiers_key)
-    precedence = 0
 
-    options = re2.Options()
-    options.log_errors = False
-    for linkifier in linkifiers:
-        raw_pattern = linkifier["pattern"]
-        prepared_url_template = uri_template.URITemplate(linkifier["url_template"])
-        try:
-            pattern = re2.compile(prepare_linkifier_pattern(raw_pattern), options=options)
-        except re2.error:
-            # An invalid regex shouldn't be possible here, and logging
-            # here on an invalid regex would spam the logs with every
-            # message sent; simply move on.
-            continue
+    for precedence in matcher.matching_linkifiers(topic_name):
+        pattern = matcher.patterns[precedence]
+        prepared_url_template = matcher.url_templates[precedence]
         pos = 0
         while pos < len(topic_name):
             m = pattern.search(topic_name, pos)
@@ -2404,7 +2521,6 @@ def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
                     precedence=precedence,
                 )
             ]
-        precedence += 1
 
     # Sort the matches beforehand so we favor the match with a higher priority and tie-break with the starting index.
     # Note that we sort it before processing the raw URLs so that linkifiers will be prioritized over them.
@@ -2473,6 +2589,8 @@ def maybe_update_markdown_engines(linkifiers_key: int, email_gateway: bool) -> N
         # Linkifier data has changed, update `linkifier_data` and any
         # of the existing Markdown engines using this set of linkifiers.
         linkifier_data[linkifiers_key] = linkifiers
+        # This also invalidates topic_links_cache for the old linkifiers.
+        linkifier_matchers[linkifiers_key] = LinkifierMatcher(linkifiers)
         for email_gateway_flag in [True, False]:
             if (linkifiers_key, email_gateway_flag) in md_engines:
                 # Update only existing engines(if any), don't create new one.
@@ -2483,6 +2601,36 @@ def maybe_update_markdown_engines(linkifiers_key: int, email_gateway: bool) -> N
         make_md_engine(linkifiers_key, email_gateway)
 
 
+# Content which fully matches this regex, and doesn't contain a
+# linkifier or an alert word, is a single paragraph of text which the
+# Markdown processor leaves unchanged: it has no characters with any
+# meaning in Markdown or HTML, no leading indentation or hyphen, no
+# mentions, emoji, emoticons, or URLs (which all need a character
+# outside this set), and periods only at the ends of words, so no
+# numbered lists or domain names.  This is deliberately conservative.
+PLAIN_TEXT_RE = re.compile(r"[A-Za-z0-9,!?'](?:[A-Za-z0-9,!?' -]|(?<=[A-Za-z])\.(?= |\Z))*(?<! )")
+
+
+def is_plain_text(
+    content: str, linkifiers_key: int, realm_alert_words_automaton: Optional[ahocorasick.Automaton]
+) -> bool:
+    """Returns whether the content can skip the Markdown processor and
+    be rendered as a paragraph containing it verbatim."""
+    if linkifiers_key == ZEPHYR_MIRROR_MARKDOWN_KEY:
+        return False
+    if PLAIN_TEXT_RE.fullmatch(content) is None:
+        return False
+    if get_linkifier_matcher(linkifiers_key).matching_linkifiers(content):
+        return False
+    # We leave deciding whether an alert word really matches, which
+    # depends on what surrounds it, to AlertWordNotificationProcessor.
+    if realm_alert_words_automaton is not None and any(
+        True for _ in realm_alert_words_automaton.iter(content.lower())
+    ):
+        return False
+    return True
+
+
 # We want to log Markdown parser failures, but shouldn't log the actual input
 # message for privacy reasons.  The compromise is to replace all alphanumeric
 # characters with 'x'.
@@ -2536,6 +2684,22 @@ def do_convert(
         linkifiers_key = ZEPHYR_MIRROR_MARKDOWN_KEY
 
     maybe_update_markdown_engines(linkifiers_key, email_gateway)
+
+    if is_plain_text(content, linkifiers_key, realm_alert_words_automaton):
+        # Most messages are short plain text, for which we can skip
+        # the Markdown processor and the database queries it needs.
+        # None of the characters in PLAIN_TEXT_RE need escaping.
+        return MessageRenderingResult(
+            rendered_content=f"<p>{content}</p>",
+            mentions_wildcard=False,
+            mentions_user_ids=set(),
+            mentions_user_group_ids=set(),
+            alert_words=set(),
+            links_for_preview=set(),
+            user_ids_with_alert_words=set(),
+            potential_attachment_path_ids=[],
+        )
+
     md_engine_key = (linkifiers_key, email_gateway)
     _md_engine = md_engines[md_engine_key]
     # Reset the parser; otherwise it will get slower over time.
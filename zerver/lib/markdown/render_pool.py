@@ -0,0 +1,127 @@
+"""Renders Markdown for batches of messages in a pool of processes.
+
+Rendering Markdown is CPU-bound, and so limited to a single core per
+process by the GIL.  Code which renders many messages at once, like
+importing a realm, can instead hand them to a MarkdownRenderPool,
+which renders them in parallel in worker processes forked when the
+pool is created.
+
+Each message is rendered with markdown_convert, so the usual limit of
+5 seconds of rendering time applies to each message individually,
+not to the batch.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from types import TracebackType
+from typing import List, Optional, Type
+
+import bmemcached
+from django.core.cache import cache
+from django.db import connection
+
+from zerver.lib.markdown import MessageRenderingResult, get_web_link_regex, markdown_convert
+from zerver.lib.mention import MentionData
+from zerver.models import Realm, flush_per_request_caches
+
+
+@dataclass
+class RenderRequest:
+    content: str
+    realm: Realm
+    sent_by_bot: bool = False
+    translate_emoticons: bool = False
+    mention_data: Optional[MentionData] = None
+
+
+def render_batch(requests: List[RenderRequest]) -> List[Optional[MessageRenderingResult]]:
+    """Renders each of the requests, returning None for those which
+    failed to render, so that one bad message can't fail the batch;
+    the caller should log those."""
+    # Worker processes live for many batches, so we need to pick up
+    # any changes to linkifiers since the last one.
+    flush_per_request_caches()
+    results: List[Optional[MessageRenderingResult]] = []
+    for request in requests:
+        try:
+            results.append(
+                markdown_convert(
+                    request.content,
+                    message_realm=request.realm,
+                    sent_by_bot=request.sent_by_bot,
+                    translate_emoticons=request.translate_emoticons,
+                    mention_data=request.mention_data,
+                )
+            )
+        except Exception:
+            # markdown_convert has already logged a
+            # MarkdownRenderingError in detail; anything else is
+            # likely a bug in a Markdown extension.
+            results.append(None)
+    return results
+
+
+class MarkdownRenderPool:
+    """A pool of processes for rendering Markdown.  With a single
+    process, messages are instead rendered in the calling process.
+
+    Creating the pool closes the caller's database and memcached
+    connections, which the worker processes would otherwise share;
+    they are reopened as needed.  Use it as a context manager, so the
+    worker processes are shut down once done."""
+
+    def __init__(self, processes: int, batch_size: int = 100) -> None:
+        assert processes >= 1
+        self.processes = processes
+        self.batch_size = batch_size
+        self.executor: Optional[ProcessPoolExecutor] = None
+        if processes > 1:
+            self.start_workers()
+
+    def start_workers(self) -> None:
+        # The workers inherit this, rather than each building it for
+        # their first message.
+        get_web_link_regex()
+
+        connection.close()
+        _cache = cache._cache  # type: ignore[attr-defined] # not in stubs
+        # The test suite's local memory cache is instead copied into
+        # each worker.
+        if isinstance(_cache, bmemcached.Client):  # nocoverage
+            _cache.disconnect_all()
+        self.executor = ProcessPoolExecutor(max_workers=self.processes)
+        # ProcessPoolExecutor only starts workers as work arrives;
+        # start them all now, while the connections are closed.
+        for future in [
+            self.executor.submit(flush_per_request_caches) for i in range(self.processes)
+        ]:
+            future.result()
+
+    def render(self, requests: List[RenderRequest]) -> List[Optional[MessageRenderingResult]]:
+        """Renders the requests, returning their results in the same
+        order, with None for those which failed to render."""
+        if self.executor is None:
+            return render_batch(requests)
+        else:
+            batches = [
+                requests[i : i + self.batch_size] for i in range(0, len(requests), self.batch_size)
+            ]
+            return [
+                result for results in self.executor.map(render_batch, batches) for result in results
+            ]
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self) -> "MarkdownRenderPool":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
@@ -1,25 +1,28 @@
 import copy
 import datetime
-import zlib
 from dataclasses import dataclass, field
 from typing import (
     Any,
+    Callable,
     Collection,
     Dict,
+    Iterable,
     List,
     Mapping,
+    NamedTuple,
     Optional,
     Sequence,
     Set,
     Tuple,
     TypedDict,
+    TypeVar,
     Union,
 )
 
 import ahocorasick
 import orjson
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Max, Sum
 from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
@@ -30,6 +33,7 @@ from analytics.lib.counts import COUNT_STATS
 from analytics.models import RealmCount
 from zerver.lib.avatar import get_avatar_field
 from zerver.lib.cache import (
+    cache_delete_many,
     cache_set_many,
     cache_with_key,
     generic_bulk_cached_fetch,
@@ -37,10 +41,16 @@ from zerver.lib.cache import (
     to_dict_cache_key_id,
 )
 from zerver.lib.display_recipient import bulk_fetch_display_recipients
-from zerver.lib.exceptions import JsonableError, MissingAuthenticationError
+from zerver.lib.exceptions import (
+    JsonableError,
+    MarkdownRenderingError,
+    MissingAuthenticationError,
+)
 from zerver.lib.markdown import MessageRenderingResult, markdown_convert, topic_links
 from zerver.lib.markdown import version as markdown_version
 from zerver.lib.mention import MentionData
+from zerver.lib.message_codec import compress_message, decompress_message
+from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import RequestVariableConversionError
 from zerver.lib.stream_subscription import (
     get_stream_subscriptions_for_user,
@@ -199,6 +209,48 @@ def truncate_topic(topic: str) -> str:
     return truncate_content(topic, MAX_TOPIC_NAME_LENGTH, "...")
 
 
+CachedMessageT = TypeVar("CachedMessageT")
+
+
+def bulk_fetch_cached_messages(
+    message_ids: List[int],
+    *,
+    extractor: Callable[[bytes], CachedMessageT],
+    setter: Callable[[CachedMessageT], bytes],
+    from_dict: Callable[[Dict[str, Any]], CachedMessageT],
+) -> Dict[int, CachedMessageT]:
+    # Messages whose rendered content is from an older version of the
+    # Markdown processor are served as they are, and re-rendered in
+    # the background, rather than making this request wait.
+    stale_message_ids: List[int] = []
+
+    def cache_transformer(row: Dict[str, Any]) -> CachedMessageT:
+        if row["rendered_content"] is not None and Message.need_to_render_content(
+            row["rendered_content"], row["rendered_content_version"], markdown_version
+        ):
+            stale_message_ids.append(row["id"])
+        return from_dict(
+            MessageDict.build_dict_from_raw_db_row(row, allow_stale_rendered_content=True)
+        )
+
+    id_fetcher = lambda row: row["id"]
+
+    messages = generic_bulk_cached_fetch(
+        to_dict_cache_key_id,
+        MessageDict.get_raw_db_rows,
+        message_ids,
+        id_fetcher=id_fetcher,
+        cache_transformer=cache_transformer,
+        extractor=extractor,
+        setter=setter,
+    )
+    if stale_message_ids:
+        # This must happen after the stale dicts are cached, since
+        # re-rendering flushes them from the cache.
+        queue_json_publish("rerender_messages", {"message_ids": stale_message_ids})
+    return messages
+
+
 def messages_for_ids(
     message_ids: List[int],
     user_message_flags: Dict[int, List[str]],
@@ -207,17 +259,11 @@ def messages_for_ids(
     client_gravatar: bool,
     allow_edit_history: bool,
 ) -> List[Dict[str, Any]]:
-    cache_transformer = MessageDict.build_dict_from_raw_db_row
-    id_fetcher = lambda row: row["id"]
-
-    message_dicts = generic_bulk_cached_fetch(
-        to_dict_cache_key_id,
-        MessageDict.get_raw_db_rows,
+    message_dicts = bulk_fetch_cached_messages(
         message_ids,
-        id_fetcher=id_fetcher,
-        cache_transformer=cache_transformer,
         extractor=extract_message_dict,
         setter=stringify_message_dict,
+        from_dict=lambda message_dict: message_dict,
     )
 
     message_list: List[Dict[str, Any]] = []
@@ -238,6 +284,70 @@ def messages_for_ids(
     return message_list
 
 
+def messages_json_for_ids(
+    message_ids: List[int],
+    user_message_flags: Dict[int, List[str]],
+    search_fields: Dict[int, Dict[str, str]],
+    apply_markdown: bool,
+    client_gravatar: bool,
+    allow_edit_history: bool,
+) -> bytes:
+    """Equivalent to serializing the result of messages_for_ids as a
+    JSON array, but much faster: rather than decoding each cached
+    message dict and encoding it again, we splice together its cached
+    JSON fragments with the sender and recipient info, which we
+    serialize only once for each distinct sender and recipient."""
+    message_fragments = bulk_fetch_cached_messages(
+        message_ids,
+        extractor=extract_message_fragments,
+        setter=stringify_message_fragments,
+        from_dict=message_dict_to_fragments,
+    )
+
+    hydration_dicts: Dict[bytes, Dict[str, Any]] = {}
+    for fragments in message_fragments.values():
+        if fragments.hydration_fields not in hydration_dicts:
+            hydration_dicts[fragments.hydration_fields] = orjson.loads(
+                b"{" + fragments.hydration_fields + b"}"
+            )
+    hydration_objs = list(hydration_dicts.values())
+    MessageDict.bulk_hydrate_sender_info(hydration_objs)
+    MessageDict.bulk_hydrate_recipient_info(hydration_objs)
+    hydrated_fields: Dict[bytes, bytes] = {}
+    for hydration_fields, obj in hydration_dicts.items():
+        MessageDict.finalize_hydrated_fields(obj, client_gravatar)
+        hydrated_fields[hydration_fields] = orjson.dumps(obj)[1:-1]
+
+    if apply_markdown:
+        content_prefix = b',"content_type":"text/html","content":'
+    else:
+        content_prefix = b',"content_type":"text/x-markdown","content":'
+
+    parts = [b"["]
+    for message_id in message_ids:
+        fragments = message_fragments[message_id]
+        if len(parts) > 1:
+            parts.append(b",")
+        parts += [
+            b"{",
+            fragments.fields,
+            b",",
+            hydrated_fields[fragments.hydration_fields],
+            content_prefix,
+            fragments.rendered_content if apply_markdown else fragments.content,
+        ]
+        # Make sure that we never send message edit history to clients
+        # in realms with allow_edit_history disabled.
+        if fragments.edit_history and allow_edit_history:
+            parts += [b',"edit_history":', fragments.edit_history]
+        parts += [b',"flags":', orjson.dumps(user_message_flags[message_id])]
+        if message_id in search_fields:
+            parts += [b",", orjson.dumps(search_fields[message_id])[1:-1]]
+        parts.append(b"}")
+    parts.append(b"]")
+    return b"".join(parts)
+
+
 def sew_messages_and_reactions(
     messages: List[Dict[str, Any]], reactions: List[Dict[str, Any]]
 ) -> List[Dict[str, Any]]:
@@ -273,12 +383,79 @@ def sew_messages_and_submessages(
             message["submessages"].append(submessage)
 
 
+# The fields of a message dict which are only used to hydrate the
+# sender and recipient info in MessageDict.post_process_dicts.
+MESSAGE_HYDRATION_FIELDS = [
+    "sender_id",
+    "sender_realm_id",
+    "recipient_id",
+    "recipient_type",
+    "recipient_type_id",
+]
+
+
+class MessageFragments(NamedTuple):
+    """A message dict in the to_dict cache, stored as separately
+    serialized JSON fragments, so that messages_json_for_ids can
+    assemble API responses from them without decoding them."""
+
+    # The members (without braces) of a JSON object of the fields
+    # not listed below.
+    fields: bytes
+    # The members of a JSON object of MESSAGE_HYDRATION_FIELDS.
+    hydration_fields: bytes
+    # JSON values.
+    content: bytes
+    rendered_content: bytes
+    # A JSON value, or empty if the message has no edit history.
+    edit_history: bytes
+
+
+def message_dict_to_fragments(message_dict: Dict[str, Any]) -> MessageFragments:
+    fields = dict(message_dict)
+    hydration_fields = {key: fields.pop(key) for key in MESSAGE_HYDRATION_FIELDS}
+    content = fields.pop("content")
+    rendered_content = fields.pop("rendered_content")
+    edit_history = fields.pop("edit_history", None)
+    return MessageFragments(
+        fields=orjson.dumps(fields)[1:-1],
+        hydration_fields=orjson.dumps(hydration_fields)[1:-1],
+        content=orjson.dumps(content),
+        rendered_content=orjson.dumps(rendered_content),
+        edit_history=b"" if edit_history is None else orjson.dumps(edit_history),
+    )
+
+
+# The fragments are separated by NUL bytes, which orjson never
+# outputs, since it escapes control characters in strings.
+def extract_message_fragments(message_bytes: bytes) -> MessageFragments:
+    return MessageFragments(*decompress_message(message_bytes).split(b"\0"))
+
+
+def stringify_message_fragments(fragments: MessageFragments) -> bytes:
+    return compress_message(b"\0".join(fragments))
+
+
 def extract_message_dict(message_bytes: bytes) -> Dict[str, Any]:
-    return orjson.loads(zlib.decompress(message_bytes))
+    fragments = extract_message_fragments(message_bytes)
+    parts = [
+        b"{",
+        fragments.fields,
+        b",",
+        fragments.hydration_fields,
+        b',"content":',
+        fragments.content,
+        b',"rendered_content":',
+        fragments.rendered_content,
+    ]
+    if fragments.edit_history:
+        parts += [b',"edit_history":', fragments.edit_history]
+    parts.append(b"}")
+    return orjson.loads(b"".join(parts))
 
 
 def stringify_message_dict(message_dict: Dict[str, Any]) -> bytes:
-    return zlib.compress(orjson.dumps(message_dict))
+    return stringify_message_fragments(message_dict_to_fragments(message_dict))
 
 
 @cache_with_key(to_dict_cache_key, timeout=3600 * 24)
@@ -297,6 +474,54 @@ def save_message_rendered_content(message: Message, content: str) -> str:
     return rendered_content
 
 
+def rerender_messages(message_ids: Iterable[int]) -> int:
+    """Re-renders those of the messages whose rendered content is
+    missing or from an older version of the Markdown processor, and
+    saves them in bulk.  Returns the number of messages re-rendered.
+
+    The cached message dicts of all of the messages whose rendering is
+    now current are flushed, not just those re-rendered here: a
+    reader may have cached a stale rendering it read just before
+    another re-render of the message committed, and then queued the
+    message again."""
+    messages = list(Message.objects.filter(id__in=message_ids).select_related())
+    current_message_ids = []
+    rendered_messages = []
+    for message in messages:
+        if not Message.need_to_render_content(
+            message.rendered_content, message.rendered_content_version, markdown_version
+        ):
+            current_message_ids.append(message.id)
+            continue
+        try:
+            rendering_result = render_markdown(message, message.content)
+        except MarkdownRenderingError:
+            # Already logged; the message keeps its old rendering.
+            continue
+        message.rendered_content = rendering_result.rendered_content
+        message.rendered_content_version = markdown_version
+        rendered_messages.append(message)
+
+    with transaction.atomic():
+        # Skip messages which were edited while we were rendering them.
+        current_contents = dict(
+            Message.objects.select_for_update()
+            .filter(id__in=[message.id for message in rendered_messages])
+            .values_list("id", "content")
+        )
+        rendered_messages = [
+            message
+            for message in rendered_messages
+            if current_contents.get(message.id) == message.content
+        ]
+        Message.objects.bulk_update(
+            rendered_messages, ["rendered_content", "rendered_content_version"], batch_size=1000
+        )
+    current_message_ids += [message.id for message in rendered_messages]
+    cache_delete_many(to_dict_cache_key_id(message_id) for message_id in current_message_ids)
+    return len(rendered_messages)
+
+
 class MessageDict:
     """MessageDict is the core class responsible for marshalling Message
     objects obtained from the database into a format that can be sent
@@ -374,14 +599,6 @@ class MessageDict:
         if not skip_copy:
             obj = copy.copy(obj)
 
-        if obj["sender_email_address_visibility"] != UserProfile.EMAIL_ADDRESS_VISIBILITY_EVERYONE:
-            # If email address of the sender is only available to administrators,
-            # clients cannot compute gravatars, so we force-set it to false.
-            # If we plumbed the current user's role, we could allow client_gravatar=True
-            # here if the current user's role has access to the target user's email address.
-            client_gravatar = False
-
-        MessageDict.set_sender_avatar(obj, client_gravatar)
         if apply_markdown:
             obj["content_type"] = "text/html"
             obj["content"] = obj["rendered_content"]
@@ -390,6 +607,23 @@ class MessageDict:
 
         if not keep_rendered_content:
             del obj["rendered_content"]
+        MessageDict.finalize_hydrated_fields(obj, client_gravatar)
+        return obj
+
+    @staticmethod
+    def finalize_hydrated_fields(obj: Dict[str, Any], client_gravatar: bool) -> None:
+        """
+        Sets the sender's avatar URL, and removes the fields used
+        to hydrate the sender and recipient info.
+        """
+        if obj["sender_email_address_visibility"] != UserProfile.EMAIL_ADDRESS_VISIBILITY_EVERYONE:
+            # If email address of the sender is only available to administrators,
+            # clients cannot compute gravatars, so we force-set it to false.
+            # If we plumbed the current user's role, we could allow client_gravatar=True
+            # here if the current user's role has access to the target user's email address.
+            client_gravatar = False
+
+        MessageDict.set_sender_avatar(obj, client_gravatar)
         del obj["sender_realm_id"]
         del obj["sender_avatar_source"]
         del obj["sender_delivery_email"]
@@ -399,7 +633,6 @@ class MessageDict:
         del obj["recipient_type_id"]
         del obj["sender_is_mirror_dummy"]
         del obj["sender_email_address_visibility"]
-        return obj
 
     @staticmethod
     def sew_submessages_and_reactions_to_msgs(
@@ -485,12 +718,15 @@ class MessageDict:
         return MessageDict.sew_submessages_and_reactions_to_msgs(messages)
 
     @staticmethod
-    def build_dict_from_raw_db_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    def build_dict_from_raw_db_row(
+        row: Dict[str, Any], allow_stale_rendered_content: bool = False
+    ) -> Dict[str, Any]:
         """
         row is a row from a .values() call, and it needs to have
         all the relevant fields populated
         """
         return MessageDict.build_message_dict(
+            allow_stale_rendered_content=allow_stale_rendered_content,
             message_id=row["id"],
             last_edit_time=row["last_edit_time"],
             edit_history_json=row["edit_history"],
@@ -529,6 +765,7 @@ class MessageDict:
         recipient_type_id: int,
         reactions: List[RawReactionRow],
         submessages: List[Dict[str, Any]],
+        allow_stale_rendered_content: bool = False,
     ) -> Dict[str, Any]:
         obj = dict(
             id=message_id,
@@ -557,7 +794,7 @@ class MessageDict:
 
         if Message.need_to_render_content(
             rendered_content, rendered_content_version, markdown_version
-        ):
+        ) and not (allow_stale_rendered_content and rendered_content is not None):
             # We really shouldn't be rendering objects in this method, but there is
             # a scenario where we upgrade the version of Markdown and fail to run
             # management commands to re-render historical messages, and then we
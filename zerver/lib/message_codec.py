@@ -0,0 +1,174 @@
+"""Compression codecs for the message to_dict cache.
+
+Short chat messages compress poorly on their own, since most of what
+zlib could exploit is repetition across messages: the JSON keys of
+the message dict and the HTML generated by the Markdown processor.
+We therefore compress with a preset dictionary of that boilerplate.
+
+Each cached message starts with a byte identifying the codec it was
+compressed with, so that messages cached by an older version of the
+server can still be read after we change the default codec.  The
+dictionary of an existing codec version must therefore never change;
+add a new version instead.
+"""
+
+import zlib
+from typing import Dict, List
+
+import orjson
+
+# Snippets of HTML from rendered messages, roughly from least to
+# most common, since zlib can encode references to the end of the
+# dictionary more cheaply.
+MESSAGE_HTML_SNIPPETS_V1 = [
+    '<div class="spoiler-block"><div class="spoiler-header">\n</div><div class="spoiler-content" aria-hidden="true">\n',
+    '<div class="message_embed"><a class="message_embed_image" href="',
+    '<div class="message_embed_description">',
+    '<div class="message_embed_title"><a href="',
+    '<div class="youtube-video message_inline_image"><a data-id="',
+    '<span class="katex"><span class="katex-mathml"><math xmlns="http://www.w3.org/1998/Math/MathML">',
+    '<div class="codehilite" data-code-language="Python"><pre><span></span><code>',
+    '<div class="codehilite"><pre><span></span><code>',
+    "</code></pre></div>",
+    "<table>\n<thead>\n<tr>\n<th>",
+    "</td>\n</tr>\n</tbody>\n</table>",
+    '<span class="timestamp-error">Invalid time format: ',
+    '<time datetime="',
+    '<a class="stream-topic" data-stream-id="',
+    '<a class="stream" data-stream-id="',
+    'href="/#narrow/stream/',
+    '<span class="user-group-mention" data-user-group-id="',
+    '<span class="user-mention silent" data-user-id="',
+    '<span class="user-mention" data-user-id="',
+    '<div class="message_inline_image"><a href="/user_uploads/',
+    '<img data-original-dimensions="',
+    'src="/user_uploads/thumbnail/',
+    '<a href="/user_uploads/',
+    "<ol>\n<li>",
+    "</li>\n</ol>",
+    "<ul>\n<li>",
+    "</li>\n<li>",
+    "</li>\n</ul>",
+    "<blockquote>\n<p>",
+    "</p>\n</blockquote>",
+    '<span aria-label="',
+    '" class="emoji emoji-',
+    '" role="img" title="',
+    "</span>",
+    "<strong>",
+    "</strong>",
+    "<em>",
+    "</em>",
+    "<code>",
+    "</code>",
+    "<br>\n",
+    '<a href="https://',
+    '">https://',
+    "</a>",
+    "</p>\n<p>",
+    "<p>",
+    "</p>",
+]
+
+# The keys of a message dict, as serialized by
+# zerver.lib.message.message_dict_to_fragments.
+MESSAGE_FIELD_SNIPPETS_V1 = [
+    '{"prev_stream":',
+    ',"stream":',
+    ',"prev_topic":"',
+    '","topic":"',
+    '{"prev_content":"',
+    '","prev_rendered_content":"',
+    '","prev_rendered_content_version":1,',
+    '{"user_id":',
+    ',"timestamp":',
+    '"submessages":[{"msg_type":"widget","content":"',
+    '","sender_id":',
+    ',"id":',
+    ',"message_id":',
+    '"reactions":[{"emoji_name":"',
+    '","emoji_code":"',
+    '","reaction_type":"unicode_emoji","user":{"email":"',
+    '","id":',
+    ',"full_name":"',
+    '"},"user_id":',
+    '},{"emoji_name":"',
+    '"last_edit_timestamp":',
+    ',"edit_history":[',
+    '\x00"sender_id":',
+    ',"sender_realm_id":',
+    ',"recipient_id":',
+    ',"recipient_type":1,"recipient_type_id":',
+    ',"recipient_type":2,"recipient_type_id":',
+    ',"recipient_type":3,"recipient_type_id":',
+    '{"id":',
+    ',"timestamp":',
+    ',"client":"website","subject":"',
+    '","topic_links":[],',
+    '"is_me_message":false,"reactions":[],"submessages":[]',
+]
+
+
+# Messages cached before we added the version byte were compressed
+# with zlib.compress, whose output always starts with this byte.
+LEGACY_ZLIB_HEADER = 0x78
+
+
+def build_dictionary(html_snippets: List[str], field_snippets: List[str]) -> bytes:
+    # The HTML is stored in JSON strings, so we escape it the same way.
+    html = b"".join(orjson.dumps(snippet)[1:-1] for snippet in html_snippets)
+    fields = "".join(field_snippets).encode()
+    return html + fields
+
+
+class MessageCodec:
+    """Compresses with raw deflate, which omits the zlib header and
+    checksum, optionally with a preset dictionary.
+
+    Messages are small, so we use a smaller window and less memory for
+    the compressor than zlib's defaults; most of the time spent
+    compressing a short message otherwise goes to setting up the
+    compressor's state."""
+
+    def __init__(
+        self, version: int, zdict: bytes = b"", level: int = 6, window_bits: int = 13
+    ) -> None:
+        assert 0 < version < LEGACY_ZLIB_HEADER
+        # The dictionary must fit in the window, with room to spare.
+        assert len(zdict) <= 2 ** (window_bits - 1)
+        self.version = version
+        self.header = bytes([version])
+        self.zdict = zdict
+        self.level = level
+        self.window_bits = window_bits
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(
+            self.level, zlib.DEFLATED, -self.window_bits, 8, zlib.Z_DEFAULT_STRATEGY, self.zdict
+        )
+        return self.header + compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        decompressor = zlib.decompressobj(-self.window_bits, self.zdict)
+        return decompressor.decompress(memoryview(data)[1:]) + decompressor.flush()
+
+
+ZLIB_CODEC = MessageCodec(1)
+DICTIONARY_CODEC_V1 = MessageCodec(
+    2, zdict=build_dictionary(MESSAGE_HTML_SNIPPETS_V1, MESSAGE_FIELD_SNIPPETS_V1)
+)
+
+MESSAGE_CODECS: Dict[int, MessageCodec] = {
+    codec.version: codec for codec in [ZLIB_CODEC, DICTIONARY_CODEC_V1]
+}
+message_codec = DICTIONARY_CODEC_V1
+
+
+def compress_message(data: bytes) -> bytes:
+    return message_codec.compress(data)
+
+
+def decompress_message(data: bytes) -> bytes:
+    if data[0] == LEGACY_ZLIB_HEADER:
+        return zlib.decompress(data)
+    return MESSAGE_CODECS[data[0]].decompress(data)
@@ -1,11 +1,14 @@
 import datetime
+import itertools
 import time
 from collections import defaultdict
-from typing import Any, Dict, Mapping, Optional, Sequence, Set
+from dataclasses import dataclass
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Set, Tuple
 
 from django.conf import settings
 from django.utils.timezone import now as timezone_now
 
+from zerver.lib.cache import cache_get, cache_set, realm_presence_snapshot_cache_key
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.models import PushDeviceToken, Realm, UserPresence, UserProfile, query_for_ids
 
@@ -150,22 +153,32 @@ def get_presence_for_user(
     return get_presence_dicts_for_rows(presence_rows, mobile_user_ids, slim_presence)
 
 
-def get_presence_dict_by_realm(
-    realm_id: int, slim_presence: bool = False
-) -> Dict[str, Dict[str, Any]]:
+@dataclass
+class PresenceSnapshot:
+    # Sorted by last_update_id.
+    rows: List[Dict[str, Any]]
+    mobile_user_ids: Set[int]
+
+
+def fetch_presence_snapshot(realm_id: int) -> PresenceSnapshot:
     two_weeks_ago = timezone_now() - datetime.timedelta(weeks=2)
-    query = UserPresence.objects.filter(
-        realm_id=realm_id,
-        last_connected_time__gte=two_weeks_ago,
-        user_profile__is_active=True,
-        user_profile__is_bot=False,
-    ).values(
-        "last_active_time",
-        "last_connected_time",
-        "user_profile__email",
-        "user_profile_id",
-        "user_profile__enable_offline_push_notifications",
-        "user_profile__date_joined",
+    query = (
+        UserPresence.objects.filter(
+            realm_id=realm_id,
+            last_connected_time__gte=two_weeks_ago,
+            user_profile__is_active=True,
+            user_profile__is_bot=False,
+        )
+        .values(
+            "last_active_time",
+            "last_connected_time",
+            "last_update_id",
+            "user_profile__email",
+            "user_profile_id",
+            "user_profile__enable_offline_push_notifications",
+            "user_profile__date_joined",
+        )
+        .order_by("last_update_id")
     )
 
     presence_rows = list(query)
@@ -183,7 +196,7 @@ def get_presence_dict_by_realm(
         # It's not clear this condition is actually possible,
         # though, because it shouldn't be possible to end up with
         # a realm with 0 active users.
-        return {}
+        return PresenceSnapshot(rows=[], mobile_user_ids=set())
 
     mobile_query_ids = query_for_ids(
         query=mobile_query,
@@ -192,7 +205,31 @@ def get_presence_dict_by_realm(
     )
     mobile_user_ids = set(mobile_query_ids)
 
-    return get_presence_dicts_for_rows(presence_rows, mobile_user_ids, slim_presence)
+    return PresenceSnapshot(rows=presence_rows, mobile_user_ids=mobile_user_ids)
+
+
+def get_presence_snapshot(realm_id: int) -> PresenceSnapshot:
+    """Every client in a realm polls for the presence of the whole
+    realm about once a minute, so we share a snapshot of the realm's
+    presence between all of them, for PRESENCE_SNAPSHOT_CACHE_SECONDS.
+    Presence is only precise to about a minute anyway."""
+    if settings.PRESENCE_SNAPSHOT_CACHE_SECONDS == 0:
+        return fetch_presence_snapshot(realm_id)
+
+    cache_key = realm_presence_snapshot_cache_key(realm_id)
+    cached = cache_get(cache_key)
+    if cached is not None:
+        return cached[0]
+    snapshot = fetch_presence_snapshot(realm_id)
+    cache_set(cache_key, snapshot, timeout=settings.PRESENCE_SNAPSHOT_CACHE_SECONDS)
+    return snapshot
+
+
+def get_presence_dict_by_realm(
+    realm_id: int, slim_presence: bool = False
+) -> Dict[str, Dict[str, Any]]:
+    snapshot = fetch_presence_snapshot(realm_id)
+    return get_presence_dicts_for_rows(snapshot.rows, snapshot.mobile_user_ids, slim_presence)
 
 
 def get_presences_for_realm(
@@ -202,13 +239,53 @@ def get_presences_for_realm(
         # Return an empty dict if presence is disabled in this realm
         return defaultdict(dict)
 
-    return get_presence_dict_by_realm(realm.id, slim_presence)
+    snapshot = get_presence_snapshot(realm.id)
+    return get_presence_dicts_for_rows(snapshot.rows, snapshot.mobile_user_ids, slim_presence)
+
+
+def get_presence_changes_for_realm(
+    realm: Realm, slim_presence: bool, last_update_id: int
+) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """Returns the presence of just the users whose presence changed
+    after last_update_id, and the update id to pass next time.
+
+    Users are never removed from the client's data this way: those
+    deactivated, or who drop out of the two-week window, are just no
+    longer included, and clients rely on their presence timestamps
+    (and on deactivation events) instead.  Disabling presence_enabled
+    gives the user's presence a new update ID, with timestamps old
+    enough to show them as offline, so that it is included here."""
+    if realm.presence_disabled:
+        return {}, last_update_id
+
+    snapshot = get_presence_snapshot(realm.id)
+    changed_rows = list(
+        itertools.takewhile(
+            lambda row: row["last_update_id"] > last_update_id, reversed(snapshot.rows)
+        )
+    )
+    if changed_rows:
+        last_update_id = changed_rows[0]["last_update_id"]
+    presences = get_presence_dicts_for_rows(changed_rows, snapshot.mobile_user_ids, slim_presence)
+    return presences, last_update_id
 
 
 def get_presence_response(
-    requesting_user_profile: UserProfile, slim_presence: bool
+    requesting_user_profile: UserProfile,
+    slim_presence: bool,
+    last_update_id: Optional[int] = None,
 ) -> Dict[str, Any]:
     realm = requesting_user_profile.realm
     server_timestamp = time.time()
-    presences = get_presences_for_realm(realm, slim_presence)
-    return dict(presences=presences, server_timestamp=server_timestamp)
+    if last_update_id is None:
+        presences = get_presences_for_realm(realm, slim_presence)
+        return dict(presences=presences, server_timestamp=server_timestamp)
+
+    presences, presence_last_update_id = get_presence_changes_for_realm(
+        realm, slim_presence, last_update_id
+    )
+    return dict(
+        presences=presences,
+        server_timestamp=server_timestamp,
+        presence_last_update_id=presence_last_update_id,
+    )
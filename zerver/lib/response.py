@@ -6,6 +6,15 @@ from django.http import HttpRequest, HttpResponse, HttpResponseNotAllowed
 from zerver.lib.exceptions import JsonableError, UnauthorizedError
 
 
+class JsonFragment:
+    """Already serialized JSON, which MutableJsonResponse includes in
+    the response as is.  Only supported as a top-level value in the
+    response data."""
+
+    def __init__(self, value: bytes) -> None:
+        self.value = value
+
+
 class MutableJsonResponse(HttpResponse):
     def __init__(
         self,
@@ -45,10 +54,26 @@ class MutableJsonResponse(HttpResponse):
             # Because we don't pass a default handler, OPT_PASSTHROUGH_DATETIME
             # actually causes orjson to raise a TypeError on datetime objects. This
             # helps us avoid relying on the particular serialization used by orjson.
-            self.content = orjson.dumps(
-                self._data,
+            data = {
+                key: value
+                for key, value in self._data.items()
+                if not isinstance(value, JsonFragment)
+            }
+            content = orjson.dumps(
+                data,
                 option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_PASSTHROUGH_DATETIME,
             )
+            if len(data) < len(self._data):
+                # Splice the fragments in before the closing brace.
+                parts = [content[: -len(b"}\n")]]
+                for key, value in self._data.items():
+                    if isinstance(value, JsonFragment):
+                        if len(parts) > 1 or data:
+                            parts.append(b",")
+                        parts += [orjson.dumps(key), b":", value.value]
+                parts.append(b"}\n")
+                content = b"".join(parts)
+            self.content = content
         return super().content
 
     # There are two ways this might be called. The first is in the getter when
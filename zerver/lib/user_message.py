@@ -1,3 +1,5 @@
+import io
+import struct
 from typing import List
 
 from django.db import connection
@@ -23,16 +25,36 @@ class UserMessageLite:
         return UserMessage.flags_list_for_flags(self.flags)
 
 
+# Above this many rows, bulk_insert_ums uses COPY rather than INSERT.
+BULK_INSERT_UMS_COPY_THRESHOLD = 1000
+
+# PostgreSQL's binary COPY format: a fixed header, then for each row
+# the number of fields, and each field's length and value; see
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+# user_profile_id (integer), message_id (integer), flags (bigint)
+USER_MESSAGE_ROW = struct.Struct("!hiiiiiq")
+
+
 def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     """
     Doing bulk inserts this way is much faster than using Django,
     since we don't have any ORM overhead.  Profiling with 1000
     users shows a speedup of 0.436 -> 0.027 seconds, so we're
     talking about a 15x speedup.
+
+    For messages to large streams, we stream the rows to PostgreSQL
+    with a binary COPY, which avoids building and parsing a huge
+    INSERT statement.
     """
     if not ums:
         return
 
+    if len(ums) > BULK_INSERT_UMS_COPY_THRESHOLD:
+        copy_insert_ums(ums)
+        return
+
     vals = [(um.user_profile_id, um.message_id, um.flags) for um in ums]
     query = SQL(
         """
@@ -44,3 +66,20 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
 
     with connection.cursor() as cursor:
         execute_values(cursor.cursor, query, vals)
+
+
+def copy_insert_ums(ums: List[UserMessageLite]) -> None:
+    pack = USER_MESSAGE_ROW.pack
+    data = io.BytesIO()
+    data.write(PGCOPY_HEADER)
+    for um in ums:
+        data.write(pack(3, 4, um.user_profile_id, 4, um.message_id, 8, int(um.flags)))
+    data.write(PGCOPY_TRAILER)
+    data.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert(
+            "COPY zerver_usermessage (user_profile_id, message_id, flags)"
+            " FROM STDIN WITH (FORMAT binary)",
+            data,
+        )
@@ -8,6 +8,7 @@ from django.utils.timezone import now as timezone_now
 from sqlalchemy.sql import ClauseElement, and_, column, not_, or_
 from sqlalchemy.types import Integer
 
+from zerver.lib.cache import flush_stream_recipient_info
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.topic import topic_match_sa
 from zerver.lib.types import UserTopicDict
@@ -86,10 +87,12 @@ def set_topic_visibility_policy(
     This is only used in tests.
     """
 
-    UserTopic.objects.filter(
+    rows = UserTopic.objects.filter(
         user_profile=user_profile,
         visibility_policy=visibility_policy,
-    ).delete()
+    )
+    flush_stream_recipient_info({row.stream_id for row in rows})
+    rows.delete()
 
     if last_updated is None:
         last_updated = timezone_now()
@@ -120,6 +123,7 @@ def bulk_set_user_topic_visibility_policy_in_database(
 ) -> List[UserProfile]:
     # returns the list of user_profiles whose user_topic row
     # is either deleted, updated, or created.
+    flush_stream_recipient_info([stream_id])
     rows = UserTopic.objects.filter(
         user_profile__in=user_profiles,
         stream_id=stream_id,
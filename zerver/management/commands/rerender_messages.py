@@ -0,0 +1,137 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, List, Set, Tuple
+
+import bmemcached
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import CommandError, CommandParser
+from django.db import connection
+from django.db.models import Q, QuerySet
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.markdown import version as markdown_version
+from zerver.lib.message import rerender_messages
+from zerver.models import Message
+
+
+def stale_messages() -> QuerySet[Message]:
+    return Message.objects.filter(
+        Q(rendered_content=None)
+        | Q(rendered_content_version=None)
+        | Q(rendered_content_version__lt=markdown_version)
+    )
+
+
+def rerender_message_range(first_id: int, last_id: int, batch_size: int) -> int:
+    message_ids = list(
+        stale_messages()
+        .filter(id__gte=first_id, id__lte=last_id)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+    count = 0
+    for i in range(0, len(message_ids), batch_size):
+        count += rerender_messages(message_ids[i : i + batch_size])
+    return count
+
+
+class Command(ZulipBaseCommand):
+    help = """Re-render messages whose rendered content is missing or from an
+older version of the Markdown processor, in message ID order.
+
+Messages are split into chunks of --chunk-size stale messages, which
+are re-rendered by --processes processes in parallel.  Progress is
+printed as chunks complete, with the --start-id to resume from if the
+command is interrupted; already re-rendered messages are skipped in
+any case.
+
+Messages fetched by clients before this completes are re-rendered in
+the background by the rerender_messages queue worker."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--start-id", default=0, type=int, help="Only re-render messages with this ID or later"
+        )
+        parser.add_argument(
+            "--chunk-size", default=5000, type=int, help="Number of messages in each chunk"
+        )
+        parser.add_argument(
+            "--batch-size",
+            default=500,
+            type=int,
+            help="Number of messages saved in each database update",
+        )
+        parser.add_argument(
+            "--processes",
+            default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
+            type=int,
+            help="Processes to use for rendering in parallel",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        num_processes = options["processes"]
+        if num_processes < 1:
+            raise CommandError("You must have at least one process.")
+        chunk_size = options["chunk_size"]
+        batch_size = options["batch_size"]
+
+        # We first split the stale messages into chunks by ID, so
+        # that the parent process is done with the database before
+        # forking.
+        chunks: List[Tuple[int, int]] = []
+        chunk_ids: List[int] = []
+        for message_id in (
+            stale_messages()
+            .filter(id__gte=options["start_id"])
+            .order_by("id")
+            .values_list("id", flat=True)
+            .iterator()
+        ):
+            chunk_ids.append(message_id)
+            if len(chunk_ids) == chunk_size:
+                chunks.append((chunk_ids[0], chunk_ids[-1]))
+                chunk_ids = []
+        if chunk_ids:
+            chunks.append((chunk_ids[0], chunk_ids[-1]))
+        if not chunks:
+            print("No messages need to be re-rendered.")
+            return
+        print(f"Re-rendering messages {chunks[0][0]} to {chunks[-1][1]} in {len(chunks)} chunks")
+
+        start = time.perf_counter()
+        total = 0
+        # Chunks can complete out of order; we can only resume after
+        # the last chunk which completed along with all before it.
+        completed: Set[int] = set()
+        next_chunk = 0
+
+        def chunk_completed(index: int, count: int) -> None:
+            nonlocal total, next_chunk
+            total += count
+            completed.add(index)
+            while next_chunk in completed:
+                next_chunk += 1
+            duration = time.perf_counter() - start
+            message = f"Re-rendered {total} messages ({total / duration:.1f}/sec)"
+            if next_chunk < len(chunks):
+                message += f"; resume with --start-id={chunks[next_chunk][0]}"
+            print(message, flush=True)
+
+        if num_processes == 1:
+            for index, (first_id, last_id) in enumerate(chunks):
+                chunk_completed(index, rerender_message_range(first_id, last_id, batch_size))
+        else:  # nocoverage
+            connection.close()
+            _cache = cache._cache  # type: ignore[attr-defined] # not in stubs
+            assert isinstance(_cache, bmemcached.Client)
+            _cache.disconnect_all()
+            with ProcessPoolExecutor(max_workers=num_processes) as executor:
+                futures = {
+                    executor.submit(rerender_message_range, first_id, last_id, batch_size): index
+                    for index, (first_id, last_id) in enumerate(chunks)
+                }
+                for future in as_completed(futures):
+                    chunk_completed(futures[future], future.result())
+
+        print("Done.")
@@ -122,8 +122,10 @@ class Command(BaseCommand):
                 from zerver.tornado.ioloop_logging import logging_data
 
                 logging_data["port"] = str(port)
-                await setup_event_queue(http_server, port)
+                # Registered before loading the event queues, so that
+                # shutting down while they're loading still saves them.
                 stack.callback(dump_event_queues, port)
+                await setup_event_queue(http_server, port)
                 add_client_gc_hook(missedmessage_hook)
                 if settings.USING_RABBITMQ:
                     setup_tornado_rabbitmq(queue_client)
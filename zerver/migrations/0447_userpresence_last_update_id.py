@@ -0,0 +1,42 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("zerver", "0446_realmauditlog_zerver_realmauditlog_user_subscriptions_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PresenceSequence",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("last_update_id", models.PositiveBigIntegerField()),
+                (
+                    "realm",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE, to="zerver.realm"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="userpresence",
+            name="last_update_id",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name="userpresence",
+            index_together={
+                ("realm", "last_active_time"),
+                ("realm", "last_connected_time"),
+                ("realm", "last_update_id"),
+            },
+        ),
+    ]
@@ -67,16 +67,19 @@ from zerver.lib.cache import (
     flush_message,
     flush_muting_users_cache,
     flush_realm,
+    flush_realm_alert_words_version,
     flush_stream,
     flush_submessage,
+    flush_subscription,
     flush_used_upload_space_cache,
     flush_user_profile,
+    flush_user_recipient_info,
     get_realm_used_upload_space_cache_key,
     get_stream_cache_key,
-    realm_alert_words_automaton_cache_key,
     realm_alert_words_cache_key,
     realm_user_dict_fields,
     realm_user_dicts_cache_key,
+    sync_local_cache,
     user_profile_by_api_key_cache_key,
     user_profile_by_id_cache_key,
     user_profile_cache_key,
@@ -1380,6 +1383,7 @@ def flush_per_request_caches() -> None:
     per_request_display_recipient_cache = {}
     global per_request_linkifiers_cache
     per_request_linkifiers_cache = {}
+    sync_local_cache()
 
 
 class RealmPlayground(models.Model):
@@ -3797,6 +3801,10 @@ class Subscription(models.Model):
     ]
 
 
+post_save.connect(flush_subscription, sender=Subscription)
+post_delete.connect(flush_subscription, sender=Subscription)
+
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600 * 24 * 7)
 def get_user_profile_by_id(user_profile_id: int) -> UserProfile:
     return UserProfile.objects.select_related().get(id=user_profile_id)
@@ -4128,6 +4136,11 @@ class UserPresence(models.Model):
     # interacting with a computer running the desktop app)
     last_active_time = models.DateTimeField(default=timezone_now, db_index=True, null=True)
 
+    # The value of the realm's PresenceSequence when this row was last
+    # changed; clients polling for presence pass the largest one they
+    # have seen, to only receive the rows which have changed since.
+    last_update_id = models.PositiveBigIntegerField(default=0)
+
     # The following constants are used in the presence API for
     # communicating whether a user is active (last_active_time recent)
     # or idle (last_connected_time recent) or offline (neither
@@ -4141,6 +4154,7 @@ class UserPresence(models.Model):
         index_together = [
             ("realm", "last_active_time"),
             ("realm", "last_connected_time"),
+            ("realm", "last_update_id"),
         ]
 
     @staticmethod
@@ -4153,6 +4167,20 @@ class UserPresence(models.Model):
         return None
 
 
+class PresenceSequence(models.Model):
+    """The last UserPresence.last_update_id allocated in each realm.
+
+    Writers of UserPresence rows lock their realm's row here, while
+    allocating update ids, until their transaction commits.  The
+    changes in a realm are thus committed in the order of their
+    update ids, so a client which has seen a given update id has
+    also seen every change before it.
+    """
+
+    realm = models.OneToOneField(Realm, on_delete=CASCADE)
+    last_update_id = models.PositiveBigIntegerField()
+
+
 class UserStatus(AbstractEmoji):
     user_profile = models.OneToOneField(UserProfile, on_delete=CASCADE)
 
@@ -4843,12 +4871,15 @@ class AlertWord(models.Model):
 
 def flush_realm_alert_words(realm: Realm) -> None:
     cache_delete(realm_alert_words_cache_key(realm))
-    cache_delete(realm_alert_words_automaton_cache_key(realm))
+    flush_realm_alert_words_version(realm.id)
 
 
 def flush_alert_word(*, instance: AlertWord, **kwargs: object) -> None:
     realm = instance.realm
     flush_realm_alert_words(realm)
+    # Which long-term idle users get_recipient_info considers depends
+    # on whether they have alert words.
+    flush_user_recipient_info(instance.user_profile_id)
 
 
 post_save.connect(flush_alert_word, sender=AlertWord)
@@ -1,7 +1,14 @@
+from unittest import mock
+
 import orjson
 
 from zerver.actions.alert_words import do_add_alert_words, do_remove_alert_words
-from zerver.lib.alert_words import alert_words_in_realm, user_alert_words
+from zerver.lib.alert_words import (
+    alert_words_in_realm,
+    build_alert_word_automaton,
+    get_alert_word_automaton,
+    user_alert_words,
+)
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import most_recent_message, most_recent_usermessage
 from zerver.models import AlertWord, UserProfile
@@ -111,6 +118,30 @@ class AlertWordTests(ZulipTestCase):
         self.assertEqual(set(realm_words[user1.id]), set(self.interesting_alert_word_list))
         self.assertEqual(set(realm_words[user2.id]), {"another"})
 
+    def test_alert_word_automaton(self) -> None:
+        AlertWord.objects.all().delete()
+        user = self.get_user()
+        self.assertIsNone(get_alert_word_automaton(user.realm))
+
+        do_add_alert_words(user, ["one", "two"])
+        automaton = get_alert_word_automaton(user.realm)
+        assert automaton is not None
+        self.assertEqual(set(automaton.keys()), {"one", "two"})
+
+        # The automaton is kept in the process until the realm's alert
+        # words change, so later messages only check the version.
+        with mock.patch(
+            "zerver.lib.alert_words.build_alert_word_automaton",
+            wraps=build_alert_word_automaton,
+        ) as m, self.assert_database_query_count(0):
+            self.assertIs(get_alert_word_automaton(user.realm), automaton)
+        m.assert_not_called()
+
+        do_remove_alert_words(user, ["one"])
+        automaton = get_alert_word_automaton(user.realm)
+        assert automaton is not None
+        self.assertEqual(set(automaton.keys()), {"two"})
+
     def test_json_list_default(self) -> None:
         user = self.get_user()
         self.login_user(user)
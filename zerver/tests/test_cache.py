@@ -1,12 +1,18 @@
+import time
 from typing import Dict, List, Optional
 from unittest.mock import Mock, patch
 
 from django.conf import settings
+from django.test import override_settings
 
+from zerver.actions.realm_settings import do_set_realm_property
 from zerver.apps import flush_cache
+from zerver.lib import cache
 from zerver.lib.cache import (
+    LOCAL_CACHE_INVALIDATION_SEQUENCE_KEY,
     MEMCACHED_MAX_KEY_LENGTH,
     InvalidCacheKeyError,
+    LocalCachePolicy,
     bulk_cached_fetch,
     cache_delete,
     cache_delete_many,
@@ -15,11 +21,17 @@ from zerver.lib.cache import (
     cache_set,
     cache_set_many,
     cache_with_key,
+    get_cache_backend,
+    get_local_cache_stats,
+    get_remote_cache_requests,
+    local_cache_invalidation_cache_key,
     safe_cache_get_many,
     safe_cache_set_many,
+    sync_local_cache,
     user_profile_by_id_cache_key,
     validate_cache_key,
 )
+from zerver.lib.realm_description import get_realm_rendered_description
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.models import UserProfile, get_realm, get_system_bot, get_user, get_user_profile_by_id
 
@@ -299,3 +311,93 @@ class GenericBulkCachedFetchTest(ZulipTestCase):
             id_fetcher=get_user_email,
         )
         self.assertEqual(result, {})
+
+
+class LocalCacheTest(ZulipTestCase):
+    # Syncs only happen when we ask for them.
+    @patch.object(cache, "LOCAL_CACHE_SYNC_INTERVAL", 3600)
+    @override_settings(PROCESS_LOCAL_CACHE=True)
+    def test_local_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        key = user_profile_by_id_cache_key(hamlet.id)
+
+        def stats() -> Dict[str, int]:
+            return get_local_cache_stats().get("user_profile_by_id", {})
+
+        sync_local_cache()
+        cache_delete(key)
+        # Filling the missing key does not publish an invalidation.
+        cache_backend = get_cache_backend(None)
+        sequence_key = cache.KEY_PREFIX + LOCAL_CACHE_INVALIDATION_SEQUENCE_KEY
+        sequence = cache_backend.get(sequence_key)
+        get_user_profile_by_id(hamlet.id)
+        self.assertEqual(cache_backend.get(sequence_key), sequence)
+
+        # Later fetches are served from the local cache, as separate
+        # copies of the object.
+        old_stats = stats()
+        remote_cache_requests = get_remote_cache_requests()
+        user = get_user_profile_by_id(hamlet.id)
+        self.assertEqual(user, hamlet)
+        self.assertIsNot(user, get_user_profile_by_id(hamlet.id))
+        self.assertEqual(get_remote_cache_requests(), remote_cache_requests)
+        self.assertEqual(stats()["hits"], old_stats.get("hits", 0) + 2)
+
+        # Saving the user drops the local copy in this process.
+        hamlet.full_name = "Prince Hamlet"
+        hamlet.save(update_fields=["full_name"])
+        self.assertEqual(get_user_profile_by_id(hamlet.id).full_name, "Prince Hamlet")
+
+        # Invalidations from other processes are applied on the next sync.
+        sequence = cache_backend.incr(sequence_key)
+        cache_backend.set(cache.KEY_PREFIX + local_cache_invalidation_cache_key(sequence), [key])
+        old_stats = stats()
+        get_user_profile_by_id(hamlet.id)
+        self.assertEqual(stats()["hits"], old_stats["hits"] + 1)
+        sync_local_cache()
+        remote_cache_requests = get_remote_cache_requests()
+        get_user_profile_by_id(hamlet.id)
+        self.assertEqual(stats()["misses"], old_stats["misses"] + 1)
+        self.assertEqual(get_remote_cache_requests(), remote_cache_requests + 1)
+
+        # If an invalidation is missing, the whole local cache is cleared.
+        cache_backend.incr(sequence_key)
+        sync_local_cache()
+        self.assertNotIn(key, cache.local_cache_entries["user_profile_by_id"])
+
+        # Entries are evicted in LRU order, and expire after the TTL.
+        get_user_profile_by_id(hamlet.id)
+        old_stats = stats()
+        with patch.dict(
+            cache.local_cache_policies,
+            {"user_profile_by_id": LocalCachePolicy(max_entries=1, ttl=300)},
+        ):
+            get_user_profile_by_id(othello.id)
+            self.assertEqual(stats()["evictions"], old_stats.get("evictions", 0) + 1)
+            self.assertEqual(
+                list(cache.local_cache_entries["user_profile_by_id"]),
+                [user_profile_by_id_cache_key(othello.id)],
+            )
+
+            with patch("time.monotonic", return_value=time.monotonic() + 301):
+                get_user_profile_by_id(othello.id)
+            self.assertEqual(stats()["misses"], old_stats["misses"] + 2)
+
+    @patch.object(cache, "LOCAL_CACHE_SYNC_INTERVAL", 3600)
+    @override_settings(PROCESS_LOCAL_CACHE=True)
+    def test_local_cache_realm(self) -> None:
+        realm = get_realm("zulip")
+
+        def hits() -> int:
+            return get_local_cache_stats().get("realm_rendered_description", {}).get("hits", 0)
+
+        sync_local_cache()
+        get_realm_rendered_description(realm)
+        old_hits = hits()
+        get_realm_rendered_description(realm)
+        self.assertEqual(hits(), old_hits + 1)
+
+        # flush_realm drops the local copy.
+        do_set_realm_property(realm, "description", "New description", acting_user=None)
+        self.assertEqual(get_realm_rendered_description(realm), "<p>New description</p>")
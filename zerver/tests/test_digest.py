@@ -11,8 +11,10 @@ from zerver.actions.create_user import do_create_user
 from zerver.actions.realm_settings import do_set_realm_property
 from zerver.actions.users import do_deactivate_user
 from zerver.lib.digest import (
+    DigestSnapshotCache,
     DigestTopic,
     _enqueue_emails_for_realm,
+    bulk_get_digest_context,
     bulk_handle_digest_email,
     bulk_write_realm_audit_logs,
     enqueue_emails,
@@ -20,6 +22,8 @@ from zerver.lib.digest import (
     get_hot_topics,
     get_modified_streams,
     get_recent_streams,
+    get_recent_topics,
+    get_user_stream_map,
 )
 from zerver.lib.message import get_last_message_id
 from zerver.lib.streams import create_stream_if_needed
@@ -241,6 +245,91 @@ class TestDigestEmailMessages(ZulipTestCase):
             (log,) = log_rows
             self.assertEqual(log.event_last_message_id, last_message_id)
 
+    def test_digest_snapshot_shared_between_chunks(self) -> None:
+        one_day_ago = timezone_now() - datetime.timedelta(days=1)
+        Message.objects.all().update(date_sent=one_day_ago)
+
+        digest_users = [self.example_user("othello"), self.example_user("polonius")]
+        for digest_user in digest_users:
+            for stream in ["Verona", "Denmark"]:
+                self.subscribe(digest_user, stream)
+        self.subscribe(digest_users[0], "Scotland")
+
+        # Topics of varying length and diversity, more than a digest
+        # includes in each stream.
+        senders = ["hamlet", "cordelia", "iago", "prospero", "ZOE"]
+        for stream, topic_count in [("Denmark", 6), ("Verona", 2), ("Scotland", 5)]:
+            for sender_name in senders:
+                self.subscribe(self.example_user(sender_name), stream)
+            for i in range(topic_count):
+                for sender_name in senders[: i % len(senders) + 1]:
+                    for j in range(i % 3 + 1):
+                        self.send_stream_message(
+                            self.example_user(sender_name),
+                            stream,
+                            topic_name=f"topic {i}",
+                            sending_client_name="website",
+                        )
+
+        RealmAuditLog.objects.all().delete()
+
+        one_hour_ago = timezone_now() - datetime.timedelta(seconds=3600)
+        cutoff = time.mktime(one_hour_ago.timetuple())
+        cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=datetime.timezone.utc)
+
+        snapshot_cache = DigestSnapshotCache()
+        with mock.patch(
+            "zerver.lib.digest.get_recent_topics", wraps=get_recent_topics
+        ) as recent_topics_mock, self.assertLogs("zerver.lib.digest", level="INFO") as info_logs:
+            contexts = [
+                bulk_get_digest_context([digest_user], cutoff, snapshot_cache)[digest_user.id]
+                for digest_user in digest_users
+            ]
+        # The second chunk reused the first one's snapshot.
+        self.assertEqual(recent_topics_mock.call_count, 1)
+        self.assertEqual(snapshot_cache.reuse_count, 1)
+        self.assertTrue(
+            info_logs.output[0].startswith(
+                f"INFO:zerver.lib.digest:Reused digest snapshot for realm {digest_users[0].realm_id} (1 reuses, "
+            )
+        )
+
+        # Without a cache, we only look at the user's own streams.
+        for digest_user, context in zip(digest_users, contexts):
+            with mock.patch(
+                "zerver.lib.digest.get_recent_topics", wraps=get_recent_topics
+            ) as recent_topics_mock:
+                uncached_context = bulk_get_digest_context([digest_user], cutoff)[digest_user.id]
+            (stream_ids, _), _ = recent_topics_mock.call_args
+            self.assertEqual(set(stream_ids), get_user_stream_map([digest_user.id])[digest_user.id])
+            self.assertEqual(context["hot_conversations"], uncached_context["hot_conversations"])
+            self.assertEqual(context["new_streams"], uncached_context["new_streams"])
+
+        # The snapshot only keeps the topics which could be hot, but
+        # picks the same ones as considering every topic.
+        snapshot = snapshot_cache.snapshot
+        assert snapshot is not None
+        all_topics = get_recent_topics(sorted(snapshot.stream_map), cutoff_date)
+        realm = digest_users[0].realm
+        stream_ids = [get_stream(name, realm).id for name in ["Denmark", "Verona", "Scotland"]]
+        for i in range(1, len(stream_ids) + 1):
+            self.assertEqual(
+                [topic.topic_key for topic in snapshot.get_hot_topics(set(stream_ids[:i]))],
+                [topic.topic_key for topic in get_hot_topics(all_topics, set(stream_ids[:i]))],
+            )
+        self.assert_length(snapshot.topics_by_stream[stream_ids[0]], 4)
+
+        # Snapshots are only reused for the same cutoff, and not once
+        # they are too old.
+        snapshot_cache.get(realm, cutoff_date - datetime.timedelta(days=1))
+        self.assertIsNot(snapshot_cache.snapshot, snapshot)
+        snapshot = snapshot_cache.snapshot
+        assert snapshot is not None
+        snapshot.created -= DigestSnapshotCache.MAX_AGE_SECONDS
+        snapshot_cache.get(realm, cutoff_date - datetime.timedelta(days=1))
+        self.assertIsNot(snapshot_cache.snapshot, snapshot)
+        self.assertEqual(snapshot_cache.reuse_count, 1)
+
     def test_streams_recently_modified_for_user(self) -> None:
         othello = self.example_user("othello")
         cordelia = self.example_user("cordelia")
@@ -1,8 +1,12 @@
+import asyncio
+import os
+import tempfile
 import time
 from typing import Any, Callable, Collection, Dict, List
 from unittest import mock
 
 import orjson
+from asgiref.sync import async_to_sync
 from django.http import HttpRequest, HttpResponse
 
 from zerver.actions.message_send import internal_send_private_message
@@ -17,13 +21,24 @@ from zerver.lib.test_helpers import HostRequestMock, dummy_handler, mock_queue_p
 from zerver.models import Recipient, Subscription, UserProfile, UserTopic, get_stream
 from zerver.tornado.event_queue import (
     ClientDescriptor,
+    QueuedMessageEvent,
     access_client_descriptor,
     allocate_client_descriptor,
+    clear_client_event_queues_for_testing,
+    clients,
+    dump_event_queues,
+    fetch_realm_tornado_ports,
+    gc_event_queues,
+    hand_off_event_queues,
+    load_event_queues,
     maybe_enqueue_notifications,
     missedmessage_hook,
     persistent_queue_filename,
     process_notification,
+    prune_internal_data,
 )
+from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.sharding import get_user_id_tornado_port
 from zerver.tornado.views import cleanup_event_queue, get_events
 
 
@@ -861,6 +876,227 @@ class FileReloadLogicTest(ZulipTestCase):
                 "/home/zulip/tornado/event_queues.9800.last.json",
             )
 
+    def test_dump_and_load_event_queues(self) -> None:
+        clear_client_event_queues_for_testing()
+        hamlet = self.example_user("hamlet")
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        )
+        clients = [allocate_client_descriptor(dict(queue_data)) for i in range(3)]
+        clients[0].event_queue.push(dict(type="other", x=1))
+        expected = {client.event_queue.id: client.to_dict() for client in clients}
+
+        def load_and_check() -> None:
+            clear_client_event_queues_for_testing()
+            with mock.patch(
+                "zerver.tornado.event_queue.EVENT_QUEUE_LOAD_BATCH_SIZE", 2
+            ), self.assertLogs(level="INFO") as logs:
+                async_to_sync(load_event_queues)(9800)
+            self.assertIn("loaded 3 event queues", logs.output[0])
+            self.assertIn("deserialized in 2 batches", logs.output[0])
+            for queue_id, client_dict in expected.items():
+                client = access_client_descriptor(hamlet.id, queue_id)
+                self.assertEqual(client.to_dict(), client_dict)
+
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            with self.assertLogs(level="INFO"):
+                dump_event_queues(9800)
+            with open(persistent_queue_filename(9800), "rb") as f:
+                self.assert_length(f.readlines(), 3)
+            load_and_check()
+
+            # The legacy format is a single JSON list.
+            with open(persistent_queue_filename(9800), "wb") as f:
+                f.write(orjson.dumps(list(expected.items())))
+            load_and_check()
+
+    def test_shutdown_while_loading_event_queues(self) -> None:
+        clear_client_event_queues_for_testing()
+        hamlet = self.example_user("hamlet")
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        )
+        queue_ids = [allocate_client_descriptor(dict(queue_data)).event_queue.id for i in range(3)]
+
+        async def shut_down_while_loading() -> None:
+            load_task = asyncio.ensure_future(load_event_queues(9800))
+            # Let the first batch of queues load, and then receive a
+            # notice, which has to wait for the rest of them.
+            await asyncio.sleep(0)
+            self.assert_length(clients, 1)
+            process_notification(dict(event=dict(type="other", x=1), users=[hamlet.id]))
+            load_task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await load_task
+
+        with tempfile.TemporaryDirectory() as tmpdir, self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(tmpdir, "event_queues%s.json")
+        ):
+            with self.assertLogs(level="INFO"):
+                dump_event_queues(9800)
+            clear_client_event_queues_for_testing()
+            with mock.patch("zerver.tornado.event_queue.EVENT_QUEUE_LOAD_BATCH_SIZE", 1):
+                async_to_sync(shut_down_while_loading)()
+
+            # Every queue was still loaded, and got the notice.
+            with self.assertLogs(level="INFO") as logs:
+                dump_event_queues(9800)
+            self.assertIn("dumped 3 event queues", logs.output[0])
+            clear_client_event_queues_for_testing()
+            with self.assertLogs(level="INFO"):
+                async_to_sync(load_event_queues)(9800)
+            for queue_id in queue_ids:
+                client = access_client_descriptor(hamlet.id, queue_id)
+                self.assertEqual([event["x"] for event in client.event_queue.contents()], [1])
+
+
+class GarbageCollectionTest(ZulipTestCase):
+    def test_gc_event_queues(self) -> None:
+        clear_client_event_queues_for_testing()
+        hamlet = self.example_user("hamlet")
+        now = time.time()
+
+        def allocate(last_connection_time: float) -> ClientDescriptor:
+            return allocate_client_descriptor(
+                dict(
+                    all_public_streams=False,
+                    apply_markdown=True,
+                    client_gravatar=True,
+                    client_type_name="website",
+                    event_types=None,
+                    last_connection_time=last_connection_time,
+                    queue_timeout=600,
+                    realm_id=hamlet.realm_id,
+                    user_profile_id=hamlet.id,
+                )
+            )
+
+        expired = allocate(now - 700)
+        reconnected = allocate(now - 700)
+        reconnected.last_connection_time = now - 10
+        removed = allocate(now - 700)
+        removed.cleanup()
+        active = [allocate(now) for i in range(5)]
+
+        with self.settings(PRODUCTION=True), self.assertLogs(level="INFO") as logs:
+            gc_event_queues(9800)
+        # Only the queues past their original expiration time are
+        # examined; the one removed by cleanup is skipped.
+        self.assertIn("removed 1 expired event queues owned by 1 users in", logs.output[0])
+        self.assertIn("(examined 2, max", logs.output[0])
+        self.assertIn("Now 6 active queues", logs.output[0])
+        with self.assertRaises(BadEventQueueIdError):
+            access_client_descriptor(hamlet.id, expired.event_queue.id)
+        for client in [reconnected, *active]:
+            access_client_descriptor(hamlet.id, client.event_queue.id)
+
+        # The reconnected queue expires once it's idle for queue_timeout.
+        with mock.patch("time.time", return_value=now + 595):
+            gc_event_queues(9800)
+        with self.assertRaises(BadEventQueueIdError):
+            access_client_descriptor(hamlet.id, reconnected.event_queue.id)
+        for client in active:
+            access_client_descriptor(hamlet.id, client.event_queue.id)
+
+
+class ShardingTest(ZulipTestCase):
+    def test_consistent_hash_user_sharding(self) -> None:
+        user_ids = range(1, 3001)
+        with mock.patch("zerver.tornado.sharding.user_sharding", {"algorithm": "consistent_hash"}):
+            self.assertEqual(get_user_id_tornado_port([9800], 5), 9800)
+            before = {
+                user_id: get_user_id_tornado_port([9800, 9801], user_id) for user_id in user_ids
+            }
+            after = {
+                user_id: get_user_id_tornado_port([9800, 9801, 9802], user_id)
+                for user_id in user_ids
+            }
+
+        # Every port gets a reasonable share of the users.
+        for port in [9800, 9801, 9802]:
+            self.assertGreater(list(after.values()).count(port), 500)
+        # Users only ever move to the new port; with modulo sharding,
+        # two thirds of the users would move.
+        moved = [user_id for user_id in user_ids if before[user_id] != after[user_id]]
+        self.assertEqual({after[user_id] for user_id in moved}, {9802})
+        self.assertLess(len(moved), 1500)
+
+        # Without a configured algorithm, we use modulo sharding.
+        self.assertEqual(get_user_id_tornado_port([9800, 9801, 9802], 4), 9801)
+
+    def test_hand_off_event_queues(self) -> None:
+        clear_client_event_queues_for_testing()
+        hamlet = self.example_user("hamlet")
+        client = allocate_client_descriptor(
+            dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=None,
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=hamlet.realm_id,
+                user_profile_id=hamlet.id,
+            )
+        )
+        client.event_queue.push(dict(type="other", x=1))
+        queue_id = client.event_queue.id
+        client_dict = client.to_dict()
+
+        ports = [9800, 9801]
+        new_port = get_user_id_tornado_port(ports, hamlet.id)
+        old_port = 9801 if new_port == 9800 else 9800
+        with mock.patch(
+            "zerver.tornado.event_queue.get_realm_tornado_ports", return_value=ports
+        ), mock.patch("zerver.tornado.event_queue.queue_json_publish") as m, self.settings(
+            TORNADO_PROCESSES=2
+        ):
+            realm_ports = fetch_realm_tornado_ports([hamlet.realm_id])
+            self.assertEqual(realm_ports, {hamlet.realm_id: ports})
+
+            # Queues which are already on the right port stay there.
+            hand_off_event_queues(new_port, realm_ports)
+            m.assert_not_called()
+
+            with self.assertLogs(level="INFO") as logs:
+                hand_off_event_queues(old_port, realm_ports)
+            self.assertEqual(
+                logs.output,
+                [f"INFO:root:Tornado {old_port} handed off 1 event queues to other ports"],
+            )
+        m.assert_called_once()
+        self.assertEqual(m.call_args[0][0], f"notify_tornado_port_{new_port}")
+        with self.assertRaises(BadEventQueueIdError):
+            access_client_descriptor(hamlet.id, queue_id)
+
+        # The new port restores the queue from the notice.
+        process_notification(orjson.loads(orjson.dumps(m.call_args[0][1])))
+        self.assertEqual(access_client_descriptor(hamlet.id, queue_id).to_dict(), client_dict)
+        with self.assertLogs(level="INFO") as logs:
+            process_notification(orjson.loads(orjson.dumps(m.call_args[0][1])))
+        self.assertEqual(
+            logs.output, [f"INFO:root:Ignoring handed off queue {queue_id}, which already exists"]
+        )
+
 
 class PruneInternalDataTest(ZulipTestCase):
     def test_prune_internal_data(self) -> None:
@@ -898,6 +1134,79 @@ class PruneInternalDataTest(ZulipTestCase):
         self.assertTrue("internal_data" in events[1])
         self.assertTrue("internal_data" in events[2])
 
+    def test_prune_internal_data_restored_queue(self) -> None:
+        # Message events in queues restored from disk are plain dictionaries.
+        message_event = dict(
+            type="message", message=dict(id=1), flags=[], internal_data=dict(x=1), id=0
+        )
+        other_event = dict(type="other", id=1)
+        events = prune_internal_data([message_event, other_event])
+        self.assertEqual(
+            events, [dict(type="message", message=dict(id=1), flags=[], id=0), other_event]
+        )
+
+        # The queued events themselves are not modified or copied.
+        self.assertIn("internal_data", message_event)
+        self.assertIs(events[0]["message"], message_event["message"])
+        self.assertIs(events[1], other_event)
+
+
+class SharedMessagePayloadTest(ZulipTestCase):
+    def test_shared_message_payload(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+
+        def allocate_queue(user_profile: UserProfile, apply_markdown: bool) -> ClientDescriptor:
+            queue_data = dict(
+                all_public_streams=False,
+                apply_markdown=apply_markdown,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=["message"],
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=user_profile.realm.id,
+                user_profile_id=user_profile.id,
+            )
+            return allocate_client_descriptor(queue_data)
+
+        hamlet_client = allocate_queue(hamlet, apply_markdown=True)
+        othello_client = allocate_queue(othello, apply_markdown=True)
+        othello_raw_client = allocate_queue(othello, apply_markdown=False)
+
+        self.send_stream_message(self.example_user("iago"), "Denmark", content="**hello**")
+
+        hamlet_event = hamlet_client.event_queue.queue[0]
+        othello_event = othello_client.event_queue.queue[0]
+        othello_raw_event = othello_raw_client.event_queue.queue[0]
+        assert isinstance(hamlet_event, QueuedMessageEvent)
+        assert isinstance(othello_event, QueuedMessageEvent)
+        assert isinstance(othello_raw_event, QueuedMessageEvent)
+
+        # Clients with the same settings share a single message payload.
+        self.assertIs(hamlet_event.message, othello_event.message)
+        self.assertIsNot(othello_event.message, othello_raw_event.message)
+        self.assertEqual(othello_raw_event["message"]["content"], "**hello**")
+
+        # Flags and internal data remain per-user.
+        self.assertEqual(hamlet_event["type"], "message")
+        self.assertEqual(hamlet_event["id"], 0)
+        self.assertIn("internal_data", hamlet_event)
+        self.assertNotIn("local_message_id", hamlet_event)
+
+        events = hamlet_client.event_queue.contents()
+        self.assert_length(events, 1)
+        self.assertEqual(
+            events[0],
+            dict(type="message", message=hamlet_event.message, flags=hamlet_event.flags, id=0),
+        )
+
+        # The persisted format is unchanged.
+        client_dict = hamlet_client.to_dict()
+        self.assertEqual(client_dict["event_queue"]["queue"], [hamlet_event.to_dict()])
+        new_client = ClientDescriptor.from_dict(client_dict)
+        self.assertEqual(new_client.event_queue.contents(), events)
+
 
 class EventQueueTest(ZulipTestCase):
     def get_client_descriptor(self) -> ClientDescriptor:
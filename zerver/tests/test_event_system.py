@@ -5,6 +5,7 @@ from urllib.parse import urlsplit
 
 import orjson
 from django.conf import settings
+from django.db import transaction
 from django.http import HttpRequest, HttpResponse
 from django.test import override_settings
 from django.utils.timezone import now as timezone_now
@@ -13,6 +14,7 @@ from version import API_FEATURE_LEVEL, ZULIP_MERGE_BASE, ZULIP_VERSION
 from zerver.actions.custom_profile_fields import try_update_realm_custom_profile_field
 from zerver.actions.message_send import check_send_message
 from zerver.actions.presence import do_update_user_presence
+from zerver.actions.streams import bulk_add_subscriptions
 from zerver.actions.user_settings import do_change_user_setting
 from zerver.actions.users import do_change_user_role
 from zerver.lib.event_schema import check_restart_event
@@ -38,11 +40,13 @@ from zerver.models import (
     get_stream,
     get_system_bot,
 )
+from zerver.tornado.django_api import batch_send_events, send_event
 from zerver.tornado.event_queue import (
     allocate_client_descriptor,
     clear_client_event_queues_for_testing,
     get_client_info_for_message_event,
     process_message_event,
+    process_notification,
     send_restart_events,
 )
 from zerver.tornado.exceptions import BadEventQueueIdError
@@ -261,6 +265,85 @@ class EventsEndpointTest(ZulipTestCase):
         self.assertEqual(context.exception.http_status_code, 400)
 
 
+class BatchSendEventsTest(ZulipTestCase):
+    def test_batch_send_events(self) -> None:
+        hamlet = self.example_user("hamlet")
+        realm = hamlet.realm
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=realm.id,
+            user_profile_id=hamlet.id,
+        )
+        client = allocate_client_descriptor(queue_data)
+
+        first_event = dict(type="other", value=1)
+        second_event = dict(type="other", value=2)
+        with mock.patch("zerver.tornado.django_api.queue_json_publish") as mock_publish:
+            with batch_send_events():
+                send_event(realm, first_event, [hamlet.id])
+                with batch_send_events():
+                    send_event(realm, second_event, [hamlet.id])
+                mock_publish.assert_not_called()
+            mock_publish.assert_called_once()
+
+        queue_name, data = mock_publish.call_args[0][:2]
+        self.assertEqual(queue_name, "notify_tornado")
+        self.assertEqual(
+            data,
+            dict(
+                notices=[
+                    dict(event=first_event, users=[hamlet.id]),
+                    dict(event=second_event, users=[hamlet.id]),
+                ]
+            ),
+        )
+
+        # Tornado processes the whole batch, and only then finishes
+        # the client's long-polling request, once.
+        with mock.patch.object(client, "finish_current_handler") as mock_finish:
+            process_notification(data)
+        mock_finish.assert_called_once()
+        self.assertEqual(
+            client.event_queue.contents(),
+            [dict(first_event, id=0), dict(second_event, id=1)],
+        )
+
+    def test_batch_peer_subscription_events(self) -> None:
+        realm = get_realm("zulip")
+        streams = [self.make_stream("batched1"), self.make_stream("batched2")]
+        users = [self.example_user("hamlet"), self.example_user("cordelia")]
+
+        # Peer events are sent once the caller's transaction commits,
+        # after bulk_add_subscriptions has returned; they should
+        # still all be sent to Tornado as a single batch.
+        with mock.patch("zerver.tornado.django_api.queue_json_publish") as mock_publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    bulk_add_subscriptions(realm, streams, users, acting_user=None)
+
+        published = [call.args[1] for call in mock_publish.call_args_list]
+        peer_add_publishes = [
+            data["notices"]
+            for data in published
+            if "notices" in data
+            and any(notice["event"].get("op") == "peer_add" for notice in data["notices"])
+        ]
+        self.assertFalse(
+            any("event" in data and data["event"].get("op") == "peer_add" for data in published)
+        )
+        self.assert_length(peer_add_publishes, 1)
+        self.assertEqual(
+            sorted(notice["event"]["stream_ids"][0] for notice in peer_add_publishes[0]),
+            sorted(stream.id for stream in streams),
+        )
+
+
 class GetEventsTest(ZulipTestCase):
     def tornado_call(
         self,
@@ -906,6 +989,51 @@ class ClientDescriptorsTest(ZulipTestCase):
         test_get_info(apply_markdown=False, client_gravatar=True)
         test_get_info(apply_markdown=True, client_gravatar=True)
 
+    def test_get_client_info_for_narrowed_clients(self) -> None:
+        hamlet = self.example_user("hamlet")
+        realm = hamlet.realm
+        clear_client_event_queues_for_testing()
+
+        def allocate_narrowed_client(
+            narrow: List[List[str]], event_types: Optional[List[str]] = None
+        ) -> str:
+            queue_data = dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=event_types,
+                last_connection_time=time.time(),
+                queue_timeout=0,
+                realm_id=realm.id,
+                user_profile_id=hamlet.id,
+                narrow=narrow,
+            )
+            return allocate_client_descriptor(queue_data).event_queue.id
+
+        stream_client = allocate_narrowed_client([["stream", "Denmark"]])
+        topic_client = allocate_narrowed_client([["stream", "denmark"], ["topic", "Lunch"]])
+        other_topic_client = allocate_narrowed_client([["stream", "Denmark"], ["topic", "other"]])
+        sender_client = allocate_narrowed_client([["sender", hamlet.email]])
+        allocate_narrowed_client([["stream", "Verona"]])
+        allocate_narrowed_client([["is", "dm"]])
+        allocate_narrowed_client([["stream", "Denmark"]], event_types=["presence"])
+
+        message_event = dict(
+            realm_id=realm.id,
+            stream_name="Denmark",
+            message_dict=dict(subject="lunch"),
+        )
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(set(client_info), {stream_client, topic_client, sender_client})
+
+        # Without the topic, we can't exclude clients narrowed to other topics.
+        message_event = dict(realm_id=realm.id, stream_name="Denmark")
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(
+            set(client_info), {stream_client, topic_client, other_topic_client, sender_client}
+        )
+
     def test_process_message_event_with_mocked_client_info(self) -> None:
         hamlet = self.example_user("hamlet")
 
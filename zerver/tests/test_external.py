@@ -201,6 +201,26 @@ class RateLimitTests(ZulipTestCase):
 
         self.do_test_hit_ratelimits(lambda: self.send_api_message(user, "some stuff"))
 
+    @rate_limit_rule(1, 5, domain="api_by_user")
+    def test_bulk_send_ratelimited_per_message(self) -> None:
+        user = self.example_user("cordelia")
+        RateLimitedUser(user).clear_history()
+        messages = [
+            dict(type="stream", to="Verona", topic="bulk", content=f"message {i}") for i in range(3)
+        ]
+
+        def send_bulk_api_messages() -> "TestHttpResponse":
+            return self.api_post(
+                user, "/api/v1/messages/bulk", {"messages": orjson.dumps(messages).decode()}
+            )
+
+        # Each message counts against the limit, so the second request,
+        # for the 4th through 6th messages, is over it.
+        with mock.patch("time.time", return_value=time.time()):
+            self.assert_json_success(send_bulk_api_messages())
+            result = send_bulk_api_messages()
+        self.assertEqual(result.status_code, 429)
+
     @rate_limit_rule(1, 5, domain="email_change_by_user")
     def test_hit_change_email_ratelimit_as_user(self) -> None:
         user = self.example_user("cordelia")
@@ -17,6 +17,7 @@ from confirmation.models import RealmCreationKey, generate_realm_creation_url
 from zerver.actions.create_user import do_create_user
 from zerver.actions.reactions import do_add_reaction
 from zerver.lib.management import ZulipBaseCommand, check_config
+from zerver.lib.markdown import version as markdown_version
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import most_recent_message, stdout_suppressed
 from zerver.models import (
@@ -386,6 +387,44 @@ class TestCalculateFirstVisibleMessageID(ZulipTestCase):
         m.assert_has_calls(calls, any_order=True)
 
 
+class TestRerenderMessages(ZulipTestCase):
+    COMMAND_NAME = "rerender_messages"
+
+    def test_rerender_messages(self) -> None:
+        hamlet = self.example_user("hamlet")
+        message_ids = [
+            self.send_stream_message(hamlet, "Denmark", content=f"**message {i}**")
+            for i in range(3)
+        ]
+        Message.objects.filter(id__in=message_ids[1:]).update(
+            rendered_content="<p>old</p>", rendered_content_version=markdown_version - 1
+        )
+
+        with patch("builtins.print") as print_mock:
+            call_command(
+                self.COMMAND_NAME,
+                "--processes=1",
+                "--chunk-size=1",
+                f"--start-id={message_ids[0]}",
+            )
+        print_mock.assert_any_call(
+            f"Re-rendering messages {message_ids[1]} to {message_ids[2]} in 2 chunks"
+        )
+        self.assertIn(
+            f"; resume with --start-id={message_ids[2]}", print_mock.call_args_list[1][0][0]
+        )
+        for message in Message.objects.filter(id__in=message_ids).order_by("id"):
+            self.assertEqual(message.rendered_content_version, markdown_version)
+        self.assertEqual(
+            Message.objects.get(id=message_ids[2]).rendered_content,
+            "<p><strong>message 2</strong></p>",
+        )
+
+        with patch("builtins.print") as print_mock:
+            call_command(self.COMMAND_NAME, "--processes=1", f"--start-id={message_ids[0]}")
+        print_mock.assert_called_once_with("No messages need to be re-rendered.")
+
+
 class TestPasswordRestEmail(ZulipTestCase):
     COMMAND_NAME = "send_password_reset_email"
 
@@ -31,8 +31,11 @@ from zerver.lib.markdown import (
     clear_state_for_testing,
     content_has_emoji_syntax,
     fetch_tweet_data,
+    get_linkifier_matcher,
+    get_topic_links_cache_stats,
     get_tweet_id,
     image_preview_enabled,
+    is_plain_text,
     markdown_convert,
     maybe_update_markdown_engines,
     possible_linked_stream_names,
@@ -41,6 +44,7 @@ from zerver.lib.markdown import (
     url_to_a,
 )
 from zerver.lib.markdown.fenced_code import FencedBlockPreprocessor
+from zerver.lib.markdown.render_pool import MarkdownRenderPool, RenderRequest
 from zerver.lib.mdiff import diff_strings
 from zerver.lib.mention import (
     FullNameInfo,
@@ -53,6 +57,7 @@ from zerver.lib.mention import (
 from zerver.lib.message import render_markdown
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.tex import render_tex
+from zerver.lib.timeout import TimeoutExpiredError
 from zerver.models import (
     Message,
     RealmEmoji,
@@ -1566,6 +1571,118 @@ class MarkdownTest(ZulipTestCase):
             ],
         )
 
+    def test_many_realm_patterns(self) -> None:
+        realm = get_realm("zulip")
+        RealmFilter.objects.bulk_create(
+            RealmFilter(
+                realm=realm,
+                pattern=rf"P{i}-(?P<id>[0-9]+)",
+                url_template=f"https://trac.example.com/p{i}/{{id}}",
+            )
+            for i in range(200)
+        )
+        # This overlaps with P1-..., but has a lower priority.
+        RealmFilter.objects.create(
+            realm=realm,
+            pattern=r"(?P<id>[A-Z][0-9]+-[0-9]+)",
+            url_template="https://other-trac.example.com/{id}",
+        )
+        flush_linkifiers(sender=RealmFilter, instance=RealmFilter(realm=realm))
+        flush_per_request_caches()
+
+        matcher = get_linkifier_matcher(realm.id)
+        self.assertEqual(matcher.matching_linkifiers("Nothing to see here"), [])
+        self.assertEqual(matcher.matching_linkifiers("Fixed P150-3, see P1-2"), [1, 150, 200])
+
+        content = "P1-2, P150-3 and Q9-10, but not P1-2z"
+        converted = markdown_convert(content, message_realm=realm)
+        self.assertEqual(
+            converted.rendered_content,
+            '<p><a href="https://trac.example.com/p1/2">P1-2</a>, <a href="https://trac.example.com/p150/3">P150-3</a> and <a href="https://other-trac.example.com/Q9-10">Q9-10</a>, but not P1-2z</p>',
+        )
+        self.assertEqual(
+            topic_links(realm.id, content),
+            [
+                {"url": "https://trac.example.com/p1/2", "text": "P1-2"},
+                {"url": "https://trac.example.com/p150/3", "text": "P150-3"},
+                {"url": "https://other-trac.example.com/Q9-10", "text": "Q9-10"},
+            ],
+        )
+
+    def test_topic_links_cache(self) -> None:
+        realm = get_realm("zulip")
+        linkifier = RealmFilter(
+            realm=realm,
+            pattern=r"#(?P<id>[0-9]{2,8})",
+            url_template=r"https://trac.example.com/ticket/{id}",
+        )
+        linkifier.save()
+        flush_per_request_caches()
+
+        stats = get_topic_links_cache_stats()
+        expected = [{"url": "https://trac.example.com/ticket/444", "text": "#444"}]
+        self.assertEqual(topic_links(realm.id, "fix #444"), expected)
+        links = topic_links(realm.id, "fix #444")
+        self.assertEqual(links, expected)
+        self.assertEqual(get_topic_links_cache_stats()["misses"], stats.get("misses", 0) + 1)
+        self.assertEqual(get_topic_links_cache_stats()["hits"], stats.get("hits", 0) + 1)
+
+        # Callers get their own copies.
+        links[0]["url"] = "https://example.com"
+        self.assertEqual(topic_links(realm.id, "fix #444"), expected)
+
+        # Changing the realm's linkifiers changes the topic links.
+        linkifier.url_template = "https://other-trac.example.com/ticket/{id}"
+        linkifier.save()
+        flush_per_request_caches()
+        maybe_update_markdown_engines(realm.id, False)
+        self.assertEqual(
+            topic_links(realm.id, "fix #444"),
+            [{"url": "https://other-trac.example.com/ticket/444", "text": "#444"}],
+        )
+
+    def test_plain_text_fast_path(self) -> None:
+        realm = get_realm("zulip")
+        RealmFilter.objects.create(
+            realm=realm,
+            pattern=r"ZUL-(?P<id>[0-9]+)",
+            url_template="https://trac.example.com/ticket/{id}",
+        )
+        flush_per_request_caches()
+        user_profile = self.example_user("othello")
+        do_add_alert_words(user_profile, ["scaryword"])
+        automaton = get_alert_word_automaton(realm)
+
+        self.assertTrue(is_plain_text("Hello there. How are you?", realm.id, automaton))
+        self.assertFalse(is_plain_text("See ZUL-44", realm.id, automaton))
+        self.assertFalse(is_plain_text("What a scaryword", realm.id, automaton))
+        self.assertFalse(is_plain_text("1. One", realm.id, automaton))
+        self.assertFalse(is_plain_text("zulip.com", realm.id, automaton))
+
+        # The output of the fast path must be identical to that of the
+        # Markdown processor, for all of the plain text in our fixtures
+        # and in the test database, whole and line by line.
+        format_tests, linkify_tests = self.load_markdown_tests()
+        corpus = [test["input"] for test in format_tests.values()]
+        corpus += [test[0] for test in linkify_tests]
+        corpus += Message.objects.values_list("content", flat=True)
+        corpus += [line for content in corpus for line in content.split("\n")]
+
+        plain_text = [
+            content for content in set(corpus) if is_plain_text(content, realm.id, automaton)
+        ]
+        self.assertGreater(len(plain_text), 10)
+        for content in plain_text:
+            with self.subTest(content=content):
+                converted = markdown_convert(
+                    content, realm_alert_words_automaton=automaton, message_realm=realm
+                )
+                with mock.patch("zerver.lib.markdown.is_plain_text", return_value=False):
+                    expected = markdown_convert(
+                        content, realm_alert_words_automaton=automaton, message_realm=realm
+                    )
+                self.assertEqual(converted, expected)
+
     def test_links_and_linkifiers_in_topic_name(self) -> None:
         realm = get_realm("zulip")
         self.check_add_linkifiers(
@@ -3126,6 +3243,60 @@ class MarkdownErrorTests(ZulipTestCase):
             with self.assertRaises(MarkdownRenderingError):
                 markdown_convert_wrapper(msg)
 
+    def test_render_pool(self) -> None:
+        realm = get_realm("zulip")
+        requests = [
+            RenderRequest(content="**bold**", realm=realm),
+            RenderRequest(content="*slow*", realm=realm),
+            RenderRequest(content="Plain text", realm=realm),
+        ]
+        # Plain text doesn't go through the Markdown processor, and so
+        # not through timeout.
+        with mock.patch(
+            "zerver.lib.markdown.timeout",
+            side_effect=["<p><strong>bold</strong></p>", TimeoutExpiredError()],
+        ), mock.patch("zerver.lib.markdown.markdown_logger") as logger:
+            with MarkdownRenderPool(1) as render_pool:
+                results = render_pool.render(requests)
+        logger.exception.assert_called_once()
+
+        self.assert_length(results, 3)
+        assert results[0] is not None and results[2] is not None
+        self.assertEqual(results[0].rendered_content, "<p><strong>bold</strong></p>")
+        self.assertIsNone(results[1])
+        self.assertEqual(results[2].rendered_content, "<p>Plain text</p>")
+
+    def test_render_pool_worker_processes(self) -> None:
+        realm = get_realm("zulip")
+        requests = [RenderRequest(content=f"Message {i}", realm=realm) for i in range(5)]
+        requests[3].content = "Broken"
+        # Render the messages once in this process, so the workers,
+        # which get a copy of the test suite's local memory cache,
+        # don't need the database.
+        with MarkdownRenderPool(1) as render_pool:
+            render_pool.render(requests)
+
+        def convert(content: str, **kwargs: Any) -> MessageRenderingResult:
+            if content == "Broken":
+                raise ValueError("Unexpected error")
+            return markdown_convert(content, **kwargs)
+
+        # The workers are forked when the pool is created, and so
+        # inherit this mock; we keep the test's database connection,
+        # which holds its transaction, open.
+        with mock.patch(
+            "zerver.lib.markdown.render_pool.markdown_convert", side_effect=convert
+        ), mock.patch("zerver.lib.markdown.render_pool.connection"):
+            with MarkdownRenderPool(2, batch_size=2) as render_pool:
+                self.assertIsNotNone(render_pool.executor)
+                results = render_pool.render(requests)
+            self.assertIsNone(render_pool.executor)
+
+        self.assertEqual(
+            [result.rendered_content if result is not None else None for result in results],
+            ["<p>Message 0</p>", "<p>Message 1</p>", "<p>Message 2</p>", None, "<p>Message 4</p>"],
+        )
+
     def test_curl_code_block_validation(self) -> None:
         processor = SimulatedFencedBlockPreprocessor(Markdown())
         processor.run_content_validators = True
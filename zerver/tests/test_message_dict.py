@@ -1,11 +1,26 @@
+import zlib
 from typing import Any, Dict, List, Union
 from unittest import mock
 
+import orjson
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.cache import cache_delete, to_dict_cache_key_id
+from zerver.lib.markdown import MessageRenderingResult
 from zerver.lib.markdown import version as markdown_version
-from zerver.lib.message import MessageDict, messages_for_ids, sew_messages_and_reactions
+from zerver.lib.message import (
+    MessageDict,
+    extract_message_dict,
+    extract_message_fragments,
+    message_dict_to_fragments,
+    messages_for_ids,
+    messages_json_for_ids,
+    render_markdown,
+    rerender_messages,
+    sew_messages_and_reactions,
+    stringify_message_dict,
+)
+from zerver.lib.message_codec import DICTIONARY_CODEC_V1, ZLIB_CODEC
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import make_client
 from zerver.lib.topic import TOPIC_LINKS
@@ -243,6 +258,123 @@ class MessageDictTest(ZulipTestCase):
         )
         self.assertEqual(dct["rendered_content"], error_content)
 
+    def test_stale_rendered_content(self) -> None:
+        hamlet = self.example_user("hamlet")
+        message_id = self.send_stream_message(hamlet, "Denmark", content="hello **world**")
+        Message.objects.filter(id=message_id).update(
+            rendered_content="<p>old rendering</p>", rendered_content_version=markdown_version - 1
+        )
+        cache_delete(to_dict_cache_key_id(message_id))
+
+        def fetch_content() -> str:
+            return messages_for_ids(
+                message_ids=[message_id],
+                user_message_flags={message_id: []},
+                search_fields={},
+                apply_markdown=True,
+                client_gravatar=True,
+                allow_edit_history=False,
+            )[0]["content"]
+
+        # Fetching serves the stale rendering, and queues the message
+        # to be re-rendered in the background.
+        with mock.patch("zerver.lib.message.queue_json_publish") as m:
+            self.assertEqual(fetch_content(), "<p>old rendering</p>")
+        m.assert_called_once_with("rerender_messages", {"message_ids": [message_id]})
+        self.assertEqual(
+            Message.objects.get(id=message_id).rendered_content_version, markdown_version - 1
+        )
+
+        # Re-rendering flushes the cached stale rendering.
+        self.assertEqual(rerender_messages([message_id]), 1)
+        self.assertEqual(rerender_messages([message_id]), 0)
+        with mock.patch("zerver.lib.message.queue_json_publish") as m:
+            self.assertEqual(fetch_content(), "<p>hello <strong>world</strong></p>")
+        m.assert_not_called()
+
+        # A reader may cache the stale rendering it read just before
+        # another re-render committed.  Its own queued re-render finds
+        # the message current, but still flushes the cached copy.
+        rendered_content = Message.objects.get(id=message_id).rendered_content
+        Message.objects.filter(id=message_id).update(
+            rendered_content="<p>old rendering</p>", rendered_content_version=markdown_version - 1
+        )
+        cache_delete(to_dict_cache_key_id(message_id))
+        with mock.patch("zerver.lib.message.queue_json_publish"):
+            self.assertEqual(fetch_content(), "<p>old rendering</p>")
+        Message.objects.filter(id=message_id).update(
+            rendered_content=rendered_content, rendered_content_version=markdown_version
+        )
+        self.assertEqual(rerender_messages([message_id]), 0)
+        self.assertEqual(fetch_content(), "<p>hello <strong>world</strong></p>")
+
+        # Messages edited while being re-rendered are skipped.
+        Message.objects.filter(id=message_id).update(rendered_content_version=None)
+        original_render_markdown = render_markdown
+
+        def edit_while_rendering(message: Message, content: str) -> MessageRenderingResult:
+            Message.objects.filter(id=message_id).update(content="edited")
+            return original_render_markdown(message, content)
+
+        with mock.patch("zerver.lib.message.render_markdown", side_effect=edit_while_rendering):
+            self.assertEqual(rerender_messages([message_id]), 0)
+        self.assertIsNone(Message.objects.get(id=message_id).rendered_content_version)
+
+    def test_messages_json_for_ids(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        iago = self.example_user("iago")
+        message_ids = [
+            self.send_stream_message(hamlet, "Denmark", content="hello **world**"),
+            self.send_personal_message(hamlet, cordelia, content='hi "there" \\ `you`'),
+            self.send_huddle_message(cordelia, [hamlet, iago], content="@**King Hamlet**"),
+            self.send_personal_message(iago, iago, content="note to self"),
+        ]
+        message = Message.objects.get(id=message_ids[0])
+        message.last_edit_time = timezone_now()
+        message.edit_history = '[{"prev_content": "hello", "timestamp": 1, "user_id": 10}]'
+        message.save()
+        cache_delete(to_dict_cache_key_id(message.id))
+
+        user_message_flags = {message_id: ["read"] for message_id in message_ids}
+        search_fields = {
+            message_ids[1]: {"match_content": "<p>hi</p>", "match_subject": ""},
+        }
+        for apply_markdown in [True, False]:
+            for client_gravatar in [True, False]:
+                for allow_edit_history in [True, False]:
+                    kwargs: Dict[str, Any] = dict(
+                        message_ids=message_ids,
+                        user_message_flags=user_message_flags,
+                        search_fields=search_fields,
+                        apply_markdown=apply_markdown,
+                        client_gravatar=client_gravatar,
+                        allow_edit_history=allow_edit_history,
+                    )
+                    self.assertEqual(
+                        orjson.loads(messages_json_for_ids(**kwargs)),
+                        messages_for_ids(**kwargs),
+                    )
+
+    def test_message_codecs(self) -> None:
+        hamlet = self.example_user("hamlet")
+        message_id = self.send_stream_message(hamlet, "Denmark", content="hello **world**")
+        message = Message.objects.get(id=message_id)
+        message_dict = MessageDict.to_dict_uncached_helper([message])[0]
+        fragments = message_dict_to_fragments(message_dict)
+        data = b"\0".join(fragments)
+
+        cached = stringify_message_dict(message_dict)
+        self.assertEqual(cached[0], DICTIONARY_CODEC_V1.version)
+        self.assertLess(len(cached), len(ZLIB_CODEC.compress(data)))
+        self.assertEqual(extract_message_dict(cached), message_dict)
+        self.assertEqual(extract_message_fragments(cached), fragments)
+
+        # Entries written with other codecs, or before cached messages
+        # had a version byte, can still be read.
+        self.assertEqual(extract_message_dict(ZLIB_CODEC.compress(data)), message_dict)
+        self.assertEqual(extract_message_dict(zlib.compress(data)), message_dict)
+
     def test_topic_links_use_stream_realm(self) -> None:
         # Set up a realm filter on 'zulip' and assert that messages
         # sent to a stream on 'zulip' have the topic linkified,
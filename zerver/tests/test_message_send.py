@@ -754,6 +754,57 @@ class MessagePOSTTest(ZulipTestCase):
         )
         self.assert_json_error(result, "Invalid type")
 
+    def test_send_messages_bulk(self) -> None:
+        self.login("hamlet")
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        stream = get_stream("Verona", hamlet.realm)
+        messages = [
+            dict(type="stream", to="Verona", topic="bulk", content="first"),
+            dict(type="stream", to=stream.id, topic="bulk", content="second", local_id="2"),
+            dict(type="direct", to=[othello.id], content="third"),
+            dict(type="private", to=othello.email, content="fourth"),
+        ]
+
+        with mock.patch("zerver.tornado.django_api.queue_json_publish") as m:
+            result = self.client_post(
+                "/json/messages/bulk", {"messages": orjson.dumps(messages).decode()}
+            )
+        message_ids = self.assert_json_success(result)["ids"]
+        self.assert_length(message_ids, 4)
+        self.assertEqual(
+            [
+                message.content
+                for message in Message.objects.filter(id__in=message_ids).order_by("id")
+            ],
+            ["first", "second", "third", "fourth"],
+        )
+        self.assertEqual(Message.objects.get(id=message_ids[1]).topic_name(), "bulk")
+
+        # The events for all of the messages are published as one batch.
+        self.assertEqual(m.call_count, 1)
+        notices = m.call_args[0][1]["notices"]
+        self.assertEqual([notice["event"]["message"] for notice in notices], message_ids)
+        self.assertEqual(notices[1]["event"]["local_id"], "2")
+
+        # If any message is invalid, none are sent.
+        messages[2] = dict(type="stream", to="nonexistent_stream", topic="bulk", content="x")
+        message_count = Message.objects.count()
+        result = self.client_post(
+            "/json/messages/bulk", {"messages": orjson.dumps(messages).decode()}
+        )
+        self.assert_json_error(result, "Stream 'nonexistent_stream' does not exist")
+        self.assertEqual(Message.objects.count(), message_count)
+
+        result = self.client_post("/json/messages/bulk", {"messages": "[]"})
+        self.assert_json_error(result, "No messages to send")
+
+        with mock.patch("zerver.views.message_send.MAX_MESSAGES_PER_BULK_SEND", 2):
+            result = self.client_post(
+                "/json/messages/bulk", {"messages": orjson.dumps(messages[:3]).decode()}
+            )
+        self.assert_json_error(result, "Too many messages; at most 2 can be sent at once")
+
     def test_empty_message(self) -> None:
         """
         Sending a message that is empty or only whitespace should fail
@@ -1387,6 +1438,35 @@ class StreamMessagesTest(ZulipTestCase):
         self.assertEqual(old_non_subscriber_messages, new_non_subscriber_messages)
         self.assertEqual(new_subscriber_messages, [elt + 1 for elt in old_subscriber_messages])
 
+    def test_stream_message_copy_insert(self) -> None:
+        sender = self.example_user("iago")
+        hamlet = self.example_user("hamlet")
+        stream_name = "Denmark"
+        self.subscribe(sender, stream_name)
+        self.subscribe(hamlet, stream_name)
+        subscribers = [
+            user
+            for user in self.users_subscribed_to_stream(stream_name, sender.realm)
+            if user.bot_type not in [UserProfile.OUTGOING_WEBHOOK_BOT, UserProfile.EMBEDDED_BOT]
+        ]
+
+        # Large sends insert UserMessage rows with a binary COPY.
+        with mock.patch("zerver.lib.user_message.BULK_INSERT_UMS_COPY_THRESHOLD", 0):
+            message_id = self.send_stream_message(
+                sender, stream_name, content="@**King Hamlet** hello"
+            )
+
+        flags = {
+            um.user_profile_id: um.flags_list()
+            for um in UserMessage.objects.filter(message_id=message_id)
+        }
+        self.assertEqual(set(flags), {user.id for user in subscribers})
+        self.assertEqual(flags[sender.id], ["read"])
+        self.assertEqual(flags[hamlet.id], ["mentioned"])
+        for user in subscribers:
+            if user.id not in [sender.id, hamlet.id]:
+                self.assertEqual(flags[user.id], [])
+
     def test_performance(self) -> None:
         """
         This test is part of the automated test suite, but
@@ -4,19 +4,25 @@ from typing import Any, Dict
 from unittest import mock
 
 from django.conf import settings
+from django.test import override_settings
 from django.utils.timezone import now as timezone_now
 
+from zerver.actions.presence import do_update_user_presence
+from zerver.actions.user_settings import do_change_user_setting
 from zerver.actions.users import do_deactivate_user
+from zerver.lib.cache import cache_delete, realm_presence_snapshot_cache_key
 from zerver.lib.presence import format_legacy_presence_dict, get_presence_dict_by_realm
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import make_client, reset_email_visibility_to_everyone_in_zulip_realm
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.models import (
+    PresenceSequence,
     PushDeviceToken,
     UserActivity,
     UserActivityInterval,
     UserPresence,
     UserProfile,
+    get_client,
     get_realm,
 )
 
@@ -172,6 +178,103 @@ class UserPresenceTests(ZulipTestCase):
             hamlet_info["idle_timestamp"],
         )
 
+    def test_presence_changes_since_last_update_id(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+
+        self.login_user(hamlet)
+        params = dict(status="idle", slim_presence="true", last_update_id="-1")
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(hamlet.id)})
+        last_update_id = json["presence_last_update_id"]
+        self.assertEqual(
+            last_update_id, UserPresence.objects.get(user_profile=hamlet).last_update_id
+        )
+
+        # Hamlet's own presence doesn't change again so soon, so
+        # nothing has changed since.
+        params = dict(status="idle", slim_presence="true", last_update_id=str(last_update_id))
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(json["presences"], {})
+        self.assertEqual(json["presence_last_update_id"], last_update_id)
+
+        self.login_user(othello)
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(othello.id)})
+        self.assertEqual(json["presence_last_update_id"], last_update_id + 1)
+        self.assertEqual(
+            PresenceSequence.objects.get(realm=hamlet.realm).last_update_id, last_update_id + 1
+        )
+
+        # Without last_update_id, we get everyone, as before.
+        params = dict(status="idle", slim_presence="true")
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(hamlet.id), str(othello.id)})
+        self.assertNotIn("presence_last_update_id", json)
+
+    def test_presence_enabled_change_since_last_update_id(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+
+        self.login_user(othello)
+        params = dict(status="idle", slim_presence="true", last_update_id="-1")
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        params["last_update_id"] = str(json["presence_last_update_id"])
+
+        # Clients polling for changes see Hamlet disabling presence.
+        do_change_user_setting(hamlet, "presence_enabled", False, acting_user=None)
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(hamlet.id)})
+        params["last_update_id"] = str(json["presence_last_update_id"])
+
+        # A forced update gets a new update ID, even when it doesn't
+        # move the presence times forward.
+        presence = UserPresence.objects.get(user_profile=hamlet)
+        do_update_user_presence(
+            hamlet,
+            get_client("website"),
+            presence.last_connected_time,
+            UserPresence.LEGACY_STATUS_IDLE_INT,
+            force_send_update=True,
+        )
+        self.assertEqual(
+            UserPresence.objects.get(user_profile=hamlet).last_connected_time,
+            presence.last_connected_time,
+        )
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(hamlet.id)})
+        self.assertEqual(json["presence_last_update_id"], presence.last_update_id + 1)
+
+    @override_settings(PRESENCE_SNAPSHOT_CACHE_SECONDS=5)
+    def test_presence_snapshot_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+
+        self.login_user(hamlet)
+        params = dict(status="idle", slim_presence="true")
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(hamlet.id)})
+
+        # Othello gets the same snapshot of the realm's presence,
+        # which doesn't include their own update yet.
+        self.login_user(othello)
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(hamlet.id)})
+
+        cache_delete(realm_presence_snapshot_cache_key(hamlet.realm_id))
+        result = self.client_post("/json/users/me/presence", params)
+        json = self.assert_json_success(result)
+        self.assertEqual(set(json["presences"].keys()), {str(hamlet.id), str(othello.id)})
+
     def test_set_active(self) -> None:
         hamlet = self.example_user("hamlet")
         othello = self.example_user("othello")
@@ -23,15 +23,18 @@ from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
 from zerver.lib.send_email import EmailNotDeliveredError, FromAddress
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import mock_queue_publish
+from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.models import (
     NotificationTriggers,
     PreregistrationUser,
     ScheduledMessageNotificationEmail,
     UserActivity,
+    UserPresence,
     UserProfile,
     get_client,
     get_realm,
     get_stream,
+    get_user_profile_by_id,
 )
 from zerver.tornado.event_queue import build_offline_notification
 from zerver.worker import queue_processors
@@ -112,6 +115,135 @@ class WorkerTest(ZulipTestCase):
             self.assert_length(activity_records, 1)
             self.assertEqual(activity_records[0].count, 2)
 
+    def test_UserActivityWorker_batch(self) -> None:
+        fake_client = FakeClient()
+
+        user = self.example_user("hamlet")
+        client = get_client("ios")
+        UserActivity.objects.filter(user_profile=user.id, client=client).delete()
+        now = time.time()
+        UserActivity.objects.create(
+            user_profile=user,
+            client=client,
+            query="get_events",
+            count=5,
+            last_visit=timestamp_to_datetime(now + 60),
+        )
+
+        for query, offset in [("get_events", 0), ("send_message", 10), ("get_events", 20)]:
+            fake_client.enqueue(
+                "user_activity",
+                dict(user_profile_id=user.id, client_id=client.id, time=now + offset, query=query),
+            )
+        with simulated_queue_client(fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.setup()
+            # All of the updates are made in a single query.
+            with self.assert_database_query_count(1):
+                worker.start()
+
+        activity = UserActivity.objects.get(user_profile=user, client=client, query="get_events")
+        self.assertEqual(activity.count, 7)
+        # We keep the latest visit.
+        self.assertEqual(activity.last_visit, timestamp_to_datetime(now + 60))
+        activity = UserActivity.objects.get(user_profile=user, client=client, query="send_message")
+        self.assertEqual(activity.count, 1)
+        self.assertEqual(activity.last_visit, timestamp_to_datetime(now + 10))
+
+    def test_UserPresenceWorker_batch(self) -> None:
+        fake_client = FakeClient()
+
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        now = time.time()
+        UserPresence.objects.filter(user_profile=cordelia).delete()
+        UserPresence.objects.update_or_create(
+            user_profile=hamlet,
+            defaults=dict(
+                realm=hamlet.realm,
+                last_active_time=timestamp_to_datetime(now - 86400),
+                last_connected_time=timestamp_to_datetime(now - 86400),
+            ),
+        )
+        UserPresence.objects.update_or_create(
+            user_profile=othello,
+            defaults=dict(
+                realm=othello.realm,
+                last_active_time=timestamp_to_datetime(now - 5),
+                last_connected_time=timestamp_to_datetime(now - 5),
+            ),
+        )
+
+        # Hamlet has several tabs open, only one of which is in use.
+        for user, status, offset in [
+            (hamlet, UserPresence.LEGACY_STATUS_IDLE_INT, 0),
+            (cordelia, UserPresence.LEGACY_STATUS_IDLE_INT, 0),
+            (othello, UserPresence.LEGACY_STATUS_ACTIVE_INT, 0),
+            (hamlet, UserPresence.LEGACY_STATUS_ACTIVE_INT, 5),
+            (hamlet, UserPresence.LEGACY_STATUS_IDLE_INT, 10),
+            (cordelia, UserPresence.LEGACY_STATUS_IDLE_INT, 20),
+        ]:
+            fake_client.enqueue(
+                "user_presence",
+                dict(user_profile_id=user.id, status=status, time=now + offset, client="website"),
+            )
+
+        # Make sure the user profiles are cached, as they usually are.
+        for user in [hamlet, cordelia, othello]:
+            get_user_profile_by_id(user.id)
+
+        with simulated_queue_client(fake_client):
+            worker = queue_processors.UserPresenceWorker()
+            worker.setup()
+            # Hamlet came back online, and Cordelia connected for the
+            # first time; Othello's pings are throttled.
+            with self.capture_send_event_calls(expected_num_events=2) as events:
+                # One query to lock the existing rows, one to
+                # allocate presence update ids, and one to write all
+                # of the changes.
+                with self.assert_database_query_count(3):
+                    worker.start()
+
+        self.assertEqual({event["event"]["user_id"] for event in events}, {hamlet.id, cordelia.id})
+
+        presence = UserPresence.objects.get(user_profile=hamlet)
+        self.assertEqual(presence.last_connected_time, timestamp_to_datetime(now + 10))
+        self.assertEqual(presence.last_active_time, timestamp_to_datetime(now + 5))
+        presence = UserPresence.objects.get(user_profile=cordelia)
+        self.assertEqual(presence.last_connected_time, timestamp_to_datetime(now + 20))
+        self.assertIsNone(presence.last_active_time)
+        presence = UserPresence.objects.get(user_profile=othello)
+        self.assertEqual(presence.last_connected_time, timestamp_to_datetime(now - 5))
+        self.assertEqual(presence.last_active_time, timestamp_to_datetime(now - 5))
+
+    def test_UserPresenceWorker_deleted_user(self) -> None:
+        fake_client = FakeClient()
+
+        hamlet = self.example_user("hamlet")
+        deleted_user_id = UserProfile.objects.latest("id").id + 1
+        now = time.time()
+        for user_id in [deleted_user_id, hamlet.id]:
+            fake_client.enqueue(
+                "user_presence",
+                dict(
+                    user_profile_id=user_id,
+                    status=UserPresence.LEGACY_STATUS_ACTIVE_INT,
+                    time=now,
+                    client="website",
+                ),
+            )
+
+        # Pings from users deleted since they were queued are skipped,
+        # without failing the rest of the batch.
+        with simulated_queue_client(fake_client):
+            worker = queue_processors.UserPresenceWorker()
+            worker.setup()
+            worker.start()
+
+        presence = UserPresence.objects.get(user_profile=hamlet)
+        self.assertEqual(presence.last_active_time, timestamp_to_datetime(now))
+
     def test_missed_message_worker(self) -> None:
         cordelia = self.example_user("cordelia")
         hamlet = self.example_user("hamlet")
@@ -188,7 +320,7 @@ class WorkerTest(ZulipTestCase):
             self.assertEqual(row.scheduled_timestamp, scheduled_timestamp)
             self.assertEqual(row.mentioned_user_group_id, mentioned_user_group_id)
 
-        def advance() -> Optional[float]:
+        def advance() -> Optional[datetime.datetime]:
             mmw.stopping = False
 
             def inner(check: Callable[[], bool], timeout: Optional[float]) -> bool:
@@ -204,13 +336,13 @@ class WorkerTest(ZulipTestCase):
 
             with patch.object(mmw.cv, "wait_for", side_effect=inner):
                 mmw.work()
-            return mmw.has_timeout
+            return mmw.next_deadline
 
         # With nothing enqueued, the condition variable is pending
         # forever.  We double-check that the condition is false in
         # steady-state.
-        has_timeout = advance()
-        self.assertFalse(has_timeout)
+        next_deadline = advance()
+        self.assertIsNone(next_deadline)
 
         # Enqueues the events to the internal queue, as if from RabbitMQ
         time_zero = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
@@ -219,20 +351,21 @@ class WorkerTest(ZulipTestCase):
         ) as notify_mock:
             for event in events:
                 mmw.consume_single_event(event)
-        # All of these notify, because has_timeout is still false in
-        # each case.  This represents multiple consume() calls getting
-        # the lock before the worker escapes the wait_for, and is
-        # unlikely in real life but does not lead to incorrect
-        # behaviour.
-        self.assertEqual(notify_mock.call_count, 3)
-
-        # This leaves a timeout set, since there are objects pending
-        with time_machine.travel(time_zero, tick=False):
-            has_timeout = advance()
-        self.assertTrue(has_timeout)
+        # Each user's first event notifies, because the worker thread
+        # has no deadline yet.  This represents multiple consume()
+        # calls getting the lock before the worker escapes the
+        # wait_for, and is unlikely in real life but does not lead to
+        # incorrect behaviour.  Hamlet's second event joins the
+        # existing batch, so does not notify.
+        self.assertEqual(notify_mock.call_count, 2)
 
         expected_scheduled_timestamp = time_zero + batch_duration
 
+        # This leaves the thread waiting for the batches to be due.
+        with time_machine.travel(time_zero, tick=False):
+            next_deadline = advance()
+        self.assertEqual(next_deadline, expected_scheduled_timestamp)
+
         # The events should be saved in the database
         hamlet_row1 = ScheduledMessageNotificationEmail.objects.get(
             user_profile_id=hamlet.id, message_id=hamlet1_msg_id
@@ -260,8 +393,8 @@ class WorkerTest(ZulipTestCase):
         self.assertEqual(notify_mock.call_count, 0)
 
         with time_machine.travel(few_moments_later, tick=False):
-            has_timeout = advance()
-        self.assertTrue(has_timeout)
+            next_deadline = advance()
+        self.assertEqual(next_deadline, expected_scheduled_timestamp)
         hamlet_row3 = ScheduledMessageNotificationEmail.objects.get(
             user_profile_id=hamlet.id, message_id=hamlet3_msg_id
         )
@@ -271,19 +404,30 @@ class WorkerTest(ZulipTestCase):
         # If called too early, it shouldn't process the emails.
         one_minute_premature = expected_scheduled_timestamp - datetime.timedelta(seconds=60)
         with time_machine.travel(one_minute_premature, tick=False):
-            has_timeout = advance()
-        self.assertTrue(has_timeout)
+            next_deadline = advance()
+        self.assertEqual(next_deadline, expected_scheduled_timestamp)
         self.assertEqual(ScheduledMessageNotificationEmail.objects.count(), 4)
 
+        # A restarted worker picks up the pending batches from the
+        # database.
+        restarted_mmw = MissedMessageWorker()
+        with self.assert_database_query_count(1):
+            restarted_mmw.load_deadlines()
+        self.assertEqual(
+            restarted_mmw.scheduled_timestamps,
+            {hamlet.id: expected_scheduled_timestamp, othello.id: expected_scheduled_timestamp},
+        )
+        self.assertEqual(sorted(restarted_mmw.deadlines), sorted(mmw.deadlines))
+
         # If called after `expected_scheduled_timestamp`, it should process all emails.
         one_minute_overdue = expected_scheduled_timestamp + datetime.timedelta(seconds=60)
         with time_machine.travel(one_minute_overdue, tick=True):
             with send_mock as sm, self.assertLogs(level="INFO") as info_logs:
-                has_timeout = advance()
-                self.assertTrue(has_timeout)
+                next_deadline = advance()
+                self.assertEqual(next_deadline, expected_scheduled_timestamp)
                 self.assertEqual(ScheduledMessageNotificationEmail.objects.count(), 0)
-                has_timeout = advance()
-                self.assertFalse(has_timeout)
+                next_deadline = advance()
+                self.assertIsNone(next_deadline)
 
         self.assertEqual(
             [
@@ -350,9 +494,9 @@ class WorkerTest(ZulipTestCase):
             mmw.consume_single_event(hamlet_event2)
             mmw.consume_single_event(othello_event)
             # See above note about multiple notifies
-            self.assertEqual(notify_mock.call_count, 3)
-            has_timeout = advance()
-            self.assertTrue(has_timeout)
+            self.assertEqual(notify_mock.call_count, 2)
+            next_deadline = advance()
+            self.assertEqual(next_deadline, expected_scheduled_timestamp)
 
         # Next, set up a fail-y consumer:
         def fail_some(user: UserProfile, *args: Any) -> None:
@@ -364,16 +508,91 @@ class WorkerTest(ZulipTestCase):
             level="ERROR"
         ) as error_logs, send_mock as sm:
             sm.side_effect = fail_some
-            has_timeout = advance()
-            self.assertTrue(has_timeout)
+            next_deadline = advance()
+            self.assertEqual(next_deadline, expected_scheduled_timestamp)
             self.assertEqual(ScheduledMessageNotificationEmail.objects.count(), 0)
-            has_timeout = advance()
-            self.assertFalse(has_timeout)
+            next_deadline = advance()
+            self.assertIsNone(next_deadline)
         self.assertIn(
             "ERROR:root:Failed to process 2 missedmessage_emails for user 10",
             error_logs.output[0],
         )
 
+    def test_missed_message_worker_earlier_deadline(self) -> None:
+        cordelia = self.example_user("cordelia")
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        othello.email_notifications_batching_period_seconds = 60
+        othello.save(update_fields=["email_notifications_batching_period_seconds"])
+        self.assertGreater(hamlet.email_notifications_batching_period_seconds, 60)
+
+        hamlet_msg_id = self.send_personal_message(from_user=cordelia, to_user=hamlet)
+        othello_msg_id = self.send_personal_message(from_user=cordelia, to_user=othello)
+
+        mmw = MissedMessageWorker()
+        time_zero = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        with time_machine.travel(time_zero, tick=False):
+            mmw.consume_single_event(
+                dict(
+                    user_profile_id=hamlet.id,
+                    message_id=hamlet_msg_id,
+                    trigger=NotificationTriggers.PRIVATE_MESSAGE,
+                )
+            )
+        # Pretend the worker thread is now waiting for Hamlet's batch.
+        mmw.next_deadline = mmw.deadlines[0][0]
+
+        # Othello's batch is due first, so the thread is woken up to
+        # wait for it instead.
+        with time_machine.travel(time_zero, tick=False), patch.object(
+            mmw.cv, "notify"
+        ) as notify_mock:
+            mmw.consume_single_event(
+                dict(
+                    user_profile_id=othello.id,
+                    message_id=othello_msg_id,
+                    trigger=NotificationTriggers.PRIVATE_MESSAGE,
+                )
+            )
+        self.assertEqual(notify_mock.call_count, 1)
+        self.assertEqual(mmw.deadlines[0], (time_zero + datetime.timedelta(seconds=60), othello.id))
+
+    def test_missed_message_worker_later_batches(self) -> None:
+        cordelia = self.example_user("cordelia")
+        hamlet = self.example_user("hamlet")
+        time_zero = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        later = time_zero + datetime.timedelta(minutes=5)
+
+        # Hamlet has emails scheduled at two different times, as can be
+        # left on disk across a restart.
+        for scheduled_timestamp in [time_zero, later]:
+            ScheduledMessageNotificationEmail.objects.create(
+                user_profile=hamlet,
+                message_id=self.send_personal_message(from_user=cordelia, to_user=hamlet),
+                trigger=NotificationTriggers.PRIVATE_MESSAGE,
+                scheduled_timestamp=scheduled_timestamp,
+            )
+
+        mmw = MissedMessageWorker()
+        mmw.load_deadlines()
+        self.assertEqual(mmw.scheduled_timestamps, {hamlet.id: time_zero})
+        self.assertEqual(sorted(mmw.deadlines), [(time_zero, hamlet.id), (later, hamlet.id)])
+
+        with patch(
+            "zerver.worker.queue_processors.handle_missedmessage_emails"
+        ) as mock_send, self.assertLogs(level="INFO"):
+            with time_machine.travel(time_zero, tick=False):
+                mmw.maybe_send_batched_emails()
+            self.assertEqual(mock_send.call_count, 1)
+            self.assertEqual(mmw.deadlines, [(later, hamlet.id)])
+
+            # The later batch still has its own deadline.
+            with time_machine.travel(later, tick=False):
+                mmw.maybe_send_batched_emails()
+            self.assertEqual(mock_send.call_count, 2)
+        self.assertEqual(mmw.deadlines, [])
+        self.assertEqual(ScheduledMessageNotificationEmail.objects.count(), 0)
+
     def test_push_notifications_worker(self) -> None:
         """
         The push notifications system has its own comprehensive test suite,
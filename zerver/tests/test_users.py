@@ -1,6 +1,6 @@
 import datetime
 from email.headerregistry import Address
-from typing import Any, Dict, Iterable, List, Optional, TypeVar, Union
+from typing import Any, Dict, Iterable, List, Optional, Set, TypeVar, Union
 from unittest import mock
 
 import orjson
@@ -51,6 +51,7 @@ from zerver.lib.user_groups import get_system_user_group_for_user
 from zerver.lib.users import Accounts, access_user_by_id, get_accounts_for_email, user_ids_to_users
 from zerver.lib.utils import assert_is_not_none
 from zerver.models import (
+    AlertWord,
     CustomProfileField,
     InvalidFakeEmailDomainError,
     Message,
@@ -1978,6 +1979,95 @@ class RecipientInfoTest(ZulipTestCase):
         self.assertEqual(info.default_bot_user_ids, {normal_bot.id})
         self.assertEqual(info.all_bot_user_ids, {normal_bot.id, service_bot.id})
 
+    def test_stream_recipient_info_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        realm = hamlet.realm
+        stream_name = "Test stream"
+        self.subscribe(hamlet, stream_name)
+        stream = get_stream(stream_name, realm)
+        recipient = stream.recipient
+        assert recipient is not None
+        stream_topic = StreamTopicTarget(stream_id=stream.id, topic_name="test topic")
+
+        def get_info() -> RecipientInfoResult:
+            return get_recipient_info(
+                realm_id=realm.id,
+                recipient=recipient,
+                sender_id=hamlet.id,
+                stream_topic=stream_topic,
+            )
+
+        self.assertEqual(get_info().active_user_ids, {hamlet.id})
+        # Once cached, sending to the stream needs no queries.
+        with self.assert_database_query_count(0):
+            self.assertEqual(get_info().active_user_ids, {hamlet.id})
+
+        # Subscription changes invalidate the cache.
+        self.subscribe(cordelia, stream_name)
+        self.assertEqual(get_info().active_user_ids, {hamlet.id, cordelia.id})
+
+        # As do changes to user settings...
+        do_change_user_setting(cordelia, "enable_stream_push_notifications", True, acting_user=None)
+        self.assertEqual(get_info().stream_push_user_ids, {cordelia.id})
+
+        # ... and topic visibility policies.
+        do_set_user_topic_visibility_policy(
+            cordelia, stream, "test topic", visibility_policy=UserTopic.VisibilityPolicy.MUTED
+        )
+        self.assertEqual(get_info().stream_push_user_ids, set())
+
+        # Saving subscription settings which recipient info does not
+        # depend on neither looks up the recipient nor invalidates it.
+        sub = get_subscription(stream_name, cordelia)
+        sub.color = "#ffffff"
+        with self.assert_database_query_count(1):
+            sub.save(update_fields=["color"])
+        with self.assert_database_query_count(0):
+            get_info()
+
+        # Without a possible wildcard mention, long-term idle
+        # subscribers are only fetched if they may be mentioned.
+        othello = self.example_user("othello")
+        AlertWord.objects.filter(user_profile=othello).delete()
+        self.subscribe(othello, stream_name)
+        othello.long_term_idle = True
+        othello.save(update_fields=["long_term_idle"])
+
+        def get_info_without_wildcards(
+            possibly_mentioned_user_ids: Set[int],
+        ) -> RecipientInfoResult:
+            return get_recipient_info(
+                realm_id=realm.id,
+                recipient=recipient,
+                sender_id=hamlet.id,
+                stream_topic=stream_topic,
+                possibly_mentioned_user_ids=possibly_mentioned_user_ids,
+                possible_wildcard_mention=False,
+            )
+
+        self.assertEqual(
+            get_info_without_wildcards(set()).active_user_ids, {hamlet.id, cordelia.id}
+        )
+        with self.assert_database_query_count(0):
+            get_info_without_wildcards(set())
+        self.assertEqual(
+            get_info_without_wildcards({othello.id}).long_term_idle_user_ids, {othello.id}
+        )
+        self.assertEqual(get_info().long_term_idle_user_ids, {othello.id})
+
+        # Changes to users who aren't subscribed don't invalidate the
+        # stream's recipient info.
+        do_change_user_setting(
+            self.example_user("iago"), "enable_stream_push_notifications", True, acting_user=None
+        )
+        with self.assert_database_query_count(0):
+            get_info_without_wildcards(set())
+
+        self.unsubscribe(othello, stream_name)
+        self.unsubscribe(cordelia, stream_name)
+        self.assertEqual(get_info().active_user_ids, {hamlet.id})
+
     def test_get_recipient_info_invalid_recipient_type(self) -> None:
         hamlet = self.example_user("hamlet")
         realm = hamlet.realm
@@ -1,6 +1,20 @@
+import threading
 from collections import defaultdict
+from contextlib import contextmanager
 from functools import lru_cache
-from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+from typing import (
+    Any,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 from urllib.parse import urlparse
 
 import orjson
@@ -145,9 +159,17 @@ def send_notification_http(port: int, data: Mapping[str, Any]) -> None:
         #
         # We use an import local to this function to prevent this hack
         # from creating import cycles.
-        from zerver.tornado.event_queue import process_notification
+        from zerver.tornado.event_queue import (
+            finish_handlers_after_batch,
+            process_notification,
+            unbatch_notices,
+        )
 
-        process_notification(data)
+        # Batches from batch_send_events are unpacked here, so that
+        # tests capturing process_notification calls see each notice.
+        with finish_handlers_after_batch():
+            for notice in unbatch_notices([data]):
+                process_notification(notice)
     else:
         tornado_url = get_tornado_url(port)
         requests_client().post(
@@ -156,6 +178,49 @@ def send_notification_http(port: int, data: Mapping[str, Any]) -> None:
         )
 
 
+# While inside a batch_send_events block, `notices` maps Tornado
+# ports to the notices that send_event has queued for them.  This is
+# per-thread, so that threads in a multi-threaded queue worker or
+# uwsgi process do not send (or flush) each other's notices.
+batch_data = threading.local()
+
+
+def get_batched_notices() -> Optional[DefaultDict[int, List[Dict[str, Any]]]]:
+    return getattr(batch_data, "notices", None)
+
+
+@contextmanager
+def batch_send_events() -> Iterator[None]:
+    """Within this block, send_event groups its notices by Tornado
+    port, rather than publishing each one separately.  When the block
+    exits, each port is sent all of its notices as a single batch,
+    which Tornado processes in one pass, waking each long-polling
+    client at most once.  This is intended for bulk operations, like
+    mass subscription changes, that send many events in a row.
+
+    Nested blocks are merged into the outermost one.  Since the
+    notices are only serialized when the block exits, events must not
+    be mutated after being passed to send_event.  Can also be used as
+    a decorator.
+    """
+    if get_batched_notices() is not None:
+        yield
+        return
+
+    notices_by_port: DefaultDict[int, List[Dict[str, Any]]] = defaultdict(list)
+    batch_data.notices = notices_by_port
+    try:
+        yield
+    finally:
+        batch_data.notices = None
+        for port, notices in notices_by_port.items():
+            queue_json_publish(
+                notify_tornado_queue_name(port),
+                dict(notices=notices),
+                lambda *args, **kwargs: send_notification_http(port, *args, **kwargs),
+            )
+
+
 # The core function for sending an event from Django to Tornado (which
 # will then push it to web and mobile clients for the target users).
 # By convention, send_event should only be called from
@@ -180,7 +245,11 @@ def send_event(
             user_id = user if isinstance(user, int) else user["id"]
             port_user_map[get_user_id_tornado_port(realm_ports, user_id)].append(user)
 
+    batched_notices = get_batched_notices()
     for port, port_users in port_user_map.items():
+        if batched_notices is not None:
+            batched_notices[port].append(dict(event=event, users=port_users))
+            continue
         queue_json_publish(
             notify_tornado_queue_name(port),
             dict(event=event, users=port_users),
@@ -1,6 +1,8 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
+import asyncio
 import copy
+import heapq
 import logging
 import os
 import random
@@ -8,8 +10,9 @@ import time
 import traceback
 import uuid
 from collections import deque
-from contextlib import suppress
+from contextlib import contextmanager, suppress
 from functools import lru_cache
+from itertools import islice
 from typing import (
     AbstractSet,
     Any,
@@ -18,6 +21,7 @@ from typing import (
     Deque,
     Dict,
     Iterable,
+    Iterator,
     List,
     Mapping,
     MutableMapping,
@@ -26,12 +30,14 @@ from typing import (
     Set,
     Tuple,
     TypedDict,
+    TypeVar,
     Union,
     cast,
 )
 
 import orjson
 import tornado.ioloop
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.utils.translation import gettext as _
 from tornado import autoreload
@@ -42,8 +48,9 @@ from zerver.lib.message import MessageDict
 from zerver.lib.narrow import build_narrow_filter
 from zerver.lib.notification_data import UserMessageNotificationsData
 from zerver.lib.queue import queue_json_publish, retry_event
+from zerver.lib.topic import get_topic_from_message_info
 from zerver.middleware import async_request_timer_restart
-from zerver.models import CustomProfileField
+from zerver.models import CustomProfileField, Realm
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
 from zerver.tornado.handlers import (
@@ -52,13 +59,18 @@ from zerver.tornado.handlers import (
     get_handler_by_id,
     handler_stats_string,
 )
+from zerver.tornado.sharding import (
+    get_realm_tornado_ports,
+    get_user_id_tornado_port,
+    notify_tornado_queue_name,
+)
 
 # The idle timeout used to be a week, but we found that in that
 # situation, queues from dead browser sessions would grow quite large
 # due to the accumulation of message data in those queues.
 DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
-# We garbage-collect every minute; this is totally fine given that the
-# GC scan takes ~2ms with 1000 event queues.
+# We garbage-collect every minute; each GC only examines the queues
+# whose expiration time has passed; see queue_expirations.
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
 
 # Capped limit for how long a client can request an event queue
@@ -195,6 +207,11 @@ class ClientDescriptor:
             async_request_timer_restart(handler._request)
 
         self.event_queue.push(event)
+        if clients_to_finish is not None:
+            # We're processing a batch of notices; the handler will be
+            # finished, with all of the batch's events, at its end.
+            clients_to_finish[self.event_queue.id] = self
+            return
         self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
@@ -246,6 +263,9 @@ class ClientDescriptor:
     def accepts_messages(self) -> bool:
         return self.event_types is None or "message" in self.event_types
 
+    def expiration_time(self) -> float:
+        return self.last_connection_time + self.queue_timeout
+
     def expired(self, now: float) -> bool:
         return (
             self.current_handler_id is None
@@ -307,12 +327,99 @@ def compute_full_event_type(event: Mapping[str, Any]) -> str:
     return event["type"]
 
 
+class QueuedMessageEvent(Mapping[str, Any]):
+    """A compact event queue entry for a `message` event.
+
+    A message sent to a large stream is delivered to every connected
+    client of every subscriber.  Rather than storing a full event
+    dictionary in each of those queues, process_message_event stores
+    one of these small per-client records, which points at a message
+    payload shared by every client with the same apply_markdown and
+    client_gravatar settings.  That payload must never be mutated.
+
+    The client-facing dictionary is only built, via to_dict, when the
+    event is actually returned to a client.  Since this implements the
+    Mapping protocol, code inspecting queued events (narrow filters,
+    missedmessage_hook, etc.) can treat it like any other event.
+    """
+
+    __slots__ = ("id", "message", "flags", "internal_data", "local_message_id")
+
+    id: Optional[int]
+    message: Mapping[str, Any]
+    flags: Collection[str]
+    internal_data: Optional[Dict[str, Any]]
+    local_message_id: Optional[str]
+
+    def __init__(
+        self,
+        message: Mapping[str, Any],
+        flags: Collection[str],
+        internal_data: Optional[Dict[str, Any]] = None,
+        local_message_id: Optional[str] = None,
+    ) -> None:
+        # The event ID is assigned by EventQueue.push.
+        self.id = None
+        self.message = message
+        self.flags = flags
+        self.internal_data = internal_data
+        self.local_message_id = local_message_id
+
+    def _keys(self) -> List[str]:
+        # This order matches the order in which the keys were added
+        # when message events were stored as plain dictionaries.
+        keys = ["type", "message", "flags"]
+        if self.internal_data is not None:
+            keys.append("internal_data")
+        if self.local_message_id is not None:
+            keys.append("local_message_id")
+        if self.id is not None:
+            keys.append("id")
+        return keys
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "type":
+            return "message"
+        if key in ("message", "flags"):
+            return getattr(self, key)
+        if key in ("id", "internal_data", "local_message_id"):
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys())
+
+    def __len__(self) -> int:
+        return len(self._keys())
+
+    def to_dict(self, include_internal_data: bool = True) -> Dict[str, Any]:
+        event: Dict[str, Any] = dict(type="message", message=self.message, flags=self.flags)
+        if include_internal_data and self.internal_data is not None:
+            event["internal_data"] = self.internal_data
+        if self.local_message_id is not None:
+            event["local_message_id"] = self.local_message_id
+        if self.id is not None:
+            event["id"] = self.id
+        return event
+
+
+QueuedEvent = Union[Dict[str, Any], QueuedMessageEvent]
+
+
+def queued_event_to_dict(event: QueuedEvent) -> Dict[str, Any]:
+    if isinstance(event, QueuedMessageEvent):
+        return event.to_dict()
+    return event
+
+
 class EventQueue:
     def __init__(self, id: str) -> None:
         # When extending this list of properties, one must be sure to
         # update to_dict and from_dict.
 
-        self.queue: Deque[Dict[str, Any]] = deque()
+        self.queue: Deque[QueuedEvent] = deque()
         self.next_event_id: int = 0
         # will only be None for migration from old versions
         self.newest_pruned_id: Optional[int] = -1
@@ -326,7 +433,7 @@ class EventQueue:
         d = dict(
             id=self.id,
             next_event_id=self.next_event_id,
-            queue=list(self.queue),
+            queue=[queued_event_to_dict(event) for event in self.queue],
             virtual_events=self.virtual_events,
         )
         if self.newest_pruned_id is not None:
@@ -343,6 +450,16 @@ class EventQueue:
         return ret
 
     def push(self, orig_event: Mapping[str, Any]) -> None:
+        if isinstance(orig_event, QueuedMessageEvent):
+            # Compact message event records are built by
+            # process_message_event for exactly one queue, so we can
+            # store them directly, without copying.  Message events
+            # are never virtual events.
+            orig_event.id = self.next_event_id
+            self.next_event_id += 1
+            self.queue.append(orig_event)
+            return
+
         # By default, we make a shallow copy of the event dictionary
         # to push into the target event queue; this allows the calling
         # code to send the same "event" object to multiple queues.
@@ -391,7 +508,7 @@ class EventQueue:
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
-    def pop(self) -> Dict[str, Any]:
+    def pop(self) -> QueuedEvent:
         return self.queue.popleft()
 
     def empty(self) -> bool:
@@ -404,7 +521,7 @@ class EventQueue:
             self.pop()
 
     def contents(self, include_internal_data: bool = False) -> List[Dict[str, Any]]:
-        contents: List[Dict[str, Any]] = []
+        contents: List[QueuedEvent] = []
         virtual_id_map: Dict[str, Dict[str, Any]] = {}
         for event_type in self.virtual_events:
             virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
@@ -426,27 +543,67 @@ class EventQueue:
         self.queue = deque(contents)
 
         if include_internal_data:
-            return contents
+            return [queued_event_to_dict(event) for event in contents]
         return prune_internal_data(contents)
 
 
-def prune_internal_data(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Prunes the internal_data data structures, which are not intended to
-    be exposed to API clients.
+def prune_internal_data(events: Iterable[QueuedEvent]) -> List[Dict[str, Any]]:
+    """Returns the client-facing version of the queued events, without
+    the internal_data data structures, which are not intended to be
+    exposed to API clients.
+
+    This is on the path of every GET /events response, which can
+    contain thousands of large message events for clients returning
+    from being idle, so it does not copy event data: only message
+    events get a new top-level dictionary.  The returned events share
+    their contents with the queue, and so must be treated as
+    read-only; they are intended to be serialized straight to JSON.
     """
-    events = copy.deepcopy(events)
+    client_events: List[Dict[str, Any]] = []
     for event in events:
-        if event["type"] == "message" and "internal_data" in event:
-            del event["internal_data"]
-    return events
+        if isinstance(event, QueuedMessageEvent):
+            client_events.append(event.to_dict(include_internal_data=False))
+        elif event["type"] == "message" and "internal_data" in event:
+            # Message events restored from a queue dumped to disk are
+            # plain dictionaries.
+            client_events.append({key: event[key] for key in event if key != "internal_data"})
+        else:
+            client_events.append(event)
+    return client_events
 
 
+# Key for realm_clients_all_streams: the (lowercased) stream and topic
+# names a client's narrow restricts it to, with None meaning any.
+StreamTopicKey = Tuple[Optional[str], Optional[str]]
+
 # maps queue ids to client descriptors
 clients: Dict[str, ClientDescriptor] = {}
 # maps user id to list of client descriptors
 user_clients: Dict[int, List[ClientDescriptor]] = {}
-# maps realm id to list of client descriptors with all_public_streams=True
-realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
+# maps user id to list of client descriptors that accept message events
+user_message_clients: Dict[int, List[ClientDescriptor]] = {}
+# maps realm id to a StreamTopicKey to list of client descriptors
+# that accept message events and have all_public_streams=True or a
+# narrow that may match public stream messages.  Indexing these by
+# narrow means that delivering a message to a huge stream does not
+# visit every narrowed client in the realm.
+realm_clients_all_streams: Dict[int, Dict[StreamTopicKey, List[ClientDescriptor]]] = {}
+
+# A heap of (expiration time, queue id) pairs, with an entry for every
+# queue, so that gc_event_queues only needs to examine the queues which
+# may have expired.  Entries are not updated when a client connects;
+# gc_event_queues instead pushes a new entry when it finds a queue
+# that is not yet expired, and skips entries for queues which were
+# already removed.
+queue_expirations: List[Tuple[float, str]] = []
+
+# Durations, in seconds, of recent gc_event_queues runs.
+gc_durations: Deque[float] = deque(maxlen=60)
+
+# While processing a batch of notices, maps queue ids to the clients
+# that received events, whose handlers are finished once the batch is
+# complete; None otherwise.  See finish_handlers_after_batch.
+clients_to_finish: Optional[Dict[str, ClientDescriptor]] = None
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -460,7 +617,10 @@ def clear_client_event_queues_for_testing() -> None:
     assert settings.TEST_SUITE
     clients.clear()
     user_clients.clear()
+    user_message_clients.clear()
     realm_clients_all_streams.clear()
+    queue_expirations.clear()
+    pending_client_records.clear()
     gc_hooks.clear()
 
 
@@ -470,6 +630,8 @@ def add_client_gc_hook(hook: Callable[[int, ClientDescriptor, bool], None]) -> N
 
 def access_client_descriptor(user_id: int, queue_id: str) -> ClientDescriptor:
     client = clients.get(queue_id)
+    if client is None and queue_id in pending_client_records:
+        client = load_pending_client_descriptor(queue_id)
     if client is not None:
         if user_id == client.user_profile_id:
             return client
@@ -487,14 +649,71 @@ def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescript
     return user_clients.get(user_profile_id, [])
 
 
-def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
-    return realm_clients_all_streams.get(realm_id, [])
+def get_message_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescriptor]:
+    return user_message_clients.get(user_profile_id, [])
+
+
+def get_client_descriptors_for_realm_all_streams(
+    realm_id: int, stream_name: str, topic_name: Optional[str]
+) -> List[ClientDescriptor]:
+    """Returns the clients in the realm registered for all public
+    streams, or with a narrow, whose narrow may match a message to
+    the given stream and topic.  Callers must still check
+    accepts_event, since this does not apply the full narrow filter.
+    """
+    realm_index = realm_clients_all_streams.get(realm_id)
+    if realm_index is None:
+        return []
+
+    stream_key = stream_name.lower()
+    if topic_name is None:
+        # Without the topic, any client narrowed to the stream might match.
+        keys = [key for key in realm_index if key[0] in (None, stream_key)]
+    else:
+        keys = [(None, None), (stream_key, None), (stream_key, topic_name.lower())]
+
+    result: List[ClientDescriptor] = []
+    for key in keys:
+        result += realm_index.get(key, [])
+    return result
+
+
+def get_realm_clients_all_streams_key(client: ClientDescriptor) -> Optional[StreamTopicKey]:
+    """Returns the key under which the client is indexed in
+    realm_clients_all_streams, or None if it shouldn't be indexed
+    there, because it never receives stream messages via that path."""
+    if not client.accepts_messages():
+        return None
+    if not client.all_public_streams and client.narrow == []:
+        return None
+
+    stream_name: Optional[str] = None
+    topic_name: Optional[str] = None
+    for element in client.narrow:
+        operator = element[0]
+        operand = element[1]
+        if operator == "is" and operand in ["dm", "private"]:
+            # Such narrows never match stream messages.
+            return None
+        if operator == "stream" and stream_name is None:
+            stream_name = operand.lower()
+        elif operator == "topic" and topic_name is None:
+            topic_name = operand.lower()
+
+    if stream_name is None:
+        # We only index topic narrows within a stream.
+        return (None, None)
+    return (stream_name, topic_name)
 
 
 def add_to_client_dicts(client: ClientDescriptor) -> None:
+    heapq.heappush(queue_expirations, (client.expiration_time(), client.event_queue.id))
     user_clients.setdefault(client.user_profile_id, []).append(client)
-    if client.all_public_streams or client.narrow != []:
-        realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+    if client.accepts_messages():
+        user_message_clients.setdefault(client.user_profile_id, []).append(client)
+    key = get_realm_clients_all_streams_key(client)
+    if key is not None:
+        realm_clients_all_streams.setdefault(client.realm_id, {}).setdefault(key, []).append(client)
 
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
@@ -506,11 +725,17 @@ def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> Clie
     return client
 
 
+KeyT = TypeVar("KeyT")
+
+
 def do_gc_event_queues(
-    to_remove: AbstractSet[str], affected_users: AbstractSet[int], affected_realms: AbstractSet[int]
+    to_remove: AbstractSet[str],
+    affected_users: AbstractSet[int],
+    affected_realms: AbstractSet[int],
+    run_gc_hooks: bool = True,
 ) -> None:
     def filter_client_dict(
-        client_dict: MutableMapping[int, List[ClientDescriptor]], key: int
+        client_dict: MutableMapping[KeyT, List[ClientDescriptor]], key: KeyT
     ) -> None:
         if key not in client_dict:
             return
@@ -523,17 +748,25 @@ def do_gc_event_queues(
 
     for user_id in affected_users:
         filter_client_dict(user_clients, user_id)
+        filter_client_dict(user_message_clients, user_id)
 
     for realm_id in affected_realms:
-        filter_client_dict(realm_clients_all_streams, realm_id)
+        if realm_id not in realm_clients_all_streams:
+            continue
+        realm_index = realm_clients_all_streams[realm_id]
+        for key in list(realm_index):
+            filter_client_dict(realm_index, key)
+        if len(realm_index) == 0:
+            del realm_clients_all_streams[realm_id]
 
     for id in to_remove:
-        for cb in gc_hooks:
-            cb(
-                clients[id].user_profile_id,
-                clients[id],
-                clients[id].user_profile_id not in user_clients,
-            )
+        if run_gc_hooks:
+            for cb in gc_hooks:
+                cb(
+                    clients[id].user_profile_id,
+                    clients[id],
+                    clients[id].user_profile_id not in user_clients,
+                )
         del clients[id]
 
 
@@ -542,25 +775,52 @@ def gc_event_queues(port: int) -> None:
     to_remove: Set[str] = set()
     affected_users: Set[int] = set()
     affected_realms: Set[int] = set()
-    for id, client in clients.items():
+    to_reschedule: List[ClientDescriptor] = []
+    examined = 0
+    while queue_expirations and queue_expirations[0][0] <= start:
+        expiration_time, id = heapq.heappop(queue_expirations)
+        client = clients.get(id)
+        if client is None or id in to_remove:
+            # Already removed, by cleanup_event_queue, for example.
+            continue
+        examined += 1
         if client.expired(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        else:
+            # The client has connected since this entry was pushed;
+            # this includes clients with a handler connected right
+            # now, which we check again on the next run.
+            to_reschedule.append(client)
+    for client in to_reschedule:
+        heapq.heappush(queue_expirations, (client.expiration_time(), client.event_queue.id))
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle (because
     # they are expired) and thus not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
 
+    # Entries for queues removed other than by expiring stay in the
+    # heap until their expiration time; rebuild it if they pile up.
+    if len(queue_expirations) > 2 * len(clients) + 1000:
+        queue_expirations[:] = [(client.expiration_time(), id) for id, client in clients.items()]
+        heapq.heapify(queue_expirations)
+
+    duration = time.time() - start
+    gc_durations.append(duration)
     if settings.PRODUCTION:
         logging.info(
-            "Tornado %d removed %d expired event queues owned by %d users in %.3fs."
+            "Tornado %d removed %d expired event queues owned by %d users in %.3fs"
+            " (examined %d, max %.3fs over the last %d runs)."
             "  Now %d active queues, %s",
             port,
             len(to_remove),
             len(affected_users),
-            time.time() - start,
+            duration,
+            examined,
+            max(gc_durations),
+            len(gc_durations),
             len(clients),
             handler_stats_string(),
         )
@@ -577,13 +837,37 @@ def persistent_queue_filename(port: int, last: bool = False) -> str:
     return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ("." + str(port),)
 
 
+# Event queues are persisted across restarts in a file with one record
+# per line: the queue ID, a space, and the JSON-encoded
+# ClientDescriptor.  This allows writing and reading the file
+# incrementally, rather than building one huge JSON document.  Older
+# versions wrote a single JSON list of [queue_id, client_dict] pairs,
+# which load_event_queues can still read.
+#
+# Records are deserialized in batches of this size, yielding to the
+# IOLoop between batches.
+EVENT_QUEUE_LOAD_BATCH_SIZE = 1000
+
+# While load_event_queues is running, maps the IDs of queues read from
+# disk, but not yet deserialized, to their JSON records.
+pending_client_records: Dict[str, bytes] = {}
+
+# While load_event_queues is running, notices received from Django,
+# which are processed once every queue has been loaded; None otherwise.
+notices_pending_load: Optional[List[Mapping[str, Any]]] = None
+
+
 def dump_event_queues(port: int) -> None:
     start = time.time()
 
+    # If we're shutting down or reloading while load_event_queues is
+    # still running, we finish loading first, so that neither the
+    # remaining queues nor the notices received meanwhile are lost.
+    finish_loading_event_queues(port)
+
     with open(persistent_queue_filename(port), "wb") as stored_queues:
-        stored_queues.write(
-            orjson.dumps([(qid, client.to_dict()) for (qid, client) in clients.items()])
-        )
+        for qid, client in clients.items():
+            stored_queues.write(b"%s %s\n" % (qid.encode(), orjson.dumps(client.to_dict())))
 
     if len(clients) > 0 or settings.PRODUCTION:
         logging.info(
@@ -591,34 +875,154 @@ def dump_event_queues(port: int) -> None:
         )
 
 
-def load_event_queues(port: int) -> None:
-    global clients
+def restore_client_descriptor(qid: str, client_dict: MutableMapping[str, Any]) -> None:
+    # Put code for migrations due to event queue data format changes here
+
+    client = ClientDescriptor.from_dict(client_dict)
+    clients[qid] = client
+    add_to_client_dicts(client)
+
+
+def load_pending_client_descriptor(qid: str) -> Optional[ClientDescriptor]:
+    """Deserializes a single queue read by load_event_queues, if it's
+    pending; this allows serving requests for any queue while the
+    rest are still loading."""
+    record = pending_client_records.pop(qid, None)
+    if record is None:
+        return None
+    try:
+        restore_client_descriptor(qid, orjson.loads(record))
+    except Exception:
+        logging.exception("Could not deserialize event queue %s", qid, stack_info=True)
+        return None
+    return clients[qid]
+
+
+def finish_loading_event_queues(port: int) -> int:
+    """Deserializes any queues which load_event_queues hasn't yet,
+    without yielding to the IOLoop, and then processes the notices
+    received while they were loading.  Returns the number of those
+    notices."""
+    global notices_pending_load
+    for qid in list(pending_client_records):
+        load_pending_client_descriptor(qid)
+
+    if notices_pending_load is None:
+        return 0
+    pending_notices = notices_pending_load
+    notices_pending_load = None
+    with finish_handlers_after_batch():
+        for notice in pending_notices:
+            try:
+                process_notification(notice)
+            except Exception:
+                logging.exception(
+                    "Tornado %d could not process notice received while loading event queues",
+                    port,
+                    stack_info=True,
+                )
+    return len(pending_notices)
+
+
+async def load_event_queues(port: int) -> None:
+    global notices_pending_load
     start = time.time()
+    legacy_data: List[Tuple[str, MutableMapping[str, Any]]] = []
 
     try:
         with open(persistent_queue_filename(port), "rb") as stored_queues:
-            data = orjson.loads(stored_queues.read())
+            if stored_queues.read(1) == b"[":
+                stored_queues.seek(0)
+                legacy_data = orjson.loads(stored_queues.read())
+            else:
+                stored_queues.seek(0)
+                for line in stored_queues:
+                    qid, _, record = line.rstrip(b"\n").partition(b" ")
+                    pending_client_records[qid.decode()] = record
     except FileNotFoundError:
         pass
     except orjson.JSONDecodeError:
         logging.exception("Tornado %d could not deserialize event queues", port, stack_info=True)
-    else:
-        try:
-            clients = {qid: ClientDescriptor.from_dict(client) for (qid, client) in data}
-        except Exception:
-            logging.exception(
-                "Tornado %d could not deserialize event queues", port, stack_info=True
-            )
+    read_time = time.time() - start
 
-    for client in clients.values():
-        # Put code for migrations due to event queue data format changes here
+    for qid, client_dict in legacy_data:
+        pending_client_records[qid] = orjson.dumps(client_dict)
+    del legacy_data
 
-        add_to_client_dicts(client)
+    # Notices from Django must wait until every queue is loaded,
+    # since they may be for users whose queues are still pending.
+    notices_pending_load = []
+    num_batches = 0
+    try:
+        while pending_client_records:
+            for qid in list(islice(pending_client_records, EVENT_QUEUE_LOAD_BATCH_SIZE)):
+                load_pending_client_descriptor(qid)
+            num_batches += 1
+            await asyncio.sleep(0)
+    finally:
+        # If we're interrupted, say by the server shutting down, this
+        # loads the rest of the queues without yielding, so that the
+        # notices we've already acknowledged are still processed.
+        load_time = time.time() - start - read_time
+        num_notices = finish_loading_event_queues(port)
 
     if len(clients) > 0 or settings.PRODUCTION:
         logging.info(
-            "Tornado %d loaded %d event queues in %.3fs", port, len(clients), time.time() - start
+            "Tornado %d loaded %d event queues in %.3fs"
+            " (read %.3fs, deserialized in %d batches %.3fs, %d notices replayed %.3fs)",
+            port,
+            len(clients),
+            time.time() - start,
+            read_time,
+            num_batches,
+            load_time,
+            num_notices,
+            time.time() - start - read_time - load_time,
+        )
+
+
+def fetch_realm_tornado_ports(realm_ids: Iterable[int]) -> Dict[int, List[int]]:
+    return {
+        realm.id: get_realm_tornado_ports(realm)
+        for realm in Realm.objects.filter(id__in=set(realm_ids))
+    }
+
+
+def hand_off_event_queues(port: int, realm_ports: Mapping[int, List[int]]) -> None:
+    """After a change to the sharding configuration, some of the queues
+    loaded from disk may belong to users who are now served by a
+    different Tornado process.  Rather than letting those queues
+    expire, and forcing their clients to reload, we send each of them
+    to its new process, which restores it.
+
+    `realm_ports` is from fetch_realm_tornado_ports.  This must run on
+    the IOLoop, since it modifies the global queue indexes, and
+    publishes with the Tornado queue client."""
+    to_remove: Set[str] = set()
+    affected_users: Set[int] = set()
+    affected_realms: Set[int] = set()
+    for qid, client in clients.items():
+        if client.realm_id not in realm_ports:
+            continue
+        new_port = get_user_id_tornado_port(realm_ports[client.realm_id], client.user_profile_id)
+        if new_port == port:
+            continue
+        queue_json_publish(
+            notify_tornado_queue_name(new_port),
+            dict(
+                event=dict(type="restore_queue", queue_id=qid, client=client.to_dict()),
+                users=[client.user_profile_id],
+            ),
         )
+        to_remove.add(qid)
+        affected_users.add(client.user_profile_id)
+        affected_realms.add(client.realm_id)
+
+    # The queues live on in their new process, so this isn't the
+    # end of them for the purposes of missedmessage_hook.
+    do_gc_event_queues(to_remove, affected_users, affected_realms, run_gc_hooks=False)
+    if to_remove:
+        logging.info("Tornado %d handed off %d event queues to other ports", port, len(to_remove))
 
 
 def send_restart_events(immediate: bool = False) -> None:
@@ -638,8 +1042,18 @@ def send_restart_events(immediate: bool = False) -> None:
 
 async def setup_event_queue(server: tornado.httpserver.HTTPServer, port: int) -> None:
     if not settings.TEST_SUITE:
-        load_event_queues(port)
+        # This is registered before loading the queues, so that a reload
+        # while they're loading still dumps them; see dump_event_queues.
         autoreload.add_reload_hook(lambda: dump_event_queues(port))
+        await load_event_queues(port)
+        if settings.TORNADO_PROCESSES > 1:
+            # Only the database lookup happens in a thread; the hand-off
+            # itself modifies the queue indexes, which notices arriving on
+            # the IOLoop are also modifying.
+            realm_ports = await sync_to_async(fetch_realm_tornado_ports, thread_sensitive=True)(
+                {client.realm_id for client in clients.values()}
+            )
+            hand_off_event_queues(port, realm_ports)
 
     with suppress(OSError):
         os.rename(persistent_queue_filename(port), persistent_queue_filename(port, last=True))
@@ -811,11 +1225,7 @@ def missedmessage_hook(
 def receiver_is_off_zulip(user_profile_id: int) -> bool:
     # If a user has no message-receiving event queues, they've got no open zulip
     # session so we notify them.
-    all_client_descriptors = get_client_descriptors_for_user(user_profile_id)
-    message_event_queues = [
-        client for client in all_client_descriptors if client.accepts_messages()
-    ]
-    off_zulip = len(message_event_queues) == 0
+    off_zulip = len(get_message_client_descriptors_for_user(user_profile_id)) == 0
     return off_zulip
 
 
@@ -892,7 +1302,12 @@ def get_client_info_for_message_event(
     # bots) that are registered to get events for ALL streams.
     if "stream_name" in event_template and not event_template.get("invite_only"):
         realm_id = event_template["realm_id"]
-        for client in get_client_descriptors_for_realm_all_streams(realm_id):
+        topic_name: Optional[str] = None
+        if "message_dict" in event_template:
+            topic_name = get_topic_from_message_info(event_template["message_dict"])
+        for client in get_client_descriptors_for_realm_all_streams(
+            realm_id, event_template["stream_name"], topic_name
+        ):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=[],
@@ -903,7 +1318,7 @@ def get_client_info_for_message_event(
         user_profile_id: int = user_data["id"]
         flags: Collection[str] = user_data.get("flags", [])
 
-        for client in get_client_descriptors_for_user(user_profile_id):
+        for client in get_message_client_descriptors_for_user(user_profile_id):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=flags,
@@ -953,16 +1368,23 @@ def process_message_event(
     recipient_type_name: str = wide_dict["type"]
     sending_client: str = wide_dict["client"]
 
+    # Every client with the same settings shares a single copy of the
+    # message payload; see QueuedMessageEvent.
     @lru_cache(maxsize=None)
-    def get_client_payload(apply_markdown: bool, client_gravatar: bool) -> Dict[str, Any]:
-        return MessageDict.finalize_payload(
+    def get_client_payload(
+        apply_markdown: bool, client_gravatar: bool, invite_only_stream: bool = False
+    ) -> Dict[str, Any]:
+        message_dict = MessageDict.finalize_payload(
             wide_dict,
             apply_markdown=apply_markdown,
             client_gravatar=client_gravatar,
         )
+        if invite_only_stream:
+            message_dict["invite_only_stream"] = True
+        return message_dict
 
-    # Extra user-specific data to include
-    extra_user_data: Dict[int, Any] = {}
+    # Extra user-specific internal data to include
+    extra_user_data: Dict[int, Dict[str, Any]] = {}
 
     for user_data in users:
         user_profile_id: int = user_data["id"]
@@ -995,7 +1417,7 @@ def process_message_event(
         # Remove fields sent through other pipes to save some space.
         internal_data.pop("user_id")
         internal_data["mentioned_user_group_id"] = mentioned_user_group_id
-        extra_user_data[user_profile_id] = dict(internal_data=internal_data)
+        extra_user_data[user_profile_id] = internal_data
 
         # If the message isn't notifiable had the user been idle, then the user
         # shouldn't receive notifications even if they were online. In that case we can
@@ -1006,7 +1428,7 @@ def process_message_event(
 
         idle = receiver_is_off_zulip(user_profile_id) or (user_profile_id in presence_idle_user_ids)
 
-        extra_user_data[user_profile_id]["internal_data"].update(
+        extra_user_data[user_profile_id].update(
             maybe_enqueue_notifications(
                 user_notifications_data=user_notifications_data,
                 acting_user_id=sender_id,
@@ -1021,29 +1443,26 @@ def process_message_event(
         client = client_data["client"]
         flags = client_data["flags"]
         is_sender: bool = client_data.get("is_sender", False)
-        extra_data: Optional[Mapping[str, bool]] = extra_user_data.get(client.user_profile_id, None)
 
         if not client.accepts_messages():
             # The actual check is the accepts_event() check below;
-            # this line is just an optimization to avoid copying
-            # message data unnecessarily
+            # this line is just an optimization to avoid building
+            # an event unnecessarily
             continue
 
-        message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
-
-        # Make sure Zephyr mirroring bots know whether stream is invite-only
-        if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
-
-        user_event: Dict[str, Any] = dict(type="message", message=message_dict, flags=flags)
-        if extra_data is not None:
-            user_event.update(extra_data)
+        message_dict = get_client_payload(
+            client.apply_markdown,
+            client.client_gravatar,
+            # Make sure Zephyr mirroring bots know whether stream is invite-only
+            "mirror" in client.client_type_name and bool(event_template.get("invite_only")),
+        )
 
-        if is_sender:
-            local_message_id = event_template.get("local_id", None)
-            if local_message_id is not None:
-                user_event["local_message_id"] = local_message_id
+        user_event = QueuedMessageEvent(
+            message_dict,
+            flags,
+            internal_data=extra_user_data.get(client.user_profile_id),
+            local_message_id=event_template.get("local_id") if is_sender else None,
+        )
 
         if not client.accepts_event(user_event):
             continue
@@ -1335,7 +1754,49 @@ def reformat_legacy_send_message_event(
     return (modern_event, user_dicts)
 
 
+@contextmanager
+def finish_handlers_after_batch() -> Iterator[None]:
+    """Defers finishing the long-polling handlers of clients that
+    receive events within this block until its end, so that a client
+    receiving several events from a batch of notices is only woken
+    once, with all of them."""
+    global clients_to_finish
+    if clients_to_finish is not None:
+        yield
+        return
+
+    clients_to_finish = {}
+    try:
+        yield
+    finally:
+        pending_clients = clients_to_finish
+        clients_to_finish = None
+        for client in pending_clients.values():
+            client.finish_current_handler()
+
+
+def unbatch_notices(notices: Iterable[Mapping[str, Any]]) -> Iterator[Mapping[str, Any]]:
+    # Notices sent from within a batch_send_events block arrive as a
+    # single notice, containing the list of individual notices.
+    for notice in notices:
+        if "notices" in notice:
+            yield from notice["notices"]
+        else:
+            yield notice
+
+
 def process_notification(notice: Mapping[str, Any]) -> None:
+    if notices_pending_load is not None:
+        # We're still loading event queues from disk; see load_event_queues.
+        notices_pending_load.append(notice)
+        return
+
+    if "notices" in notice:
+        with finish_handlers_after_batch():
+            for batched_notice in notice["notices"]:
+                process_notification(batched_notice)
+        return
+
     event: Mapping[str, Any] = notice["event"]
     users: Union[List[int], List[Mapping[str, Any]]] = notice["users"]
     start_time = time.time()
@@ -1379,6 +1840,13 @@ def process_notification(notice: Mapping[str, Any]) -> None:
             )
         else:
             client.cleanup()
+    elif event["type"] == "restore_queue":
+        # hand_off_event_queues generates this event to move a queue
+        # to the shard which now serves its user.
+        if event["queue_id"] in clients:
+            logging.info("Ignoring handed off queue %s, which already exists", event["queue_id"])
+        else:
+            restore_client_descriptor(event["queue_id"], dict(event["client"]))
     else:
         process_event(event, cast(List[int], users))
     logging.debug(
@@ -1398,10 +1866,13 @@ def get_wrapped_process_notification(queue_name: str) -> Callable[[List[Dict[str
         )
 
     def wrapped_process_notification(notices: List[Dict[str, Any]]) -> None:
-        for notice in notices:
-            try:
-                process_notification(notice)
-            except Exception:
-                retry_event(queue_name, notice, failure_processor)
+        with finish_handlers_after_batch():
+            for notice in unbatch_notices(notices):
+                try:
+                    process_notification(notice)
+                except Exception:
+                    # Each notice in a batch is retried separately, to
+                    # avoid duplicating the events that succeeded.
+                    retry_event(queue_name, dict(notice), failure_processor)
 
     return wrapped_process_notification
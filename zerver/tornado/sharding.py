@@ -1,7 +1,10 @@
+import bisect
+import hashlib
 import json
 import os
 import re
-from typing import Dict, List, Pattern, Tuple, Union
+from functools import lru_cache
+from typing import Any, Dict, List, Pattern, Tuple, Union
 
 from django.conf import settings
 
@@ -9,6 +12,7 @@ from zerver.models import Realm, UserProfile
 
 shard_map: Dict[str, Union[int, List[int]]] = {}
 shard_regexes: List[Tuple[Pattern[str], Union[int, List[int]]]] = []
+user_sharding: Dict[str, Any] = {}
 if os.path.exists("/etc/zulip/sharding.json"):
     with open("/etc/zulip/sharding.json") as f:
         data = json.loads(f.read())
@@ -19,6 +23,11 @@ if os.path.exists("/etc/zulip/sharding.json"):
         shard_regexes = [
             (re.compile(regex, re.I), port) for regex, port in data.get("shard_regexes", [])
         ]
+        user_sharding = data.get("user_sharding", {})
+
+# Number of points each port gets on the consistent hashing ring, if
+# not configured; more points spread users more evenly between ports.
+DEFAULT_VIRTUAL_NODES = 64
 
 
 def get_realm_tornado_ports(realm: Realm) -> List[int]:
@@ -33,7 +42,35 @@ def get_realm_tornado_ports(realm: Realm) -> List[int]:
     return [settings.TORNADO_PORTS[0]]
 
 
+def ring_hash(key: str) -> int:
+    # Python's hash() is randomized per process, and every process
+    # needs to agree on where a user lives.
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+@lru_cache(None)
+def get_consistent_hash_ring(
+    realm_ports: Tuple[int, ...], virtual_nodes: int
+) -> Tuple[List[int], List[int]]:
+    """Returns the sorted hashes of the points on the ring, and the port
+    owning each.  Adding a port to a realm only moves the users whose
+    hashes fall just before one of the new port's points, rather than
+    nearly every user as with modulo sharding."""
+    points = sorted(
+        (ring_hash(f"{port}-{i}"), port) for port in realm_ports for i in range(virtual_nodes)
+    )
+    return [point_hash for point_hash, port in points], [port for point_hash, port in points]
+
+
 def get_user_id_tornado_port(realm_ports: List[int], user_id: int) -> int:
+    if len(realm_ports) == 1:
+        return realm_ports[0]
+    if user_sharding.get("algorithm") == "consistent_hash":
+        hashes, ports = get_consistent_hash_ring(
+            tuple(realm_ports), user_sharding.get("virtual_nodes", DEFAULT_VIRTUAL_NODES)
+        )
+        index = bisect.bisect(hashes, ring_hash(str(user_id)))
+        return ports[index % len(ports)]
     return realm_ports[user_id % len(realm_ports)]
 
 
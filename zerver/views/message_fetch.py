@@ -9,7 +9,7 @@ from sqlalchemy.types import Integer, Text
 
 from zerver.context_processors import get_valid_realm_from_request
 from zerver.lib.exceptions import JsonableError, MissingAuthenticationError
-from zerver.lib.message import get_first_visible_message_id, messages_for_ids
+from zerver.lib.message import get_first_visible_message_id, messages_json_for_ids
 from zerver.lib.narrow import (
     NarrowBuilder,
     OptionalNarrowListT,
@@ -20,7 +20,7 @@ from zerver.lib.narrow import (
     parse_anchor_value,
 )
 from zerver.lib.request import REQ, RequestNotes, has_request_variables
-from zerver.lib.response import json_success
+from zerver.lib.response import JsonFragment, json_success
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.topic import DB_TOPIC_NAME, MATCH_TOPIC, topic_column_sa
 from zerver.lib.validator import check_bool, check_int, check_list, to_non_negative_int
@@ -212,7 +212,7 @@ def get_messages_backend(
                 rendered_content, topic_name, content_matches, topic_matches
             )
 
-    message_list = messages_for_ids(
+    messages_json = messages_json_for_ids(
         message_ids=message_ids,
         user_message_flags=user_message_flags,
         search_fields=search_fields,
@@ -222,7 +222,7 @@ def get_messages_backend(
     )
 
     ret = dict(
-        messages=message_list,
+        messages=JsonFragment(messages_json),
         result="success",
         msg="",
         found_anchor=query_info.found_anchor,
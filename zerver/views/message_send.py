@@ -1,25 +1,38 @@
 from email.headerregistry import Address
-from typing import Iterable, Optional, Sequence, Union, cast
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union, cast
 
+import orjson
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.http import HttpRequest, HttpResponse
 from django.utils.translation import gettext as _
 
 from zerver.actions.message_send import (
+    OutgoingMessage,
     check_send_message,
+    check_send_messages,
     compute_irc_user_fullname,
     compute_jabber_user_fullname,
     create_mirror_user_if_needed,
     extract_private_recipients,
     extract_stream_indicator,
 )
+from zerver.lib.addressee import Addressee
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.message import render_markdown
+from zerver.lib.rate_limiter import rate_limit_user
 from zerver.lib.request import REQ, RequestNotes, has_request_variables
 from zerver.lib.response import json_success
 from zerver.lib.topic import REQ_topic
-from zerver.lib.validator import check_string_in, to_float
+from zerver.lib.validator import (
+    check_dict_only,
+    check_int,
+    check_list,
+    check_string,
+    check_string_in,
+    check_union,
+    to_float,
+)
 from zerver.lib.zcommand import process_zcommands
 from zerver.lib.zephyr import compute_mit_user_fullname
 from zerver.models import (
@@ -245,6 +258,98 @@ def send_message_backend(
     return json_success(request, data={"id": ret})
 
 
+MAX_MESSAGES_PER_BULK_SEND = 100
+
+
+@has_request_variables
+def send_messages_backend(
+    request: HttpRequest,
+    user_profile: UserProfile,
+    messages: List[Dict[str, Any]] = REQ(
+        json_validator=check_list(
+            check_dict_only(
+                [
+                    ("type", check_string_in(Message.API_RECIPIENT_TYPES)),
+                    (
+                        "to",
+                        check_union(
+                            [
+                                check_string,
+                                check_int,
+                                check_list(check_string),
+                                check_list(check_int),
+                            ]
+                        ),
+                    ),
+                    ("content", check_string),
+                ],
+                [
+                    ("topic", check_string),
+                    ("local_id", check_string),
+                    ("queue_id", check_string),
+                ],
+            )
+        )
+    ),
+) -> HttpResponse:
+    if len(messages) == 0:
+        raise JsonableError(_("No messages to send"))
+    if len(messages) > MAX_MESSAGES_PER_BULK_SEND:
+        raise JsonableError(
+            _("Too many messages; at most {max_messages} can be sent at once").format(
+                max_messages=MAX_MESSAGES_PER_BULK_SEND
+            )
+        )
+
+    # The request itself was charged one unit of the user's API rate
+    # limit; charge one for each additional message, so that sending
+    # in bulk is not a way around that limit.
+    for i in range(len(messages) - 1):
+        rate_limit_user(request, user_profile, domain="api_by_user")
+
+    client = RequestNotes.get_notes(request).client
+    assert client is not None
+
+    outgoing_messages = []
+    for message in messages:
+        recipient_type_name = message["type"]
+        if recipient_type_name == "direct":
+            recipient_type_name = "private"
+
+        # `to` accepts the same values as in the single-message
+        # endpoint, which are JSON-encoded there; decoded values are
+        # re-encoded so that they go through the same parsing.
+        req_to = message["to"]
+        if not isinstance(req_to, str):
+            req_to = orjson.dumps(req_to).decode()
+
+        message_to: Union[Sequence[int], Sequence[str]]
+        if recipient_type_name == "stream":
+            stream_indicator = extract_stream_indicator(req_to)
+            # Split for mypy; see send_message_backend.
+            if isinstance(stream_indicator, int):
+                message_to = [stream_indicator]
+            else:
+                message_to = [stream_indicator]
+        else:
+            message_to = extract_private_recipients(req_to)
+
+        addressee = Addressee.legacy_build(
+            user_profile, recipient_type_name, message_to, message.get("topic")
+        )
+        outgoing_messages.append(
+            OutgoingMessage(
+                addressee=addressee,
+                content=message["content"],
+                local_id=message.get("local_id"),
+                sender_queue_id=message.get("queue_id"),
+            )
+        )
+
+    message_ids = check_send_messages(user_profile, client, outgoing_messages)
+    return json_success(request, data={"ids": message_ids})
+
+
 @has_request_variables
 def zcommand_backend(
     request: HttpRequest, user_profile: UserProfile, command: str = REQ("command")
@@ -5,6 +5,7 @@ import datetime
 import email
 import email.policy
 import functools
+import heapq
 import logging
 import os
 import signal
@@ -50,14 +51,17 @@ from zerver.actions.invites import do_send_confirmation_email
 from zerver.actions.message_edit import do_update_embedded_data
 from zerver.actions.message_flags import do_mark_stream_messages_as_read
 from zerver.actions.message_send import internal_send_private_message, render_incoming_message
-from zerver.actions.presence import do_update_user_presence
+from zerver.actions.presence import do_update_user_presences
 from zerver.actions.realm_export import notify_realm_export
-from zerver.actions.user_activity import do_update_user_activity, do_update_user_activity_interval
+from zerver.actions.user_activity import (
+    do_update_user_activities,
+    do_update_user_activity_interval,
+)
 from zerver.context_processors import common_context
 from zerver.lib.bot_lib import EmbeddedBotHandler, EmbeddedBotQuitError, get_bot_handler
 from zerver.lib.context_managers import lockfile
 from zerver.lib.db import reset_queries
-from zerver.lib.digest import bulk_handle_digest_email
+from zerver.lib.digest import DigestSnapshotCache, bulk_handle_digest_email
 from zerver.lib.email_mirror import (
     decode_stream_email_address,
     is_missed_message_address,
@@ -68,6 +72,7 @@ from zerver.lib.email_notifications import handle_missedmessage_emails
 from zerver.lib.error_notify import do_report_error
 from zerver.lib.exceptions import RateLimitedError
 from zerver.lib.export import export_realm_wrapper
+from zerver.lib.message import rerender_messages
 from zerver.lib.outgoing_webhook import do_rest_call, get_outgoing_webhook_service_handler
 from zerver.lib.push_notifications import (
     clear_push_device_tokens,
@@ -98,14 +103,15 @@ from zerver.models import (
     RealmAuditLog,
     ScheduledMessageNotificationEmail,
     UserMessage,
+    UserPresence,
     UserProfile,
     filter_to_valid_prereg_users,
     flush_per_request_caches,
     get_bot_services,
-    get_client,
     get_system_bot,
     get_user_profile_by_id,
 )
+from zerver.tornado.django_api import batch_send_events
 
 logger = logging.getLogger(__name__)
 
@@ -533,16 +539,13 @@ class UserActivityWorker(LoopQueueProcessingWorker):
                 count, time = uncommitted_events[key_tuple]
                 uncommitted_events[key_tuple] = (count + 1, max(time, event["time"]))
 
-        # Then we insert the updates into the database.
-        #
-        # TODO: Doing these updates in sequence individually is likely
-        # inefficient; the idealized version would do some sort of
-        # bulk insert_or_update query.
-        for key_tuple in uncommitted_events:
-            (user_profile_id, client_id, query) = key_tuple
-            count, time = uncommitted_events[key_tuple]
-            log_time = timestamp_to_datetime(time)
-            do_update_user_activity(user_profile_id, client_id, query, count, log_time)
+        # Then we insert the updates into the database, in one query.
+        do_update_user_activities(
+            {
+                key_tuple: (count, timestamp_to_datetime(time))
+                for key_tuple, (count, time) in uncommitted_events.items()
+            }
+        )
 
 
 @assign_queue("user_activity_interval")
@@ -554,14 +557,40 @@ class UserActivityIntervalWorker(QueueProcessingWorker):
 
 
 @assign_queue("user_presence")
-class UserPresenceWorker(QueueProcessingWorker):
-    def consume(self, event: Mapping[str, Any]) -> None:
-        logging.debug("Received presence event: %s", event)
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        status = event["status"]
-        do_update_user_presence(user_profile, client, log_time, status)
+class UserPresenceWorker(LoopQueueProcessingWorker):
+    """Users with several tabs or devices open each ping presence
+    regularly, so a backlog in this queue contains many pings per
+    user.  Since presence only tracks when a user was last connected
+    and last active, we coalesce each user's pings down to the latest
+    of each, and then update everyone's UserPresence rows at once."""
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        pings: Dict[int, Tuple[float, Optional[float]]] = {}
+        for event in events:
+            logging.debug("Received presence event: %s", event)
+            user_profile_id = event["user_profile_id"]
+            log_time = event["time"]
+            active_time = (
+                log_time if event["status"] == UserPresence.LEGACY_STATUS_ACTIVE_INT else None
+            )
+            if user_profile_id in pings:
+                last_log_time, last_active_time = pings[user_profile_id]
+                log_time = max(log_time, last_log_time)
+                if active_time is None or (
+                    last_active_time is not None and last_active_time > active_time
+                ):
+                    active_time = last_active_time
+            pings[user_profile_id] = (log_time, active_time)
+
+        do_update_user_presences(
+            {
+                user_profile_id: (
+                    timestamp_to_datetime(log_time),
+                    timestamp_to_datetime(active_time) if active_time is not None else None,
+                )
+                for user_profile_id, (log_time, active_time) in pings.items()
+            }
+        )
 
 
 @assign_queue("missedmessage_emails")
@@ -571,67 +600,77 @@ class MissedMessageWorker(QueueProcessingWorker):
     # batch of messages and/or editing them before they are sent out
     # as emails to recipients.
     #
-    # The batch interval is best-effort -- we poll at most every
-    # CHECK_FREQUENCY_SECONDS, to avoid excessive activity.
-    CHECK_FREQUENCY_SECONDS = 5
+    # The ScheduledMessageNotificationEmail table is the durable record
+    # of the pending emails.  We also keep a heap of when each user's
+    # batch is due in memory, rebuilt from the table on startup, so
+    # that the worker thread can sleep until exactly the next batch is
+    # due, rather than polling the database.
 
     worker_thread: Optional[threading.Thread] = None
 
-    # This condition variable mediates the stopping and has_timeout
-    # pieces of state, below it.
+    # This condition variable mediates the stopping state and the
+    # deadline state, below it.
     cv = threading.Condition()
     stopping = False
-    has_timeout = False
+
+    def __init__(self) -> None:
+        super().__init__()
+        # A min-heap of (scheduled_timestamp, user_profile_id), with
+        # an entry for each distinct scheduled timestamp of each user's
+        # pending emails; and, for each user, the timestamp which new
+        # emails are batched with, which is also in the heap.
+        self.deadlines: List[Tuple[datetime.datetime, int]] = []
+        self.scheduled_timestamps: Dict[int, datetime.datetime] = {}
+        # The deadline which the worker thread is sleeping until, if
+        # any; see work().
+        self.next_deadline: Optional[datetime.datetime] = None
+
+    def load_deadlines(self) -> None:
+        # A user may have rows at several timestamps, if emails were
+        # scheduled after their batch was taken for sending, but
+        # before the worker restarted; each needs its own deadline.
+        with self.cv:
+            self.deadlines = [
+                (scheduled_timestamp, user_profile_id)
+                for user_profile_id, scheduled_timestamp in (
+                    ScheduledMessageNotificationEmail.objects.values_list(
+                        "user_profile_id", "scheduled_timestamp"
+                    )
+                    .distinct()
+                    .order_by()
+                )
+            ]
+            heapq.heapify(self.deadlines)
+            # New emails are batched with each user's earliest batch.
+            self.scheduled_timestamps = {}
+            for scheduled_timestamp, user_profile_id in self.deadlines:
+                if (
+                    user_profile_id not in self.scheduled_timestamps
+                    or scheduled_timestamp < self.scheduled_timestamps[user_profile_id]
+                ):
+                    self.scheduled_timestamps[user_profile_id] = scheduled_timestamp
 
     # The main thread, which handles the RabbitMQ connection and creates
     # database rows from them.
     def consume(self, event: Dict[str, Any]) -> None:
         logging.debug("Processing missedmessage_emails event: %s", event)
-        # When we consume an event, check if there are existing pending emails
-        # for that user, and if so use the same scheduled timestamp.
         user_profile_id: int = event["user_profile_id"]
-        user_profile = get_user_profile_by_id(user_profile_id)
-        batch_duration_seconds = user_profile.email_notifications_batching_period_seconds
-        batch_duration = datetime.timedelta(seconds=batch_duration_seconds)
-
-        try:
-            pending_email = ScheduledMessageNotificationEmail.objects.filter(
-                user_profile_id=user_profile_id
-            )[0]
-            scheduled_timestamp = pending_email.scheduled_timestamp
-        except IndexError:
-            scheduled_timestamp = timezone_now() + batch_duration
 
         with self.cv:
-            # We now hold the lock, so there are three places the
-            # worker thread can be:
-            #
-            #  1. In maybe_send_batched_emails, and will have to take
-            #     the lock (and thus block insertions of new rows
-            #     here) to decide if there are any rows and if it thus
-            #     needs a timeout.
-            #
-            #  2. In the cv.wait_for with a timeout because there were
-            #     rows already.  There's nothing for us to do, since
-            #     the newly-inserted row will get checked upon that
-            #     timeout.
-            #
-            #  3. In the cv.wait_for without a timeout, because there
-            #     weren't any rows (which we're about to change).
-            #
-            # Notifying in (1) is irrelevant, since the thread is not
-            # waiting.  If we over-notify by doing so for both (2) and
-            # (3), the behaviour is correct but slightly inefficient,
-            # as the thread will be needlessly awoken and will just
-            # re-wait.  However, if we fail to awake case (3), the
-            # worker thread will never wake up, and the
-            # ScheduledMessageNotificationEmail internal queue will
-            # back up.
-            #
-            # Use the self.has_timeout property (which is protected by
-            # the lock) to determine which of cases (2) or (3) we are
-            # in, and as such if we need to notify after making the
-            # row.
+            # When we consume an event, check if there are existing
+            # pending emails for that user, and if so use the same
+            # scheduled timestamp.  The worker thread only removes
+            # users from scheduled_timestamps with the lock held, just
+            # before sending everything due by then; so if the user is
+            # still there, the new row will be sent with the rest.
+            scheduled_timestamp = self.scheduled_timestamps.get(user_profile_id)
+            if scheduled_timestamp is None:
+                user_profile = get_user_profile_by_id(user_profile_id)
+                batch_duration = datetime.timedelta(
+                    seconds=user_profile.email_notifications_batching_period_seconds
+                )
+                scheduled_timestamp = timezone_now() + batch_duration
+
             try:
                 ScheduledMessageNotificationEmail.objects.create(
                     user_profile_id=user_profile_id,
@@ -640,14 +679,24 @@ class MissedMessageWorker(QueueProcessingWorker):
                     scheduled_timestamp=scheduled_timestamp,
                     mentioned_user_group_id=event.get("mentioned_user_group_id"),
                 )
-                if not self.has_timeout:
-                    self.cv.notify()
             except IntegrityError:
                 logging.debug(
                     "ScheduledMessageNotificationEmail row could not be created. The message may have been deleted. Skipping event."
                 )
+                return
+
+            if user_profile_id not in self.scheduled_timestamps:
+                self.scheduled_timestamps[user_profile_id] = scheduled_timestamp
+                heapq.heappush(self.deadlines, (scheduled_timestamp, user_profile_id))
+                # The worker thread only needs waking if it is now
+                # sleeping past the earliest deadline.  Over-notifying
+                # would be harmless, since it would just re-wait;
+                # failing to notify would delay this batch.
+                if self.next_deadline is None or scheduled_timestamp < self.next_deadline:
+                    self.cv.notify()
 
     def start(self) -> None:
+        self.load_deadlines()
         with self.cv:
             self.stopping = False
         self.worker_thread = threading.Thread(target=lambda: self.work())
@@ -664,52 +713,55 @@ class MissedMessageWorker(QueueProcessingWorker):
                 #  1. We are being explicitly asked to stop; see the
                 #     notify() call in stop()
                 #
-                #  2. We have no ScheduledMessageNotificationEmail
-                #     objects currently (has_timeout = False) and the
-                #     first one was just enqueued; see the notify()
-                #     call in consume().  We break out so that we can
-                #     come back around the loop and re-wait with a
-                #     timeout (see next condition).
+                #  2. A batch was added which is due before the one we
+                #     are waiting for, if any; see the notify() call in
+                #     consume().  We break out so that we can come back
+                #     around the loop and re-wait with a shorter
+                #     timeout.
                 #
-                #  3. One or more ScheduledMessageNotificationEmail
-                #     exist in the database, so we need to re-check
-                #     them regularly; this happens by hitting the
-                #     timeout and calling maybe_send_batched_emails().
-                #     There is no explicit notify() for this.
-                timeout: Optional[int] = None
-                if ScheduledMessageNotificationEmail.objects.exists():
-                    timeout = self.CHECK_FREQUENCY_SECONDS
-                self.has_timeout = timeout is not None
+                #  3. The earliest batch is due; this happens by
+                #     hitting the timeout and calling
+                #     maybe_send_batched_emails().  There is no
+                #     explicit notify() for this.
+                timeout: Optional[float] = None
+                if self.deadlines:
+                    self.next_deadline = self.deadlines[0][0]
+                    timeout = max(0.0, (self.next_deadline - timezone_now()).total_seconds())
+                else:
+                    self.next_deadline = None
 
                 def wait_condition() -> bool:
                     if self.stopping:
                         # Condition (1)
                         return True
-                    if timeout is None:
-                        # Condition (2).  We went to sleep with no
-                        # ScheduledMessageNotificationEmail existing,
-                        # and one has just been made.  We re-check
-                        # that is still true now that we have the
-                        # lock, and if we see it, we stop waiting.
-                        return ScheduledMessageNotificationEmail.objects.exists()
-                    # This should only happen at the start or end of
-                    # the wait, when we haven't been notified, but are
-                    # re-checking the condition.
-                    return False
+                    # Condition (2).  We re-check that there is an
+                    # earlier deadline now that we have the lock.
+                    return bool(self.deadlines) and (
+                        self.next_deadline is None or self.deadlines[0][0] < self.next_deadline
+                    )
 
                 was_notified = self.cv.wait_for(wait_condition, timeout=timeout)
 
             # Being notified means that we are in conditions (1) or
             # (2), above.  In neither case do we need to look at if
-            # there are batches to send -- (2) means that the
-            # ScheduledMessageNotificationEmail was _just_ created, so
-            # there is no need to check it now.
+            # there are batches to send -- (2) means that a batch was
+            # _just_ scheduled, so it is not due yet.
             if not was_notified:
                 self.maybe_send_batched_emails()
 
     def maybe_send_batched_emails(self) -> None:
         current_time = timezone_now()
 
+        with self.cv:
+            # Any further events for these users start new batches;
+            # see consume().
+            while self.deadlines and self.deadlines[0][0] <= current_time:
+                scheduled_timestamp, user_profile_id = heapq.heappop(self.deadlines)
+                # The user may still have a later batch, from before
+                # a restart, that new emails are not being added to.
+                if self.scheduled_timestamps.get(user_profile_id) == scheduled_timestamp:
+                    del self.scheduled_timestamps[user_profile_id]
+
         with transaction.atomic():
             events_to_process = ScheduledMessageNotificationEmail.objects.filter(
                 scheduled_timestamp__lte=current_time
@@ -846,13 +898,18 @@ class ErrorReporter(QueueProcessingWorker):
 class DigestWorker(QueueProcessingWorker):  # nocoverage
     # Who gets a digest is entirely determined by the enqueue_digest_emails
     # management command, not here.
+    def __init__(self) -> None:
+        super().__init__()
+        # Shared by the consecutive chunks of users in each realm.
+        self.snapshot_cache = DigestSnapshotCache()
+
     def consume(self, event: Mapping[str, Any]) -> None:
         if "user_ids" in event:
             user_ids = event["user_ids"]
         else:
             # legacy code may have enqueued a single id
             user_ids = [event["user_profile_id"]]
-        bulk_handle_digest_email(user_ids, event["cutoff"])
+        bulk_handle_digest_email(user_ids, event["cutoff"], self.snapshot_cache)
 
 
 @assign_queue("email_mirror")
@@ -936,6 +993,21 @@ class FetchLinksEmbedData(QueueProcessingWorker):
         raise InterruptConsumeError
 
 
+@assign_queue("rerender_messages")
+class RerenderMessagesWorker(LoopQueueProcessingWorker):
+    """Re-renders messages whose rendered content was found to be from an
+    older version of the Markdown processor while being fetched; see
+    messages_for_ids.  The same message is often queued by several
+    readers, so we deduplicate the batch first."""
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        message_ids = sorted(
+            {message_id for event in events for message_id in event["message_ids"]}
+        )
+        rerendered_count = rerender_messages(message_ids)
+        logging.info("Re-rendered %d of %d queued messages", rerendered_count, len(message_ids))
+
+
 @assign_queue("outgoing_webhooks")
 class OutgoingWebhookWorker(QueueProcessingWorker):
     def consume(self, event: Dict[str, Any]) -> None:
@@ -1011,14 +1083,15 @@ class DeferredWorker(QueueProcessingWorker):
                 event["stream_recipient_ids"],
             )
 
-            for recipient_id in event["stream_recipient_ids"]:
-                count = do_mark_stream_messages_as_read(user_profile, recipient_id)
-                logger.info(
-                    "Marked %s messages as read for user %s, stream_recipient_id %s",
-                    count,
-                    user_profile.id,
-                    recipient_id,
-                )
+            with batch_send_events():
+                for recipient_id in event["stream_recipient_ids"]:
+                    count = do_mark_stream_messages_as_read(user_profile, recipient_id)
+                    logger.info(
+                        "Marked %s messages as read for user %s, stream_recipient_id %s",
+                        count,
+                        user_profile.id,
+                        recipient_id,
+                    )
         elif event["type"] == "mark_stream_messages_as_read_for_everyone":
             logger.info(
                 "Marking messages as read for all users, stream_recipient_id %s",
@@ -0,0 +1,162 @@
+import copy
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import orjson
+from django.core.management.base import CommandParser
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.message import MessageDict
+from zerver.lib.topic import get_topic_from_message_info
+from zerver.models import Message
+from zerver.tornado.event_queue import (
+    EventQueue,
+    QueuedMessageEvent,
+    allocate_client_descriptor,
+    clients,
+    do_gc_event_queues,
+    process_message_event,
+    prune_internal_data,
+)
+
+
+def legacy_prune_internal_data(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # The deepcopy-based implementation that prune_internal_data
+    # replaced, kept here for comparison.
+    events = copy.deepcopy(events)
+    for event in events:
+        if event["type"] == "message" and "internal_data" in event:
+            del event["internal_data"]
+    return events
+
+
+def measure(f: Callable[[], object], reps: int) -> Tuple[float, int]:
+    """Returns the mean time per call, in seconds, and the peak memory
+    allocated by a single call, in bytes."""
+    start = time.perf_counter()
+    for i in range(reps):
+        f()
+    duration = (time.perf_counter() - start) / reps
+
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return duration, peak
+
+
+class Command(ZulipBaseCommand):
+    help = """Micro-benchmarks for the Tornado event queue system.
+
+contents: Times building the client-facing events for a GET /events
+response from an event queue holding --count message events.
+
+dispatch: Times delivering a single public stream message to --count
+connected clients, plus --narrowed-clients clients in the same realm
+narrowed to other streams."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("benchmark", choices=["contents", "dispatch"], help="Benchmark to run")
+        parser.add_argument(
+            "--count", help="Number of queued events or clients", default=1000, type=int
+        )
+        parser.add_argument(
+            "--narrowed-clients",
+            help="Number of clients narrowed to other streams, for dispatch",
+            default=1000,
+            type=int,
+        )
+        parser.add_argument("--reps", help="Iterations of each benchmark", default=20, type=int)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        message = Message.objects.latest("id")
+        wide_dict = MessageDict.wide_dict(message)
+        message_dict = MessageDict.finalize_payload(
+            wide_dict, apply_markdown=True, client_gravatar=True
+        )
+
+        if options["benchmark"] == "contents":
+            self.benchmark_contents(message_dict, options["count"], options["reps"])
+        elif options["benchmark"] == "dispatch":
+            self.benchmark_dispatch(
+                message, wide_dict, options["count"], options["narrowed_clients"], options["reps"]
+            )
+
+    def benchmark_contents(self, message_dict: Dict[str, Any], count: int, reps: int) -> None:
+        queue = EventQueue("benchmark")
+        for i in range(count):
+            queue.push(
+                QueuedMessageEvent(
+                    message_dict,
+                    ["read"],
+                    internal_data=dict(mentioned_user_group_id=None, stream_push_notify=False),
+                )
+            )
+        queued_events = queue.contents(include_internal_data=True)
+
+        print(f"Serializing {count} queued message events, {reps} reps...")
+        for name, f in [
+            ("deepcopy", lambda: legacy_prune_internal_data(queued_events)),
+            ("contents", lambda: prune_internal_data(queue.queue)),
+            ("deepcopy+json", lambda: orjson.dumps(legacy_prune_internal_data(queued_events))),
+            ("contents+json", lambda: orjson.dumps(prune_internal_data(queue.queue))),
+        ]:
+            duration, peak = measure(f, reps)
+            print(f"  {name:>14}: {duration * 1000:8.3f}ms/response, {peak / 1024:10.1f}KiB peak")
+
+    def benchmark_dispatch(
+        self,
+        message: Message,
+        wide_dict: Dict[str, Any],
+        count: int,
+        narrowed_count: int,
+        reps: int,
+    ) -> None:
+        realm_id = message.realm_id
+        stream_name = "benchmark stream"
+        topic_name = get_topic_from_message_info(wide_dict)
+
+        # The clients are not attached to real users; user IDs are
+        # offset to avoid colliding with any existing event queues.
+        base_user_id = 10**9
+        queue_ids = set()
+        for i in range(count + narrowed_count):
+            client = allocate_client_descriptor(
+                dict(
+                    user_profile_id=base_user_id + i,
+                    realm_id=realm_id,
+                    event_types=None,
+                    client_type_name="website",
+                    apply_markdown=i % 2 == 0,
+                    client_gravatar=True,
+                    all_public_streams=False,
+                    queue_timeout=600,
+                    last_connection_time=time.time(),
+                    narrow=[["stream", f"other stream {i}"]] if i >= count else [],
+                )
+            )
+            queue_ids.add(client.event_queue.id)
+
+        event_template = dict(
+            type="message",
+            message_dict=dict(wide_dict, type="stream", subject=topic_name),
+            realm_id=realm_id,
+            stream_name=stream_name,
+        )
+        users = [dict(id=base_user_id + i, flags=[]) for i in range(count)]
+
+        try:
+            print(
+                f"Delivering a message to {count} clients"
+                f" with {narrowed_count} narrowed clients, {reps} reps..."
+            )
+            start = time.perf_counter()
+            for i in range(reps):
+                process_message_event(event_template, users)
+            duration = (time.perf_counter() - start) / reps
+            print(f"  {duration * 1000:.3f}ms/message, {duration * 1000000 / count:.3f}us/client")
+        finally:
+            do_gc_event_queues(
+                queue_ids, {clients[queue_id].user_profile_id for queue_id in queue_ids}, {realm_id}
+            )
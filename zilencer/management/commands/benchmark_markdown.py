@@ -0,0 +1,482 @@
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Match, Optional, Set, Tuple
+
+import ahocorasick
+import orjson
+from django.core.management.base import CommandError, CommandParser
+from markdown.util import Registry
+
+import zerver.models
+from zerver.lib.alert_words import alert_words_in_realm
+from zerver.lib.exceptions import MarkdownRenderingError
+from zerver.lib.generate_test_data import config, load_generators, parse_file
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.markdown import ZulipMarkdown, is_plain_text, markdown_convert, md_engines
+from zerver.lib.types import LinkifierDict
+from zerver.models import (
+    EmojiInfo,
+    Message,
+    Realm,
+    Stream,
+    UserGroup,
+    UserProfile,
+    linkifiers_for_realm,
+)
+from zilencer.management.commands.render_messages import original_content
+
+
+@dataclass
+class BenchmarkMessage:
+    content: str
+    message: Optional[Message] = None
+    # The rendering recorded by render_messages, if any.
+    expected: Optional[str] = None
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[round(fraction * (len(sorted_values) - 1))]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.5),
+        "p99": percentile(values, 0.99),
+        "max": values[-1],
+    }
+
+
+class FeatureTimer:
+    """Accumulates the time spent in each of the processors of a
+    Markdown engine, by wrapping the methods Python-Markdown calls on
+    them.  Time spent in an inline pattern is also counted in the
+    "inline" treeprocessor which runs it."""
+
+    def __init__(self) -> None:
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.patched: List[Tuple[object, str]] = []
+
+    def wrap(self, feature: str, f: Callable[..., Any]) -> Callable[..., Any]:
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.seconds[feature] += time.perf_counter() - start
+                self.calls[feature] += 1
+
+        return timed
+
+    def timed_matches(self, feature: str, matches: Iterator[Match[str]]) -> Iterator[Match[str]]:
+        while True:
+            start = time.perf_counter()
+            match = next(matches, None)
+            self.seconds[feature] += time.perf_counter() - start
+            if match is None:
+                return
+            yield match
+
+    def patch(self, obj: object, attribute: str, replacement: Callable[..., Any]) -> None:
+        setattr(obj, attribute, replacement)
+        self.patched.append((obj, attribute))
+
+    def registry_items(self, registry: Registry) -> List[Tuple[str, Any]]:
+        # Python-Markdown has no public API for the names of the items
+        # in a registry.
+        return [
+            (item.name, registry[item.name])
+            for item in registry._priority  # type: ignore[attr-defined] # see above
+        ]
+
+    def instrument_registry(self, kind: str, registry: Registry, methods: List[str]) -> None:
+        for name, processor in self.registry_items(registry):
+            for method in methods:
+                self.patch(
+                    processor, method, self.wrap(f"{kind}:{name}", getattr(processor, method))
+                )
+
+    def instrument_inline_patterns(self, registry: Registry) -> None:
+        for name, pattern in self.registry_items(registry):
+            feature = f"inline:{name}"
+            get_regex = pattern.getCompiledRegExp
+            self.patch(
+                pattern,
+                "getCompiledRegExp",
+                lambda get_regex=get_regex, feature=feature: TimedRegex(self, feature, get_regex()),
+            )
+            self.patch(pattern, "handleMatch", self.wrap(feature, pattern.handleMatch))
+
+    def instrument(self, engine: ZulipMarkdown) -> None:
+        self.instrument_registry("preprocessor", engine.preprocessors, ["run"])
+        self.instrument_registry("block", engine.parser.blockprocessors, ["test", "run"])
+        self.instrument_registry("tree", engine.treeprocessors, ["run"])
+        self.instrument_inline_patterns(engine.inlinePatterns)
+        self.instrument_registry("postprocessor", engine.postprocessors, ["run"])
+
+    def uninstrument(self) -> None:
+        for obj, attribute in reversed(self.patched):
+            delattr(obj, attribute)
+        self.patched = []
+
+
+class TimedRegex:
+    """Stands in for an inline pattern's compiled regex, timing the
+    search for matches."""
+
+    def __init__(self, timer: FeatureTimer, feature: str, regex: Any) -> None:
+        self.timer = timer
+        self.feature = feature
+        self.regex = regex
+
+    def finditer(self, data: str, pos: int) -> Iterator[Match[str]]:
+        return self.timer.timed_matches(self.feature, self.regex.finditer(data, pos))
+
+    def match(self, data: str) -> Optional[Match[str]]:
+        return self.timer.wrap(self.feature, self.regex.match)(data)
+
+
+class Command(ZulipBaseCommand):
+    help = """Benchmarks rendering messages with markdown_convert, in a realm
+with many linkifiers, custom emoji and alert words, added for the
+duration of the benchmark without changing the database.
+
+Renders either the messages in --corpus, a file written by
+render_messages, or synthetic messages from generate_test_data, with
+mentions of the realm's users, groups and streams, linkifiers, custom
+emoji, and alert words added to some of them.  For --corpus, also
+reports the messages whose rendering no longer matches the file.
+
+Reports p50/p99 rendering latency, the peak memory allocated while
+rendering each message, and the time spent in each of the Markdown
+engine's preprocessors, block processors, treeprocessors, inline
+patterns and postprocessors.
+
+With --output, writes the results as JSON; with --baseline, compares
+them to such a file, and fails if any got slower by more than
+--threshold percent."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--corpus", help="Messages file written by render_messages")
+        parser.add_argument("--count", help="Number of synthetic messages", default=1000, type=int)
+        parser.add_argument(
+            "--reps", help="Iterations of the latency benchmark", default=3, type=int
+        )
+        parser.add_argument("--linkifiers", help="Linkifiers to add", default=200, type=int)
+        parser.add_argument("--realm-emoji", help="Custom emoji to add", default=500, type=int)
+        parser.add_argument("--alert-words", help="Alert words to add", default=1000, type=int)
+        parser.add_argument(
+            "--mentions", help="Users mentioned in synthetic messages", default=10, type=int
+        )
+        parser.add_argument(
+            "--seed", help="Random seed for synthetic messages", default=0, type=int
+        )
+        parser.add_argument("--output", help="Write the results to this file, as JSON")
+        parser.add_argument("--baseline", help="Compare the results to this JSON file")
+        parser.add_argument(
+            "--threshold", help="Regression threshold, in percent", default=10.0, type=float
+        )
+        self.add_realm_args(parser, required=True)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None
+        rng = random.Random(options["seed"])
+
+        linkifiers = self.add_linkifiers(realm, options["linkifiers"])
+        emoji_names = self.add_realm_emoji(realm, options["realm_emoji"])
+        automaton, alert_words = self.build_alert_word_automaton(realm, options["alert_words"])
+
+        if options["corpus"]:
+            messages = self.load_corpus(realm, options["corpus"])
+        else:
+            messages = self.synthetic_messages(
+                realm,
+                rng,
+                options["count"],
+                options["mentions"],
+                [f"BENCH{i}" for i in range(options["linkifiers"])],
+                emoji_names,
+                alert_words,
+            )
+        if not messages:
+            raise CommandError("No messages to benchmark with.")
+
+        def render(message: BenchmarkMessage) -> Optional[str]:
+            sender = message.message.sender if message.message is not None else None
+            try:
+                return markdown_convert(
+                    message.content,
+                    realm_alert_words_automaton=automaton,
+                    message=message.message,
+                    message_realm=realm,
+                    sent_by_bot=sender is not None and sender.is_bot,
+                    translate_emoticons=sender is not None and sender.translate_emoticons,
+                ).rendered_content
+            except MarkdownRenderingError:
+                return None
+
+        # Warm up the Markdown engine and caches, and check the output.
+        failures = 0
+        mismatches: List[int] = []
+        for message in messages:
+            rendered_content = render(message)
+            if rendered_content is None:
+                failures += 1
+            elif message.expected is not None and rendered_content != message.expected:
+                assert message.message is not None
+                mismatches.append(message.message.id)
+        plain_text = sum(
+            is_plain_text(message.content, realm.id, automaton) for message in messages
+        )
+
+        print(
+            f"Rendering {len(messages)} messages ({plain_text} plain text) in realm"
+            f" {realm.string_id}, with {len(linkifiers)} linkifiers,"
+            f" {len(emoji_names)} custom emoji and {len(alert_words)} alert words"
+        )
+
+        latencies: List[float] = []
+        for i in range(options["reps"]):
+            for message in messages:
+                start = time.perf_counter()
+                render(message)
+                latencies.append(time.perf_counter() - start)
+
+        allocations: List[float] = []
+        tracemalloc.start()
+        for message in messages:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            render(message)
+            allocations.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+
+        timer = FeatureTimer()
+        timer.instrument(md_engines[(realm.id, False)])
+        try:
+            start = time.perf_counter()
+            for message in messages:
+                render(message)
+            instrumented_seconds = time.perf_counter() - start
+        finally:
+            timer.uninstrument()
+
+        results: Dict[str, Any] = {
+            "messages": len(messages),
+            "plain_text_messages": plain_text,
+            "failures": failures,
+            "mismatches": len(mismatches),
+            "realm_state": {
+                "linkifiers": len(linkifiers),
+                "realm_emoji": len(emoji_names),
+                "alert_words": len(alert_words),
+            },
+            "latency_ms": {name: value * 1000 for name, value in summarize(latencies).items()},
+            "allocated_kib": {name: value / 1024 for name, value in summarize(allocations).items()},
+            "features_us_per_message": {
+                feature: seconds * 1000000 / len(messages)
+                for feature, seconds in sorted(
+                    timer.seconds.items(), key=lambda item: item[1], reverse=True
+                )
+            },
+        }
+        self.print_results(results, timer, instrumented_seconds, mismatches)
+
+        if options["output"]:
+            with open(options["output"], "wb") as f:
+                f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+        if options["baseline"]:
+            with open(options["baseline"], "rb") as f:
+                baseline = orjson.loads(f.read())
+            self.compare(baseline, results, options["threshold"])
+
+    def add_linkifiers(self, realm: Realm, count: int) -> List[LinkifierDict]:
+        linkifiers = linkifiers_for_realm(realm.id) + [
+            LinkifierDict(
+                pattern=rf"BENCH{i}-(?P<id>[0-9]+)",
+                url_template=f"https://tracker.example.com/bench{i}/{{id}}",
+                id=-i - 1,
+            )
+            for i in range(count)
+        ]
+        # Rendering gets the realm's linkifiers from this cache, which
+        # nothing flushes during the benchmark.
+        zerver.models.per_request_linkifiers_cache[realm.id] = linkifiers
+        return linkifiers
+
+    def add_realm_emoji(self, realm: Realm, count: int) -> List[str]:
+        benchmark_emoji: Dict[str, EmojiInfo] = {}
+        for i in range(count):
+            name = f"bench_emoji_{i}"
+            benchmark_emoji[name] = EmojiInfo(
+                id=str(-i - 1),
+                name=name,
+                source_url=f"/user_avatars/{realm.id}/emoji/images/{name}.png",
+                deactivated=False,
+                author_id=None,
+                still_url=None,
+            )
+
+        # Rendering fetches the realm's emoji from the database for
+        # each message which may use one, which we keep doing.
+        get_active_emoji = realm.get_active_emoji
+
+        def get_active_emoji_with_benchmark_emoji() -> Dict[str, EmojiInfo]:
+            return {**get_active_emoji(), **benchmark_emoji}
+
+        realm.get_active_emoji = get_active_emoji_with_benchmark_emoji  # type: ignore[method-assign] # benchmark only
+        return list(realm.get_active_emoji())
+
+    def build_alert_word_automaton(
+        self, realm: Realm, count: int
+    ) -> Tuple[Optional[ahocorasick.Automaton], List[str]]:
+        user_ids = list(
+            UserProfile.objects.filter(realm=realm, is_active=True, is_bot=False).values_list(
+                "id", flat=True
+            )
+        )
+        words: Dict[str, Set[int]] = defaultdict(set)
+        for user_id, user_words in alert_words_in_realm(realm).items():
+            for word in user_words:
+                words[word.lower()].add(user_id)
+        for i in range(count):
+            words[f"benchword{i}"].add(user_ids[i % len(user_ids)])
+        if not words:
+            return None, []
+
+        automaton = ahocorasick.Automaton()
+        for word, word_user_ids in words.items():
+            automaton.add_word(word, (word, word_user_ids))
+        automaton.make_automaton()
+        return automaton, list(words)
+
+    def load_corpus(self, realm: Realm, filename: str) -> List[BenchmarkMessage]:
+        expected: Dict[int, str] = {}
+        with open(filename, "rb") as f:
+            for line in f:
+                row = orjson.loads(line)
+                expected[row["id"]] = row["content"]
+        messages = Message.objects.filter(id__in=expected, realm=realm).select_related()
+        if len(messages) < len(expected):
+            print(f"Skipping {len(expected) - len(messages)} messages not in this realm")
+        return [
+            BenchmarkMessage(
+                content=original_content(message), message=message, expected=expected[message.id]
+            )
+            for message in messages.order_by("id")
+        ]
+
+    def synthetic_messages(
+        self,
+        realm: Realm,
+        rng: random.Random,
+        count: int,
+        mentions: int,
+        linkifier_prefixes: List[str],
+        emoji_names: List[str],
+        alert_words: List[str],
+    ) -> List[BenchmarkMessage]:
+        # generate_test_data uses the global random state.
+        random.seed(rng.random())
+        paragraphs = parse_file(config, load_generators(config), config["corpus"]["filename"])
+        user_names = list(
+            UserProfile.objects.filter(realm=realm, is_active=True).values_list(
+                "full_name", flat=True
+            )
+        )
+        group_names = list(
+            UserGroup.objects.filter(realm=realm, is_system_group=False).values_list(
+                "name", flat=True
+            )
+        )
+        stream_names = list(
+            Stream.objects.filter(realm=realm, deactivated=False).values_list("name", flat=True)
+        )
+
+        messages = []
+        for i in range(count):
+            words = paragraphs[i % len(paragraphs)].split(" ")
+            # A quarter of messages use each kind of realm state.
+            kind = i % 4
+            if kind == 0 and user_names:
+                words += [
+                    f"@**{name}**"
+                    for name in rng.sample(user_names, min(mentions, len(user_names)))
+                ]
+                if group_names:
+                    words.append(f"@*{rng.choice(group_names)}*")
+                if stream_names:
+                    words.append(f"#**{rng.choice(stream_names)}**")
+            elif kind == 1 and linkifier_prefixes:
+                words += [
+                    f"{rng.choice(linkifier_prefixes)}-{rng.randrange(10000)}" for j in range(3)
+                ]
+            elif kind == 2 and emoji_names:
+                words += [f":{name}:" for name in rng.sample(emoji_names, min(3, len(emoji_names)))]
+            elif kind == 3 and alert_words:
+                words.insert(rng.randrange(len(words) + 1), rng.choice(alert_words))
+            messages.append(BenchmarkMessage(content=" ".join(words)))
+        return messages
+
+    def print_results(
+        self,
+        results: Dict[str, Any],
+        timer: FeatureTimer,
+        instrumented_seconds: float,
+        mismatches: List[int],
+    ) -> None:
+        latency = results["latency_ms"]
+        allocated = results["allocated_kib"]
+        print(
+            f"Latency: mean {latency['mean']:.3f}ms, p50 {latency['p50']:.3f}ms,"
+            f" p99 {latency['p99']:.3f}ms, max {latency['max']:.3f}ms"
+            f" ({1000 / latency['mean']:.1f} messages/sec)"
+        )
+        print(
+            f"Peak allocated: mean {allocated['mean']:.1f}KiB, p50 {allocated['p50']:.1f}KiB,"
+            f" p99 {allocated['p99']:.1f}KiB, max {allocated['max']:.1f}KiB"
+        )
+        if results["failures"]:
+            print(f"{results['failures']} messages failed to render")
+        if mismatches:
+            print(
+                f"{len(mismatches)} messages rendered differently from the corpus,"
+                f" e.g. message IDs {mismatches[:10]}"
+            )
+
+        print(f"{'feature':>40} {'us/msg':>10} {'calls':>10} {'share':>6}")
+        for feature, per_message in results["features_us_per_message"].items():
+            share = timer.seconds[feature] / instrumented_seconds
+            print(
+                f"{feature:>40} {per_message:10.1f} {timer.calls[feature]:10}"
+                f" {share * 100:5.1f}%"
+            )
+
+    def compare(self, baseline: Dict[str, Any], results: Dict[str, Any], threshold: float) -> None:
+        metrics: List[Tuple[str, float, float]] = []
+        for section in ["latency_ms", "allocated_kib"]:
+            for name in ["p50", "p99"]:
+                metrics.append(
+                    (f"{section}.{name}", baseline[section][name], results[section][name])
+                )
+        for feature, value in results["features_us_per_message"].items():
+            if feature in baseline["features_us_per_message"]:
+                metrics.append(
+                    (f"feature {feature}", baseline["features_us_per_message"][feature], value)
+                )
+
+        regressions = []
+        print(f"{'metric':>48} {'baseline':>10} {'current':>10} {'change':>8}")
+        for name, old, new in metrics:
+            change = (new - old) / old * 100 if old else 0.0
+            print(f"{name:>48} {old:10.2f} {new:10.2f} {change:7.1f}%")
+            if change > threshold:
+                regressions.append(name)
+        if regressions:
+            raise CommandError(f"Regressions of more than {threshold}%: {', '.join(regressions)}")
@@ -0,0 +1,105 @@
+import time
+import zlib
+from typing import Any, Callable, List, Tuple
+
+from django.core.management.base import CommandParser
+
+from zerver.lib.cache import to_dict_cache_key_id
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.message import MessageDict, message_dict_to_fragments
+from zerver.lib.message_codec import (
+    DICTIONARY_CODEC_V1,
+    MESSAGE_CODECS,
+    ZLIB_CODEC,
+    MessageCodec,
+)
+from zerver.models import Message
+
+# Roughly memcached's per-item overhead, beyond the key and value.
+MEMCACHED_ITEM_OVERHEAD = 56
+
+
+def measure(f: Callable[[bytes], bytes], items: List[bytes], reps: int) -> float:
+    """Returns the mean time per item, in seconds."""
+    start = time.perf_counter()
+    for i in range(reps):
+        for item in items:
+            f(item)
+    return (time.perf_counter() - start) / (reps * len(items))
+
+
+class Command(ZulipBaseCommand):
+    help = """Compares the codecs for the message to_dict cache on the most
+recent --count messages: plain zlib, as used before cached messages
+had a version byte, and the codecs in zerver.lib.message_codec.
+
+For each, reports the memcached memory used per message, the CPU
+time to compress a message and to decompress it on a fetch, and the
+hit rate a memcached of --cache-size MiB would have, if all of it
+were used for a working set of --working-set messages accessed
+uniformly.
+
+With --train, also builds a dictionary from half of the messages and
+tests it on the other half, to estimate what a dictionary trained on
+this server's messages would gain over the built-in one."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--count", help="Number of messages", default=5000, type=int)
+        parser.add_argument("--reps", help="Iterations of each benchmark", default=5, type=int)
+        parser.add_argument(
+            "--cache-size", help="Memcached memory for messages, in MiB", default=512, type=int
+        )
+        parser.add_argument(
+            "--working-set", help="Number of messages being fetched", default=1000000, type=int
+        )
+        parser.add_argument("--train", action="store_true", help="Also test a trained dictionary")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        messages = list(Message.objects.select_related().order_by("-id")[: options["count"]])
+        if not messages:
+            print("No messages to benchmark with.")
+            return
+        items = [
+            b"\0".join(message_dict_to_fragments(message_dict))
+            for message_dict in MessageDict.to_dict_uncached_helper(messages)
+        ]
+        key_length = len(to_dict_cache_key_id(messages[0].id))
+
+        codecs: List[Tuple[str, Callable[[bytes], bytes], Callable[[bytes], bytes]]] = [
+            ("legacy zlib", zlib.compress, zlib.decompress),
+            ("zlib", ZLIB_CODEC.compress, ZLIB_CODEC.decompress),
+            ("dictionary v1", DICTIONARY_CODEC_V1.compress, DICTIONARY_CODEC_V1.decompress),
+        ]
+        if options["train"]:
+            # zlib only uses the end of the dictionary which fits in
+            # its window, and favors its last bytes; the most recent
+            # messages are the most representative.
+            training_items = items[: len(items) // 2]
+            items = items[len(items) // 2 :]
+            zdict = b"".join(reversed(training_items))[-4096:]
+            trained_codec = MessageCodec(max(MESSAGE_CODECS) + 1, zdict=zdict)
+            codecs.append(("trained", trained_codec.compress, trained_codec.decompress))
+
+        uncompressed_size = sum(len(item) for item in items)
+        print(
+            f"{len(items)} messages, {uncompressed_size / len(items):.1f} bytes each uncompressed"
+        )
+        print(
+            f"{'codec':>14} {'bytes/msg':>10} {'ratio':>6} {'compress':>11}"
+            f" {'decompress':>11} {'hit rate':>9}"
+        )
+        for name, compress, decompress in codecs:
+            compressed_items = [compress(item) for item in items]
+            assert [decompress(item) for item in compressed_items] == items
+            compressed_size = sum(len(item) for item in compressed_items) / len(items)
+            item_size = MEMCACHED_ITEM_OVERHEAD + key_length + compressed_size
+            capacity = options["cache_size"] * 1024 * 1024 / item_size
+            hit_rate = min(1.0, capacity / options["working_set"])
+
+            compress_time = measure(compress, items, options["reps"])
+            decompress_time = measure(decompress, compressed_items, options["reps"])
+            print(
+                f"{name:>14} {compressed_size:10.1f} {uncompressed_size / len(items) / compressed_size:6.2f}"
+                f" {compress_time * 1000000:9.2f}us {decompress_time * 1000000:9.2f}us"
+                f" {hit_rate * 100:8.1f}%"
+            )
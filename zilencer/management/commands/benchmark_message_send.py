@@ -0,0 +1,66 @@
+import time
+from typing import Any, List
+
+from django.core.management.base import CommandParser
+
+from zerver.actions.message_send import OutgoingMessage, check_send_message, check_send_messages
+from zerver.lib.addressee import Addressee
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import Message, get_stream
+
+
+class Command(ZulipBaseCommand):
+    help = """Compares message sending throughput between one message per
+request, as with POST /messages, and batches of messages, as with
+POST /messages/bulk.  Sends --count messages to a stream in each mode.
+
+This sends real messages, so should only be run in a development
+environment."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("email", help="Email address of the sender")
+        parser.add_argument("--stream", help="Stream to send to", default="Verona")
+        parser.add_argument("--count", help="Number of messages to send", default=500, type=int)
+        parser.add_argument(
+            "--batch-size", help="Number of messages per bulk send", default=100, type=int
+        )
+        self.add_realm_args(parser, required=True)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None
+        sender = self.get_user(options["email"], realm)
+        stream = get_stream(options["stream"], realm)
+        client = self.get_client()
+        count = options["count"]
+        batch_size = options["batch_size"]
+
+        sent_message_ids: List[int] = []
+        try:
+            print(f"Sending {count} messages one at a time...")
+            start = time.perf_counter()
+            for i in range(count):
+                sent_message_ids.append(
+                    check_send_message(
+                        sender, client, "stream", [stream.id], "single", f"message {i}"
+                    )
+                )
+            single_duration = time.perf_counter() - start
+            print(f"  {count / single_duration:10.1f} messages/sec")
+
+            print(f"Sending {count} messages in batches of {batch_size}...")
+            start = time.perf_counter()
+            for batch_start in range(0, count, batch_size):
+                outgoing_messages = [
+                    OutgoingMessage(
+                        addressee=Addressee.for_stream(stream, "bulk"), content=f"message {i}"
+                    )
+                    for i in range(batch_start, min(batch_start + batch_size, count))
+                ]
+                sent_message_ids += check_send_messages(sender, client, outgoing_messages)
+            bulk_duration = time.perf_counter() - start
+            print(f"  {count / bulk_duration:10.1f} messages/sec")
+
+            print(f"Speedup: {single_duration / bulk_duration:.2f}x")
+        finally:
+            Message.objects.filter(id__in=sent_message_ids).delete()
@@ -1,15 +1,87 @@
 import csv
+import datetime
+import itertools
+import time
 from timeit import timeit
-from typing import Any, Union
+from typing import Any, Dict, Iterator, List, Tuple, Union
+from unittest import mock
 
 from django.core.management.base import BaseCommand, CommandParser
 
 from zerver.lib.queue import SimpleQueueClient, queue_json_publish
-from zerver.worker.queue_processors import BatchNoopWorker, NoopWorker
+from zerver.models import Client, UserActivity, UserProfile
+from zerver.worker import queue_processors
+from zerver.worker.queue_processors import BatchNoopWorker, NoopWorker, UserActivityWorker
+
+BENCHMARK_QUERY_PREFIX = "queue_rate_benchmark_"
+
+
+def legacy_update_user_activities(
+    activities: Dict[Tuple[int, int, str], Tuple[int, datetime.datetime]]
+) -> None:
+    # The one-row-at-a-time implementation which
+    # do_update_user_activities replaced, kept here for comparison.
+    for (user_profile_id, client_id, query), (count, log_time) in activities.items():
+        (activity, created) = UserActivity.objects.get_or_create(
+            user_profile_id=user_profile_id,
+            client_id=client_id,
+            query=query,
+            defaults={"last_visit": log_time, "count": count},
+        )
+        if not created:
+            activity.count += count
+            activity.last_visit = log_time
+            activity.save(update_fields=["last_visit", "count"])
+
+
+class UserActivityBenchmarkWorker(UserActivityWorker):
+    """A UserActivityWorker on its own queue, which stops after
+    max_consume events."""
+
+    queue_name = "user_activity_benchmark"
+
+    def __init__(self, max_consume: int, legacy: bool) -> None:
+        self.consumed = 0
+        self.max_consume = max_consume
+        self.legacy = legacy
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        if self.legacy:
+            with mock.patch.object(
+                queue_processors, "do_update_user_activities", legacy_update_user_activities
+            ):
+                super().consume_batch(events)
+        else:
+            super().consume_batch(events)
+        self.consumed += len(events)
+        if self.consumed >= self.max_consume:
+            self.stop()
+
+
+def user_activity_events(keys: int) -> Iterator[Dict[str, Any]]:
+    """Events cycling through the given number of distinct (user,
+    client, query) keys."""
+    user_ids = list(
+        UserProfile.objects.filter(is_active=True, is_bot=False).values_list("id", flat=True)
+    )
+    client_ids = list(Client.objects.values_list("id", flat=True)[:5])
+    for i in itertools.count():
+        key = i % keys
+        yield dict(
+            user_profile_id=user_ids[key % len(user_ids)],
+            client_id=client_ids[key % len(client_ids)],
+            query=f"{BENCHMARK_QUERY_PREFIX}{key}",
+            time=time.time(),
+        )
 
 
 class Command(BaseCommand):
-    help = """Times the overhead of enqueuing and dequeuing messages from RabbitMQ."""
+    help = """Times the overhead of enqueuing and dequeuing messages from RabbitMQ.
+
+With --user-activity, instead times draining a backlog of user_activity
+events, cycling through --keys distinct (user, client, query) keys,
+with UserActivityWorker on a separate queue; --legacy writes them one
+row at a time, as UserActivityWorker used to, for comparison."""
 
     def add_arguments(self, parser: CommandParser) -> None:
         parser.add_argument(
@@ -17,6 +89,15 @@ class Command(BaseCommand):
         )
         parser.add_argument("--reps", help="Iterations of enqueue/dequeue", default=1, type=int)
         parser.add_argument("--batch", help="Enables batch dequeuing", action="store_true")
+        parser.add_argument(
+            "--user-activity", help="Drain user_activity events", action="store_true"
+        )
+        parser.add_argument(
+            "--keys", help="Distinct user_activity keys in the backlog", default=1000, type=int
+        )
+        parser.add_argument(
+            "--legacy", help="Write user_activity rows one at a time", action="store_true"
+        )
         parser.add_argument("--csv", help="Path to CSV output", default="rabbitmq-timings.csv")
         parser.add_argument(
             "--prefetches",
@@ -36,10 +117,18 @@ class Command(BaseCommand):
     def handle(self, *args: Any, **options: Any) -> None:
         print("Purging queue...")
         queue = SimpleQueueClient()
-        queue_name = "noop_batch" if options["batch"] else "noop"
-        queue.ensure_queue(queue_name, lambda channel: channel.queue_purge("noop"))
+        if options["user_activity"]:
+            queue_name = UserActivityBenchmarkWorker.queue_name
+        else:
+            queue_name = "noop_batch" if options["batch"] else "noop"
+        queue.ensure_queue(queue_name, lambda channel: channel.queue_purge(queue_name))
         count = options["count"]
         reps = options["reps"]
+        events = (
+            user_activity_events(options["keys"])
+            if options["user_activity"]
+            else itertools.repeat({})
+        )
 
         with open(options["csv"], "w", newline="") as csvfile:
             writer = csv.DictWriter(
@@ -49,14 +138,18 @@ class Command(BaseCommand):
 
             for prefetch in options["prefetches"]:
                 print(f"Queue size {count}, prefetch {prefetch}...")
-                worker: Union[NoopWorker, BatchNoopWorker] = NoopWorker(count, options["slow"])
-                if options["batch"]:
+                worker: Union[
+                    NoopWorker, BatchNoopWorker, UserActivityBenchmarkWorker
+                ] = NoopWorker(count, options["slow"])
+                if options["user_activity"]:
+                    worker = UserActivityBenchmarkWorker(count, options["legacy"])
+                elif options["batch"]:
                     worker = BatchNoopWorker(count, options["slow"])
-                    if prefetch > 0 and prefetch < worker.batch_size:
-                        print(
-                            f"    Skipping, as prefetch {prefetch} is less than batch size {worker.batch_size}"
-                        )
-                        continue
+                if not isinstance(worker, NoopWorker) and 0 < prefetch < worker.batch_size:
+                    print(
+                        f"    Skipping, as prefetch {prefetch} is less than batch size {worker.batch_size}"
+                    )
+                    continue
                 worker.ENABLE_TIMEOUTS = True
                 worker.setup()
 
@@ -68,7 +161,7 @@ class Command(BaseCommand):
                 for i in range(1, reps + 1):
                     worker.consumed = 0
                     timeit(
-                        lambda: queue_json_publish(queue_name, {}),
+                        lambda: queue_json_publish(queue_name, next(events)),
                         number=count,
                     )
                     duration = timeit(
@@ -87,3 +180,6 @@ class Command(BaseCommand):
                     )
                     csvfile.flush()
                 print(f"  Overall: {reps * count}/{total_time}s = {(reps * count) / total_time}/s")
+
+        if options["user_activity"]:
+            UserActivity.objects.filter(query__startswith=BENCHMARK_QUERY_PREFIX).delete()
@@ -18,6 +18,20 @@ def queryset_iterator(queryset: QuerySet[Message], chunksize: int = 5000) -> Ite
         queryset = queryset.filter(id__gt=msg_id)
 
 
+def original_content(message: Message) -> str:
+    """In order to ensure that the output of this tool is consistent
+    across the time, even if messages are edited, we always render the
+    original content version, extracting it from the edit history if
+    necessary."""
+    if message.edit_history:
+        history = orjson.loads(message.edit_history)
+        history = sorted(history, key=lambda i: i["timestamp"])
+        for entry in history:
+            if "prev_content" in entry:
+                return entry["prev_content"]
+    return message.content
+
+
 class Command(BaseCommand):
     help = """
     Render messages to a file.
@@ -40,24 +54,12 @@ class Command(BaseCommand):
         with open(options["destination"], "wb") as result:
             messages = Message.objects.filter(id__gt=latest - amount, id__lte=latest).order_by("id")
             for message in queryset_iterator(messages):
-                content = message.content
-                # In order to ensure that the output of this tool is
-                # consistent across the time, even if messages are
-                # edited, we always render the original content
-                # version, extracting it from the edit history if
-                # necessary.
-                if message.edit_history:
-                    history = orjson.loads(message.edit_history)
-                    history = sorted(history, key=lambda i: i["timestamp"])
-                    for entry in history:
-                        if "prev_content" in entry:
-                            content = entry["prev_content"]
-                            break
+                content = original_content(message)
                 result.write(
                     orjson.dumps(
                         {
                             "id": message.id,
-                            "content": render_markdown(message, content),
+                            "content": render_markdown(message, content).rendered_content,
                         },
                         option=orjson.OPT_APPEND_NEWLINE,
                     )
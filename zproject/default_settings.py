@@ -169,6 +169,9 @@ BOT_CONFIG_SIZE_LIMIT = 10000
 CAMO_URI = ""
 MEMCACHED_LOCATION = "127.0.0.1:11211"
 MEMCACHED_USERNAME = None if get_secret("memcached_password") is None else "zulip@localhost"
+# Whether each process keeps hot, rarely changing objects, like user
+# profiles, in a small local cache in front of memcached.
+PROCESS_LOCAL_CACHE = False
 RABBITMQ_HOST = "127.0.0.1"
 RABBITMQ_PORT = 5672
 RABBITMQ_USERNAME = "zulip"
@@ -512,6 +515,11 @@ USER_LIMIT_FOR_SENDING_PRESENCE_UPDATE_EVENTS = 100
 # a database write each time a client sends a presence update.
 PRESENCE_UPDATE_MIN_FREQ_SECONDS = 55
 
+# How long a snapshot of an organization's presence data is cached
+# and shared between all of the clients polling for it.  If set to 0,
+# every poll queries the database.
+PRESENCE_SNAPSHOT_CACHE_SECONDS = 5
+
 # Controls the timedelta between last_connected_time and last_active_time
 # within which the user should be considered ACTIVE for the purposes of
 # legacy presence events. That is - when sending a presence update about a user to clients,
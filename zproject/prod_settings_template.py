@@ -612,6 +612,9 @@ SOCIAL_AUTH_SAML_SUPPORT_CONTACT = {
 ## To authenticate to memcached, set memcached_password in zulip-secrets.conf,
 ## and optionally change the default username "zulip@localhost" here.
 # MEMCACHED_USERNAME = "zulip@localhost"
+## To save memcached round trips for hot objects like user profiles,
+## each process can also keep a small local cache of them.
+# PROCESS_LOCAL_CACHE = True
 
 
 ################
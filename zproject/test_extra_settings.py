@@ -105,6 +105,9 @@ CACHES["database"] = {
 # Disable caching on sessions to make query counts consistent
 SESSION_ENGINE = "django.contrib.sessions.backends.db"
 
+# Tests check presence right after updating it.
+PRESENCE_SNAPSHOT_CACHE_SECONDS = 0
+
 # Use production config from Webpack in tests
 if PUPPETEER_TESTS:
     WEBPACK_STATS_FILE = os.path.join(DEPLOY_ROOT, "webpack-stats-production.json")
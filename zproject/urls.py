@@ -78,7 +78,12 @@ from zerver.views.message_flags import (
     update_message_flags,
     update_message_flags_for_narrow,
 )
-from zerver.views.message_send import render_message_backend, send_message_backend, zcommand_backend
+from zerver.views.message_send import (
+    render_message_backend,
+    send_message_backend,
+    send_messages_backend,
+    zcommand_backend,
+)
 from zerver.views.muted_users import mute_user, unmute_user
 from zerver.views.presence import (
     get_presence_backend,
@@ -343,6 +348,8 @@ v1_api_and_json_patterns = [
         DELETE=delete_message_backend,
     ),
     rest_path("messages/render", POST=render_message_backend),
+    # POST sends a batch of messages in one request
+    rest_path("messages/bulk", POST=(send_messages_backend, {"allow_incoming_webhooks"})),
     rest_path("messages/flags", POST=update_message_flags),
     rest_path("messages/flags/narrow", POST=update_message_flags_for_narrow),
     rest_path("messages/<int:message_id>/history", GET=get_message_edit_history),